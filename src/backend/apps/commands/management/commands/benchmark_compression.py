@@ -0,0 +1,63 @@
+import time
+import zlib
+
+from django.core.management.base import BaseCommand
+from websockets.frames import OP_TEXT, Frame
+
+from realtime.compression import COMPRESS_SETTINGS, MAX_WINDOW_BITS, ThresholdPerMessageDeflate
+from realtime.helpers import encode_update
+
+
+class Command(BaseCommand):
+    """Measures what permessage-deflate buys per update frame, by frame size.
+
+    Frames go through the same compressor a socket would use, one after the
+    other, so later frames benefit from earlier ones like they do on a real
+    connection. Use it to pick REALTIME['COMPRESSION_THRESHOLD']: below some
+    size the bytes saved aren't worth the CPU.
+    """
+    help = "Benchmark websocket compression, bytes on the wire and CPU per message by frame size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', default='1,4,16,64,256,1024', help="Comma separated rows per update payload")
+        parser.add_argument('--rounds', type=int, default=200, help="Frames sent per payload size")
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write(
+            f"{'raw bytes':>10} {'deflated':>10} {'saved':>7} {'compress':>11} {'decompress':>11}  (per message)"
+        )
+        for items in [int(items) for items in kwargs['items'].split(',')]:
+            frames = [
+                encode_update(
+                    [{"id": n * items + i, "name": f"Item {i}", "tags": ["a", "b", "c"], "value": i * 1.5} for i in range(items)],
+                    "bench/update",
+                ).encode()
+                for n in range(kwargs['rounds'])
+            ]
+            raw, deflated, compress, decompress = self._run(frames)
+            self.stdout.write(
+                f"{raw:>10.0f} {deflated:>10.0f} {1 - deflated / raw:>7.0%} {compress:>8.1f} us {decompress:>8.1f} us"
+            )
+
+    def _run(self, frames):
+        """Returns average raw and compressed size, and CPU microseconds to compress and decompress."""
+        extension = ThresholdPerMessageDeflate(False, False, MAX_WINDOW_BITS, MAX_WINDOW_BITS, dict(COMPRESS_SETTINGS))
+
+        started = time.process_time()
+        compressed = [extension.encode(Frame(fin=True, opcode=OP_TEXT, data=data)).data for data in frames]
+        compress = time.process_time() - started
+
+        # What the browser does with each frame
+        decoder = zlib.decompressobj(wbits=-MAX_WINDOW_BITS)
+        started = time.process_time()
+        for data in compressed:
+            decoder.decompress(data + b'\x00\x00\xff\xff')
+        decompress = time.process_time() - started
+
+        count = len(frames)
+        return (
+            sum(len(data) for data in frames) / count,
+            sum(len(data) for data in compressed) / count,
+            compress / count * 1_000_000,
+            decompress / count * 1_000_000,
+        )
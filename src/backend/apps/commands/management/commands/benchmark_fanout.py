@@ -0,0 +1,61 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from realtime.consumers import RealtimeConsumer
+from realtime.helpers import make_update_event
+
+
+class Command(BaseCommand):
+    """Measures CPU spent per delivered realtime update as the group grows.
+
+    Compares the old "encode in every consumer" events against events made
+    with publish_update, which are encoded once and forwarded as-is.
+    """
+    help = "Benchmark realtime group fan-out, CPU per delivered message"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100,1000', help="Comma separated group sizes")
+        parser.add_argument('--rounds', type=int, default=20, help="Broadcasts per group size")
+        parser.add_argument('--items', type=int, default=50, help="Rows in the payload being sent")
+
+    def handle(self, *args, **kwargs):
+        sizes = [int(size) for size in kwargs['sizes'].split(',')]
+        data = [
+            {"id": i, "name": f"Item {i}", "tags": ["a", "b", "c"], "value": i * 1.5}
+            for i in range(kwargs['items'])
+        ]
+
+        self.stdout.write(f"{'group size':>10} {'per-socket encode':>20} {'encode once':>14}")
+        for size in sizes:
+            legacy = async_to_sync(self._run)(size, kwargs['rounds'], {"type": "update", "data": data, "commit": "bench/update"})
+            once = async_to_sync(self._run)(size, kwargs['rounds'], make_update_event(data, "bench/update"))
+            self.stdout.write(f"{size:>10} {legacy:>17.1f} us {once:>11.1f} us")
+
+    async def _run(self, size, rounds, event):
+        """Returns CPU microseconds per delivered message for `event`."""
+        # Each consumer needs a channel to receive on; use a layer with room
+        # for every round so nothing gets dropped as ChannelFull
+        layer = InMemoryChannelLayer(capacity=rounds + 1)
+        consumers = []
+        for _ in range(size):
+            consumer = RealtimeConsumer()
+            consumer.channel_name = await layer.new_channel()
+            consumer.base_send = _discard
+            await layer.group_add("bench", consumer.channel_name)
+            consumers.append(consumer)
+
+        started = time.process_time()
+        for _ in range(rounds):
+            await layer.group_send("bench", event)
+            for consumer in consumers:
+                await consumer.update(await layer.receive(consumer.channel_name))
+        elapsed = time.process_time() - started
+
+        return elapsed / (size * rounds) * 1_000_000
+
+
+async def _discard(message):
+    pass
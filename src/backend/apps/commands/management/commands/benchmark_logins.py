@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import HttpCommunicator
+from django.contrib.auth import authenticate as sync_authenticate, get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from users.hashing import HashingPoolBusy, authenticate, get_hashing_pool
+
+
+EMAIL_DOMAIN = 'loadtest.invalid'
+
+
+class Command(BaseCommand):
+    """Measures login throughput and latency with many logins at once.
+
+    Runs --logins logins, --concurrency at a time, with each --modes:
+
+        sync     authenticate() on Django's shared sync thread, which is
+                 what a sync view (DRF's) hashing passwords does under ASGI
+        thread   users.hashing.authenticate with a thread pool
+        process  users.hashing.authenticate with a process pool
+
+    Meanwhile a "bystander" keeps requesting a cheap sync view through
+    asgi.application, to show what the logins do to everyone else.
+    """
+    help = "Benchmark concurrent logins, throughput and tail latency per hashing mode"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default='sync,thread,process', help="Comma separated modes to compare")
+        parser.add_argument('--logins', type=int, default=100, help="Logins per mode")
+        parser.add_argument('--concurrency', type=int, default=20, help="Logins at once")
+        parser.add_argument('--workers', type=int, help="USERS['HASHING_WORKERS'], defaults to the number of CPUs")
+        parser.add_argument('--max-pending', type=int, default=1000, help="USERS['HASHING_MAX_PENDING']")
+        parser.add_argument('--hasher', default='django.contrib.auth.hashers.PBKDF2PasswordHasher')
+
+    def handle(self, *args, **kwargs):
+        # The bystander isn't logged in, no need for a warning per request
+        logger = logging.getLogger('django.request')
+        level = logger.level
+        logger.setLevel(logging.ERROR)
+        try:
+            self._benchmark(**kwargs)
+        finally:
+            logger.setLevel(level)
+
+    def _benchmark(self, **kwargs):
+        with override_settings(PASSWORD_HASHERS=[kwargs['hasher']]):
+            users = self._make_users(min(kwargs['logins'], 50))
+            try:
+                self.stdout.write(
+                    f"{'mode':>8} {'logins/s':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'503s':>5}"
+                    f" {'bystander p50':>14} {'bystander p99':>14}"
+                )
+                for mode in kwargs['modes'].split(','):
+                    with override_settings(USERS={
+                        'HASHING_EXECUTOR': 'thread' if mode == 'sync' else mode,
+                        'HASHING_WORKERS': kwargs['workers'],
+                        'HASHING_MAX_PENDING': kwargs['max_pending'],
+                    }):
+                        result = async_to_sync(self._run)(mode, users, kwargs['logins'], kwargs['concurrency'])
+                        get_hashing_pool().shutdown()
+                    self.stdout.write(
+                        f"{mode:>8} {result['logins_per_second']:>9.1f}"
+                        f" {_ms(result['latency'], 50)} {_ms(result['latency'], 95)} {_ms(result['latency'], 99)}"
+                        f" {result['rejected']:>5} {_ms(result['bystander'], 50):>14} {_ms(result['bystander'], 99):>14}"
+                    )
+            finally:
+                get_user_model().objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def _make_users(self, count):
+        # Hashing every user's password would take a while, they share one
+        password_hash = make_password('benchmark')
+        User = get_user_model()
+        return User.objects.bulk_create([
+            User(email=f'benchmark-{time.time_ns()}-{i}@{EMAIL_DOMAIN}', password=password_hash)
+            for i in range(count)
+        ])
+
+    async def _run(self, mode, users, logins, concurrency):
+        from asgi import application
+
+        if mode != 'sync':
+            # Start the workers up front, spawning processes isn't what we're measuring
+            pool = get_hashing_pool()
+            await asyncio.gather(*[pool.make_password('warm up') for _ in range(concurrency)])
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latency, bystander = [], []
+        rejected = 0
+
+        async def login(user):
+            nonlocal rejected
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if mode == 'sync':
+                        logged_in = await sync_to_async(sync_authenticate)(None, email=user.email, password='benchmark')
+                    else:
+                        logged_in = await authenticate(None, user.email, 'benchmark')
+                except HashingPoolBusy:
+                    rejected += 1
+                    return
+                assert logged_in is not None, "Benchmark login failed"
+                latency.append(time.perf_counter() - started)
+
+        async def watch(done):
+            while not done.is_set():
+                started = time.perf_counter()
+                await HttpCommunicator(application, "GET", "/api/users/me/").get_response(timeout=60)
+                bystander.append(time.perf_counter() - started)
+                await asyncio.sleep(0.01)
+
+        done = asyncio.Event()
+        watcher = asyncio.ensure_future(watch(done))
+        started = time.perf_counter()
+        await asyncio.gather(*[login(users[i % len(users)]) for i in range(logins)])
+        elapsed = time.perf_counter() - started
+        done.set()
+        await watcher
+
+        return {
+            'logins_per_second': len(latency) / elapsed,
+            'latency': sorted(latency),
+            'rejected': rejected,
+            'bystander': sorted(bystander),
+        }
+
+
+def _ms(values, percentile):
+    if not values:
+        return f"{'-':>9}"
+    value = values[min(len(values) - 1, int(len(values) * percentile / 100))]
+    return f"{value * 1000:>6.1f} ms"
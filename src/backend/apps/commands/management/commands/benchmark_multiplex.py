@@ -0,0 +1,79 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from realtime.consumers import RealtimeConsumer
+from realtime.helpers import make_update_event
+from realtime.hub import RealtimeHub
+
+
+class CountingChannelLayer(InMemoryChannelLayer):
+    """Counts messages put on channels.
+
+    With channels_redis every one of these is an LPUSH + EXPIRE when sent and
+    a pop when received, so it's a good stand-in for Redis ops per broadcast.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+
+    async def send(self, channel, message):
+        self.sent += 1
+        await super().send(channel, message)
+
+
+class Command(BaseCommand):
+    """Compares channel layer traffic per broadcast for sockets joining their
+    room directly against sockets sharing a RealtimeHub per worker process.
+    """
+    help = "Benchmark channel layer messages per broadcast, with and without the realtime hub"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tabs', default='1,10,100', help="Comma separated sockets per user")
+        parser.add_argument('--workers', type=int, default=4, help="Worker processes the sockets are spread over")
+        parser.add_argument('--rounds', type=int, default=10, help="Broadcasts to send")
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write(f"{'tabs':>6} {'workers':>8} {'direct':>8} {'hub':>8}  (channel layer messages per broadcast)")
+        for tabs in [int(tabs) for tabs in kwargs['tabs'].split(',')]:
+            direct = async_to_sync(self._run)(tabs, kwargs['workers'], kwargs['rounds'], False)
+            hub = async_to_sync(self._run)(tabs, kwargs['workers'], kwargs['rounds'], True)
+            self.stdout.write(f"{tabs:>6} {kwargs['workers']:>8} {direct:>8.1f} {hub:>8.1f}")
+
+    async def _run(self, tabs, workers, rounds, use_hub):
+        layer = CountingChannelLayer(capacity=rounds + 1)
+        # Each hub stands in for one worker process
+        hubs = [RealtimeHub(layer) for _ in range(workers)]
+        consumers = []
+        for tab in range(tabs):
+            consumer = RealtimeConsumer()
+            consumer.channel_name = await layer.new_channel()
+            consumer.base_send = _discard
+            if use_hub:
+                await hubs[tab % workers].join("bench", consumer)
+            else:
+                await layer.group_add("bench", consumer.channel_name)
+            consumers.append(consumer)
+
+        event = make_update_event({"id": 1}, "bench/update")
+        for _ in range(rounds):
+            await layer.group_send("bench", event)
+            if not use_hub:
+                for consumer in consumers:
+                    await consumer.update(await layer.receive(consumer.channel_name))
+
+        # Let the hubs hand everything out before we stop them
+        while any(not queue.empty() for queue in layer.channels.values()):
+            await asyncio.sleep(0)
+        for hub in hubs:
+            for consumer in consumers:
+                await hub.leave("bench", consumer)
+
+        return layer.sent / rounds
+
+
+async def _discard(message):
+    pass
@@ -0,0 +1,82 @@
+import resource
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from users.export import UserExport
+from users.factories import delete_generated_users, generate_users
+
+
+EMAIL_DOMAIN = 'exportbench.invalid'
+
+
+class Command(BaseCommand):
+    """Measures user exports' throughput and memory on a generated table.
+
+    Fills users_user up to --users generated users (kept between runs with
+    --keep), then exports them in each format, throwing the output away,
+    and reports rows per second and the process' peak RSS after each.
+    The "list" rows load every row first like a plain queryset would, and
+    run last since peak RSS never goes back down.
+    """
+    help = "Benchmark streaming user exports, rows per second and peak RSS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000, help="Generated users to export")
+        parser.add_argument('--chunk-size', type=int, help="Rows per fetch, defaults to USERS['EXPORT_CHUNK_SIZE']")
+        parser.add_argument('--skip-list', action='store_true', help="Don't compare against loading every row")
+        parser.add_argument('--keep', action='store_true', help="Leave the generated users for the next run")
+
+    def handle(self, *args, **kwargs):
+        generate_users(kwargs['users'], EMAIL_DOMAIN)
+        queryset = get_user_model().objects.filter(email__endswith=f'@{EMAIL_DOMAIN}')
+        try:
+            self.stdout.write(f"{'mode':>8} {'format':>7} {'rows':>9} {'rows/s':>9} {'peak RSS':>11}")
+            for export_format in ('csv', 'ndjson'):
+                export = UserExport(queryset, format=export_format, chunk_size=kwargs['chunk_size'])
+                self._report('stream', export_format, *_time(lambda: _drain(export.chunks())))
+
+            if not kwargs['skip_list']:
+                for export_format in ('csv', 'ndjson'):
+                    export = UserExport(queryset, format=export_format)
+                    self._report('list', export_format, *_time(lambda: _drain(_in_memory(export))))
+        finally:
+            if not kwargs['keep']:
+                delete_generated_users(EMAIL_DOMAIN)
+
+    def _report(self, mode, export_format, lines, elapsed):
+        # CSV starts with a header
+        rows = lines - 1 if export_format == 'csv' else lines
+        rows_per_second = rows / elapsed if elapsed else 0
+        self.stdout.write(f"{mode:>8} {export_format:>7} {rows:>9} {rows_per_second:>9.0f} {_peak_rss_mib():>7.1f} MiB")
+
+
+def _in_memory(export):
+    """The export the way a plain queryset would do it, every row fetched and encoded at once."""
+    rows = list(export.queryset.values_list(*export.fields))
+    if export.format == 'csv':
+        yield export.encode_csv([export.fields]) + export.encode_csv(rows)
+    else:
+        yield export.encode_ndjson(rows)
+
+
+def _drain(chunks):
+    """Reads `chunks` to the end, returning how many lines they held."""
+    lines = 0
+    for chunk in chunks:
+        lines += chunk.count('\n')
+    return lines
+
+
+def _time(run):
+    started = time.perf_counter()
+    rows = run()
+    return rows, time.perf_counter() - started
+
+
+def _peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
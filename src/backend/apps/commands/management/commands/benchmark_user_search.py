@@ -0,0 +1,71 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from users.factories import delete_generated_users, generate_users
+from users.search import search_users
+
+
+EMAIL_DOMAIN = 'searchbench.invalid'
+
+
+class Command(BaseCommand):
+    """Compares user searches through users.search against the admin's old icontains.
+
+    Fills users_user up to --users generated users (kept between runs with
+    --keep, they take a while to make), then times each search both ways:
+    fetching the first page of 20, and counting every match like the admin's
+    paginator does.
+    """
+    help = "Benchmark trigram user search against icontains on a generated table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2_000_000, help="Generated users to search through")
+        parser.add_argument('--rounds', type=int, default=5, help="Runs per search, the median is reported")
+        parser.add_argument('--searches', default='bench-777-,ramirez,patricia lewis,nosuchuser', help="Comma separated searches")
+        parser.add_argument('--keep', action='store_true', help="Leave the generated users for the next run")
+
+    def handle(self, *args, **kwargs):
+        queryset = get_user_model().objects.all()
+        generate_users(kwargs['users'], EMAIL_DOMAIN)
+        try:
+            self.stdout.write(
+                f"{'search':>16} {'matches':>8} {'icontains page':>15} {'trigram page':>13}"
+                f" {'icontains count':>16} {'trigram count':>14}"
+            )
+            for term in kwargs['searches'].split(','):
+                old, new = _icontains(queryset, term), search_users(queryset, term)
+                timings = [
+                    _median(kwargs['rounds'], lambda: list(old[:20])),
+                    _median(kwargs['rounds'], lambda: list(new[:20])),
+                    _median(kwargs['rounds'], old.count),
+                    _median(kwargs['rounds'], new.count),
+                ]
+                self.stdout.write(
+                    f"{term:>16} {new.count():>8} {timings[0]:>12.1f} ms {timings[1]:>10.1f} ms"
+                    f" {timings[2]:>13.1f} ms {timings[3]:>11.1f} ms"
+                )
+        finally:
+            if not kwargs['keep']:
+                delete_generated_users(EMAIL_DOMAIN)
+
+
+def _icontains(queryset, term):
+    """What the admin's search_fields did before users.search."""
+    for word in term.split():
+        queryset = queryset.filter(
+            Q(first_name__icontains=word) | Q(last_name__icontains=word) | Q(email__icontains=word)
+        )
+    return queryset.order_by('-id')
+
+
+def _median(rounds, run):
+    """Median milliseconds `run` takes."""
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
@@ -0,0 +1,171 @@
+import math
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import get_hashers, identify_hasher, is_password_usable
+from django.core.management.base import BaseCommand
+
+from users.conf import users_setting
+from users.hashers import Argon2PasswordHasher, BCryptSHA256PasswordHasher, SettingsWorkFactorMixin
+
+
+# Stop refining once p99 is within this of the target
+TOLERANCE = 0.1
+MAX_STEPS = 6
+# Lowest work factors we'd ever recommend
+MINIMUMS = {'iterations': 10_000, 'time_cost': 1, 'memory_cost': 8 * 1024, 'rounds': 10}
+
+
+class Command(BaseCommand):
+    """Picks password hasher work factors that suit the current host.
+
+    For each hasher in PASSWORD_HASHERS taking its work factors from USERS
+    (see users.hashers), verifies a password --samples times per candidate
+    work factor until the p99 is within 10% of --target-ms. Argon2 first
+    gets as much memory per hash as --memory-budget-mib allows with every
+    HASHING_WORKERS hashing at once, then the time cost to reach the target.
+
+    Prints the work factors to use, and how many users' passwords would be
+    rehashed on their next login with them. Settings read them from the
+    environment, so on Heroku
+
+        heroku config:set $(./manage.py calibrate_hashers --env)
+
+    run on a dyno of the size serving logins.
+    """
+    help = "Recommend password hasher work factors hitting a target p99 verification time on this host"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float, default=100, help="p99 time to verify a password")
+        parser.add_argument('--samples', type=int, default=20, help="Verifications timed per work factor")
+        parser.add_argument('--memory-budget-mib', type=int, default=256, help="Memory all of Argon2's hashing at once may use")
+        parser.add_argument('--env', action='store_true', help="Only print the settings, as environment variables")
+
+    def handle(self, *args, **kwargs):
+        target = kwargs['target_ms'] / 1000
+        recommended = {}
+        rows = []
+        for hasher in get_hashers():
+            if not isinstance(hasher, SettingsWorkFactorMixin):
+                self.stderr.write(f"Skipping {hasher.algorithm}, its work factors don't come from settings")
+                continue
+            settings = set(hasher.work_factors.values())
+            if settings <= set(recommended):
+                # PBKDF2SHA1 shares PBKDF2's, the first hasher configured decides
+                continue
+            if hasher.library:
+                try:
+                    hasher._load_library()
+                except ValueError:
+                    self.stderr.write(f"Skipping {hasher.algorithm}, {hasher.library} isn't installed")
+                    continue
+
+            before = self._p99(hasher, kwargs['samples'])
+            factors, after = self._calibrate(hasher, target, kwargs)
+            for attribute, value in factors.items():
+                setting = hasher.work_factors[attribute]
+                recommended[setting] = value
+                rows.append((setting, hasher.algorithm, getattr(hasher, attribute), before, value, after))
+
+        if kwargs['env']:
+            for setting, value in recommended.items():
+                self.stdout.write(f"{setting}={value}")
+            return
+
+        self.stdout.write(f"{'setting':<20} {'hasher':<14} {'current':>10} {'p99':>9} {'recommended':>12} {'p99':>9}")
+        for setting, algorithm, current, before, value, after in rows:
+            self.stdout.write(
+                f"{setting:<20} {algorithm:<14} {current:>10} {_ms(before)} {value:>12} {_ms(after)}"
+            )
+
+        now, then, total = self._count_rehashes(recommended)
+        self.stdout.write(
+            f"Rehashed on next login: {now} of {total} users with a password now, {then} with these settings"
+        )
+
+    def _calibrate(self, hasher, target, kwargs):
+        """Returns {attribute: value} for `hasher` hitting `target`, and their p99."""
+        hasher_class = type(hasher)
+        samples = kwargs['samples']
+
+        if isinstance(hasher, Argon2PasswordHasher):
+            workers = users_setting('HASHING_WORKERS') or os.cpu_count()
+            memory_cost = max(MINIMUMS['memory_cost'], kwargs['memory_budget_mib'] // workers * 1024)
+            time_cost, p99 = self._search(hasher_class, 'time_cost', hasher.time_cost, target, samples, memory_cost=memory_cost)
+            if time_cost == MINIMUMS['time_cost'] and p99 > target * (1 + TOLERANCE):
+                # Too slow even going over the memory once, so less of it
+                memory_cost, p99 = self._search(hasher_class, 'memory_cost', memory_cost, target, samples, time_cost=time_cost)
+            return {'time_cost': time_cost, 'memory_cost': memory_cost}, p99
+
+        attribute = 'rounds' if isinstance(hasher, BCryptSHA256PasswordHasher) else 'iterations'
+        value, p99 = self._search(hasher_class, attribute, getattr(hasher, attribute), target, samples)
+        return {attribute: value}, p99
+
+    def _search(self, hasher_class, attribute, value, target, samples, **fixed):
+        """Adjusts `attribute` from `value` until verifying takes about `target`, returns it and its p99."""
+        p99 = self._p99(hasher_class(**{attribute: value}, **fixed), samples)
+        for _ in range(MAX_STEPS):
+            ratio = target / p99
+            if abs(ratio - 1) <= TOLERANCE:
+                break
+            if attribute == 'rounds':
+                # bcrypt's rounds are a log2 of its cost
+                candidate = value + round(math.log2(ratio))
+            elif attribute == 'iterations':
+                candidate = round(value * ratio, -3)
+            elif attribute == 'memory_cost':
+                # Whole MiB
+                candidate = round(value * ratio / 1024) * 1024
+            else:
+                candidate = round(value * ratio)
+            candidate = max(MINIMUMS[attribute], int(candidate))
+            if candidate == value:
+                break
+            value = candidate
+            p99 = self._p99(hasher_class(**{attribute: value}, **fixed), samples)
+        return value, p99
+
+    def _p99(self, hasher, samples):
+        encoded = hasher.encode('calibrating', hasher.salt())
+        timings = []
+        for _ in range(samples):
+            started = time.perf_counter()
+            hasher.verify('calibrating', encoded)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        return timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+    def _count_rehashes(self, recommended):
+        """Returns how many passwords must_update now and with `recommended`, of how many usable ones."""
+        preferred = get_hashers()[0]
+        calibrated = preferred
+        if isinstance(preferred, SettingsWorkFactorMixin):
+            calibrated = type(preferred)(**{
+                attribute: recommended[setting]
+                for attribute, setting in preferred.work_factors.items()
+                if setting in recommended
+            })
+
+        now = then = total = 0
+        passwords = get_user_model().objects.values_list('password', flat=True)
+        for encoded in passwords.iterator(chunk_size=2000):
+            if not is_password_usable(encoded):
+                continue
+            total += 1
+            try:
+                algorithm = identify_hasher(encoded).algorithm
+            except ValueError:
+                # Hashed with something no longer configured, can't log in to be rehashed
+                continue
+            if algorithm != preferred.algorithm:
+                now += 1
+                then += 1
+                continue
+            now += preferred.must_update(encoded)
+            then += calibrated.must_update(encoded)
+        return now, then, total
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:>6.1f} ms"
@@ -0,0 +1,43 @@
+from contextlib import closing
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from users.export import FIELDS, UserExport
+
+
+class Command(BaseCommand):
+    """Writes users out as CSV or NDJSON, a chunk at a time, see users.export.
+
+        ./manage.py export_users --format ndjson --fields id,email --is-active true > users.ndjson
+    """
+    help = "Export users as CSV or NDJSON without loading them all into memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', default='csv', help="csv or ndjson")
+        parser.add_argument('--fields', help=f"Comma separated, from {','.join(FIELDS)}")
+        parser.add_argument('--is-active', help="Only active (true) or inactive (false) users")
+        parser.add_argument('--is-staff', help="Only staff (true) or other (false) users")
+        parser.add_argument('--email', help="Only users whose email starts with this")
+        parser.add_argument('--chunk-size', type=int, help="Rows per fetch, defaults to USERS['EXPORT_CHUNK_SIZE']")
+        parser.add_argument('--output', help="File to write to instead of stdout")
+
+    def handle(self, *args, **kwargs):
+        params = {
+            name: kwargs[name] for name in ('format', 'fields', 'is_active', 'is_staff', 'email')
+            if kwargs[name] is not None
+        }
+        try:
+            export = UserExport.from_params(params, chunk_size=kwargs['chunk_size'])
+        except ValidationError as e:
+            raise CommandError(' '.join(f"{field}: {' '.join(errors)}" for field, errors in e.detail.items()))
+
+        # Closed as soon as we stop, it holds a transaction open
+        with closing(export.chunks()) as chunks:
+            if kwargs['output']:
+                with open(kwargs['output'], 'w', newline='') as output:
+                    for chunk in chunks:
+                        output.write(chunk)
+            else:
+                for chunk in chunks:
+                    self.stdout.write(chunk, ending='')
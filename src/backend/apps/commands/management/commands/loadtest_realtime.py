@@ -0,0 +1,361 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from importlib import import_module
+
+from asgiref.sync import async_to_sync
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from realtime.helpers import send_to_users
+
+
+COMMIT = 'loadtest/update'
+EMAIL_DOMAIN = 'loadtest.invalid'
+
+
+class InProcessSocket:
+    """Talks to asgi.application directly, no network involved."""
+
+    def __init__(self, application, cookie):
+        self.communicator = WebsocketCommunicator(application, "/ws/", headers=[(b"cookie", cookie.encode())])
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        return connected
+
+    async def recv(self):
+        return await self.communicator.receive_from(timeout=60 * 60)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class UvicornSocket:
+    """A real websocket to the uvicorn server we started."""
+
+    def __init__(self, url, cookie):
+        self.url = url
+        self.cookie = cookie
+        self.websocket = None
+
+    async def connect(self):
+        import websockets
+
+        try:
+            self.websocket = await websockets.connect(self.url, extra_headers=[('Cookie', self.cookie)], max_queue=None)
+        except websockets.InvalidStatusCode:
+            return False
+        return True
+
+    async def recv(self):
+        return await self.websocket.recv()
+
+    async def close(self):
+        if self.websocket:
+            await self.websocket.close()
+
+
+class EventStream:
+    """Splits a Server-Sent Events body into the data of each event, subclasses read the body."""
+
+    def __init__(self):
+        self.buffer = b""
+
+    async def recv(self):
+        while True:
+            while b"\n\n" not in self.buffer:
+                chunk = await self.read()
+                if chunk is None:
+                    raise ConnectionError("Event stream ended")
+                self.buffer += chunk
+            event, self.buffer = self.buffer.split(b"\n\n", 1)
+            data = [line[6:] for line in event.split(b"\n") if line.startswith(b"data: ")]
+            if data:
+                # Comments (heartbeats) have no data
+                return b"\n".join(data).decode()
+
+
+class InProcessEventStream(EventStream):
+    """Reads /events/ from asgi.application directly, no network involved."""
+
+    def __init__(self, application, cookie):
+        super().__init__()
+        self.communicator = ApplicationCommunicator(application, {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "GET",
+            "path": "/events/",
+            "query_string": b"",
+            "headers": [(b"cookie", cookie.encode())],
+        })
+
+    async def connect(self):
+        await self.communicator.send_input({"type": "http.request", "body": b""})
+        start = await self.communicator.receive_output(timeout=30)
+        return start['status'] == 200
+
+    async def read(self):
+        message = await self.communicator.receive_output(timeout=60 * 60)
+        return message.get('body', b"") if message.get('more_body') else None
+
+    async def close(self):
+        await self.communicator.send_input({"type": "http.disconnect"})
+        await self.communicator.wait()
+
+
+class UvicornEventStream(EventStream):
+    """A real HTTP request for /events/ to the server we started."""
+
+    def __init__(self, port, cookie):
+        super().__init__()
+        self.port = port
+        self.cookie = cookie
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.writer.write(
+            f"GET /events/ HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: {self.cookie}\r\n"
+            f"Accept: text/event-stream\r\n\r\n".encode()
+        )
+        headers = await self.reader.readuntil(b"\r\n\r\n")
+        return headers.split(b" ", 2)[1] == b"200"
+
+    async def read(self):
+        # uvicorn streams with chunked transfer encoding
+        size = int((await self.reader.readline()).strip(), 16)
+        chunk = await self.reader.readexactly(size + 2)
+        return chunk[:-2] if size else None
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class Command(BaseCommand):
+    """Load tests the websocket side of asgi.application.
+
+    Opens --sockets authenticated sockets spread over --users throwaway users,
+    sends every user an update --rate times a second for --duration seconds,
+    and prints a JSON report:
+
+        connect_latency_ms / fanout_latency_ms  p50, p95 and p99
+        messages_per_second                     updates received by all sockets
+        memory_per_socket_kb                    server RSS growth while connecting
+
+    --transport sse reads the /events/ stream instead of opening websockets,
+    to compare what each costs.
+
+    By default the app runs in this process on the configured channel layer
+    (the in-memory one under test settings). --server uvicorn starts a local
+    `./manage.py serve` instead, which needs --redis-url so updates sent from
+    here reach it. The server gets REDIS_URL from it, so its settings must use
+    the Redis layer; a redislite server works fine as a stand-in.
+
+    Compare reports from before and after a change to RealtimeConsumer to
+    catch regressions. Memory is read from /proc, so it's null off Linux, and
+    in process it includes the test client's side of each socket.
+    """
+    help = "Load test realtime websockets, printing latency, throughput and memory as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=100, help="Sockets to open")
+        parser.add_argument('--users', type=int, default=10, help="Users the sockets are spread over")
+        parser.add_argument('--rate', type=float, default=10, help="Broadcasts per second, each goes to every user")
+        parser.add_argument('--duration', type=float, default=5, help="Seconds to send broadcasts for")
+        parser.add_argument('--concurrency', type=int, default=50, help="Sockets connecting at once")
+        parser.add_argument('--server', choices=['inprocess', 'uvicorn'], default='inprocess')
+        parser.add_argument('--transport', choices=['websocket', 'sse'], default='websocket')
+        parser.add_argument('--port', type=int, default=8765, help="Port for --server uvicorn")
+        parser.add_argument('--redis-url', help="Use the Redis channel layer at this URL, i.e. redis://localhost:6379")
+
+    def handle(self, *args, **kwargs):
+        if kwargs['server'] == 'uvicorn' and not kwargs['redis_url']:
+            raise CommandError("--server uvicorn needs --redis-url, the in-memory layer can't reach another process")
+        if kwargs['sockets'] < 1 or kwargs['users'] < 1 or kwargs['rate'] <= 0:
+            raise CommandError("--sockets, --users and --rate must be positive")
+
+        layers = settings.CHANNEL_LAYERS
+        if kwargs['redis_url']:
+            layers = {
+                'default': {
+                    'BACKEND': 'realtime.layers.RealtimeRedisChannelLayer',
+                    'CONFIG': {'hosts': [kwargs['redis_url']]},
+                },
+            }
+
+        users, sessions = self._make_users(kwargs['users'])
+        server = None
+        try:
+            with override_settings(CHANNEL_LAYERS=layers):
+                sse = kwargs['transport'] == 'sse'
+                if kwargs['server'] == 'uvicorn':
+                    server = self._start_uvicorn(kwargs['port'], kwargs['redis_url'])
+                    url = f"ws://127.0.0.1:{kwargs['port']}/ws/"
+                    pid = server.pid
+
+                    def make_socket(cookie):
+                        return UvicornEventStream(kwargs['port'], cookie) if sse else UvicornSocket(url, cookie)
+                else:
+                    from asgi import application
+                    pid = os.getpid()
+
+                    def make_socket(cookie):
+                        return InProcessEventStream(application, cookie) if sse else InProcessSocket(application, cookie)
+
+                report = async_to_sync(self._run)(make_socket, users, sessions, pid, kwargs)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+            for session in sessions:
+                session.delete()
+            get_user_model().objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        report.update({
+            'server': kwargs['server'],
+            'transport': kwargs['transport'],
+            'layer': layers['default']['BACKEND'],
+            'users': kwargs['users'],
+            'target_rate': kwargs['rate'],
+            'duration': kwargs['duration'],
+        })
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+    def _make_users(self, count):
+        """Creates users that can't log in, plus a logged in session for each."""
+        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+        users, sessions = [], []
+        for i in range(count):
+            user = get_user_model().objects.create_user(email=f'loadtest-{time.time_ns()}-{i}@{EMAIL_DOMAIN}')
+            session = SessionStore()
+            session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+            session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.save()
+            users.append(user)
+            sessions.append(session)
+        return users, sessions
+
+    def _start_uvicorn(self, port, redis_url):
+        server = subprocess.Popen(
+            [sys.executable, 'manage.py', 'serve', '--port', str(port), '--log-level', 'warning'],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'REDIS_URL': redis_url},
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f"uvicorn exited with {server.returncode}")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server
+            except OSError:
+                time.sleep(0.1)
+        server.terminate()
+        raise CommandError("uvicorn didn't start listening within 30 seconds")
+
+    async def _run(self, make_socket, users, sessions, pid, options):
+        cookies = [f"{settings.SESSION_COOKIE_NAME}={session.session_key}" for session in sessions]
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        connect_times = []
+
+        async def connect(i):
+            sock = make_socket(cookies[i % len(cookies)])
+            async with semaphore:
+                started = time.perf_counter()
+                connected = await sock.connect()
+                connect_times.append(time.perf_counter() - started)
+            return sock if connected else None
+
+        rss_before = _rss(pid)
+        sockets = [sock for sock in await asyncio.gather(*[connect(i) for i in range(options['sockets'])]) if sock]
+        rss_after = _rss(pid)
+
+        latencies = []
+        readers = [asyncio.ensure_future(_read(sock, latencies)) for sock in sockets]
+
+        loop = asyncio.get_running_loop()
+        user_ids = [user.pk for user in users]
+        total = max(1, int(options['rate'] * options['duration']))
+        started = loop.time()
+        for broadcast in range(total):
+            # Keep to the schedule even if a send was slow
+            await asyncio.sleep(max(0, started + broadcast / options['rate'] - loop.time()))
+            await send_to_users(user_ids, {"sent_at": time.time()}, commit=COMMIT)
+
+        # Give the last updates a moment to arrive
+        expected = total * len(sockets)
+        deadline = loop.time() + 5
+        while len(latencies) < expected and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = loop.time() - started
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        await asyncio.gather(*[sock.close() for sock in sockets], return_exceptions=True)
+
+        memory_per_socket = None
+        if sockets and rss_before is not None and rss_after is not None:
+            memory_per_socket = round((rss_after - rss_before) / len(sockets), 2)
+
+        return {
+            'sockets': options['sockets'],
+            'connected': len(sockets),
+            'broadcasts': total,
+            'connect_latency_ms': _percentiles(connect_times),
+            'fanout_latency_ms': _percentiles(latencies),
+            'messages_expected': expected,
+            'messages_received': len(latencies),
+            'messages_per_second': round(len(latencies) / elapsed, 2),
+            'memory_per_socket_kb': memory_per_socket,
+        }
+
+
+async def _read(sock, latencies):
+    """Records how long each load test update took to arrive, until cancelled or closed."""
+    try:
+        while True:
+            text = await sock.recv()
+            received_at = time.time()
+            frame = json.loads(text)
+            for update in frame['updates'] if frame.get('type') == 'batch' else [frame]:
+                if update.get('commit') == COMMIT:
+                    latencies.append(received_at - update['data']['sent_at'])
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # The server closed the socket, i.e. its send queue overflowed
+        pass
+
+
+def _percentiles(seconds):
+    if not seconds:
+        return None
+    values = sorted(seconds)
+    return {
+        f'p{p}': round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 3)
+        for p in (50, 95, 99)
+    }
+
+
+def _rss(pid):
+    """Resident memory of `pid` in KB, or None where /proc isn't available."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
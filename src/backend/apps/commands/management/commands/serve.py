@@ -0,0 +1,40 @@
+import uvicorn
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from realtime.compression import RealtimeWebSocketProtocol
+from realtime.conf import realtime_setting
+
+
+class Command(BaseCommand):
+    """Same as `uvicorn asgi:application`, but with our websocket protocol.
+
+    uvicorn's command line can only pick one of its own websocket protocols,
+    this runs it with realtime.compression.RealtimeWebSocketProtocol so the
+    REALTIME compression settings apply. Frames far over
+    REALTIME['MAX_FRAME_SIZE'] are refused by uvicorn itself, before they're
+    even read in full.
+    """
+    help = "Serve asgi.application with uvicorn"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--workers', type=int, help="Worker processes, defaults to $WEB_CONCURRENCY or 1")
+        parser.add_argument('--reload', action='store_true', help="Restart when code changes")
+        parser.add_argument('--log-level', default='info', choices=['critical', 'error', 'warning', 'info', 'debug'])
+
+    def handle(self, *args, **kwargs):
+        uvicorn.run(
+            'asgi:application',
+            host=kwargs['host'],
+            port=kwargs['port'],
+            workers=kwargs['workers'],
+            reload=kwargs['reload'],
+            reload_dirs=[settings.BASE_DIR] if kwargs['reload'] else None,
+            log_level=kwargs['log_level'],
+            ws=RealtimeWebSocketProtocol,
+            # Bytes here, the consumer counts characters, so UTF-8 text gets some slack
+            ws_max_size=realtime_setting('MAX_FRAME_SIZE') * 4,
+        )
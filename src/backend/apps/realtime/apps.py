@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class RealtimeConfig(AppConfig):
+    name = 'realtime'
+
+    def ready(self):
+        # Connects the auth cache's invalidation receivers
+        from realtime import auth  # noqa: F401
@@ -0,0 +1,121 @@
+from channels.auth import AuthMiddleware, _get_user_session_key
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, load_backend, user_logged_out
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+
+from realtime.conf import realtime_setting
+from utils import metrics
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """AuthMiddleware that remembers who each session belongs to for a little while.
+
+    Normally every websocket connect reads the session and then the user from
+    Postgres. After a deploy every open socket reconnects at once, so with
+    REALTIME['AUTH_CACHE_TTL'] set we keep both in REALTIME['AUTH_CACHE'] for
+    that many seconds instead.
+
+    Cached sessions are forgotten on logout and cached users whenever they're
+    saved, so password and is_active changes apply right away. Hits and
+    misses are counted under 'realtime.auth_cache', see get_hit_ratio.
+    """
+
+    async def resolve_scope(self, scope):
+        if realtime_setting('AUTH_CACHE_TTL'):
+            scope["user"]._wrapped = await database_sync_to_async(resolve_user)(scope["session"])
+        else:
+            await super().resolve_scope(scope)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+def resolve_user(session):
+    """Same as channels.auth.get_user, but through the cache."""
+    if not session.session_key:
+        return AnonymousUser()
+
+    cache = caches[realtime_setting('AUTH_CACHE')]
+    ttl = realtime_setting('AUTH_CACHE_TTL')
+
+    session_key = _session_cache_key(session.session_key)
+    cached_session = cache.get(session_key)
+    _count(cached_session)
+    if cached_session is None:
+        try:
+            cached_session = (
+                _get_user_session_key(session),
+                session[BACKEND_SESSION_KEY],
+                session.get(HASH_SESSION_KEY),
+            )
+        except KeyError:
+            return AnonymousUser()
+        cache.set(session_key, cached_session, ttl)
+    user_id, backend_path, session_hash = cached_session
+
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+
+    user_key = _user_cache_key(user_id)
+    user = cache.get(user_key)
+    _count(user)
+    if user is None:
+        user = load_backend(backend_path).get_user(user_id)
+        if user is None:
+            return AnonymousUser()
+        cache.set(user_key, user, ttl)
+
+    # Verify the session, same as django.contrib.auth.get_user
+    if hasattr(user, 'get_session_auth_hash'):
+        if not (session_hash and constant_time_compare(session_hash, user.get_session_auth_hash())):
+            cache.delete(session_key)
+            return AnonymousUser()
+    return user
+
+
+def get_hit_ratio():
+    """Share of cached auth lookups that didn't need the database, None before any."""
+    hits = metrics.get_count('realtime.auth_cache.hit')
+    total = hits + metrics.get_count('realtime.auth_cache.miss')
+    return hits / total if total else None
+
+
+def _count(cached):
+    metrics.increment('realtime.auth_cache.miss' if cached is None else 'realtime.auth_cache.hit')
+
+
+def _session_cache_key(session_key):
+    return f"realtime_auth:session:{session_key}"
+
+
+def _user_cache_key(user_id):
+    return f"realtime_auth:user:{user_id}"
+
+
+# ----------------------------------------------------------------------------
+# Invalidation, connected in RealtimeConfig.ready. Queryset .update()s skip
+# the signals and call forget_users themselves.
+# ----------------------------------------------------------------------------
+@receiver(user_logged_out)
+def forget_session(sender, request, **kwargs):
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if session_key:
+        caches[realtime_setting('AUTH_CACHE')].delete(_session_cache_key(session_key))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_user(sender, instance, **kwargs):
+    forget_users([instance.pk])
+
+
+def forget_users(user_ids):
+    """Drops the cached users, for changes made without signals."""
+    caches[realtime_setting('AUTH_CACHE')].delete_many([_user_cache_key(user_id) for user_id in user_ids])
@@ -0,0 +1,75 @@
+"""permessage-deflate for realtime sockets, skipping frames too small to be worth it.
+
+uvicorn always offers permessage-deflate and compresses every frame, even a
+20 byte ping. Serving with `./manage.py serve` swaps in
+RealtimeWebSocketProtocol, which follows REALTIME['COMPRESSION'] and sends
+frames under REALTIME['COMPRESSION_THRESHOLD'] bytes uncompressed. That's
+allowed per message (RFC 7692 section 6), browsers handle it on their own.
+
+See `./manage.py benchmark_compression` for picking a threshold.
+"""
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import OP_BINARY, OP_TEXT
+
+from realtime.conf import realtime_setting
+
+
+# Smaller compression window and memory level than zlib's defaults, so each
+# socket's compressor takes ~32 KB instead of ~256 KB, for a little less
+# compression on big frames
+MAX_WINDOW_BITS = 12
+COMPRESS_SETTINGS = {'memLevel': 5}
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+
+    def __init__(self, *args, threshold=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def encode(self, frame):
+        # Leaving a message alone just means not setting its rsv1 bit, and
+        # not touching the compressor keeps its context valid for the next one
+        if frame.opcode in (OP_TEXT, OP_BINARY) and frame.fin and len(frame.data) < self.threshold:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdServerPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, threshold=0, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            threshold=self.threshold,
+        )
+
+
+def get_extension_factories():
+    """Returns the websocket extensions to offer clients, following the REALTIME settings."""
+    if not realtime_setting('COMPRESSION'):
+        return []
+    return [
+        ThresholdServerPerMessageDeflateFactory(
+            threshold=realtime_setting('COMPRESSION_THRESHOLD'),
+            server_max_window_bits=MAX_WINDOW_BITS,
+            compress_settings=COMPRESS_SETTINGS,
+        ),
+    ]
+
+
+class RealtimeWebSocketProtocol(WebSocketProtocol):
+    """uvicorn's websockets protocol, with our compression settings."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = get_extension_factories()
@@ -0,0 +1,44 @@
+from django.conf import settings
+
+
+DEFAULTS = {
+    'COALESCE_WINDOW': None,
+    'COALESCE_MODE': 'latest',
+    'SEND_QUEUE_SIZE': 100,
+    'SEND_QUEUE_POLICY': 'drop_oldest',
+    'SEND_QUEUE_CLOSE_CODE': 4008,
+    'REPLAY_BUFFER_SIZE': None,
+    'REPLAY_BUFFER_TTL': 60,
+    'REPLAY_CACHE': 'default',
+    'RPC_MAX_CONCURRENCY': 4,
+    'RPC_MAX_PENDING': 32,
+    'RPC_MAX_BATCH_SIZE': 20,
+    'MULTIPLEX': True,
+    'MAX_TOPICS': 20,
+    'PUBLISHER_FLUSH_INTERVAL': 0.01,
+    'PUBLISHER_MAX_BATCH_SIZE': 500,
+    'AUTH_CACHE_TTL': None,
+    'AUTH_CACHE': 'default',
+    'HEARTBEAT_INTERVAL': 30,
+    'IDLE_TIMEOUT': 75,
+    'MAX_LIFETIME': None,
+    'MAX_LIFETIME_JITTER': 0.1,
+    'REAP_CLOSE_CODE': 4009,
+    'LEAN_CONNECTIONS': False,
+    'COMPRESSION': True,
+    'COMPRESSION_THRESHOLD': 256,
+    'DELTA_TTL': 60 * 60,
+    'DELTA_CACHE': 'default',
+    'MAX_FRAME_SIZE': 64 * 1024,
+    'RECEIVE_RATE': 10,
+    'RECEIVE_BURST': 50,
+    'RECEIVE_BYTE_RATE': 64 * 1024,
+    'RECEIVE_BYTE_BURST': 256 * 1024,
+    'RECEIVE_LIMIT_POLICY': 'drop',
+    'RECEIVE_LIMIT_CLOSE_CODE': 4029,
+}
+
+
+def realtime_setting(name):
+    """Looks up `name` in settings.REALTIME, falling back to our defaults."""
+    return getattr(settings, 'REALTIME', {}).get(name, DEFAULTS[name])
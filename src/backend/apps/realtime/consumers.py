@@ -1,32 +1,209 @@
+import asyncio
 import json
+import logging
+import random
 
+from asgiref.sync import sync_to_async
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.contrib.auth import get_user_model
 from json import JSONDecodeError
+from urllib.parse import parse_qs
 
-from realtime.helpers import make_realtime_room_key
+from realtime import rpc, topics
+from realtime.conf import realtime_setting
+from realtime.deltas import get_delta_store
+from realtime.helpers import (
+    encode_batch,
+    encode_event_stream,
+    encode_update,
+    make_realtime_room_key,
+    make_realtime_topic_key,
+)
+from realtime.hub import get_hub
+from realtime.limits import DISCONNECT, TokenBucket
+from realtime.queues import SendQueue
+from realtime.replay import get_replay_buffer
+from utils import metrics
 
 
-class RealtimeConsumer(AsyncJsonWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+# All that's left of the scope of a lean connection once it's connected
+LEAN_SCOPE_KEYS = ('type', 'path')
+
+
+def make_bucket(rate_setting, burst_setting):
+    rate = realtime_setting(rate_setting)
+    return TokenBucket(rate, realtime_setting(burst_setting)) if rate else None
+
+
+def rpc_error(call_id, message, code=400):
+    return {"type": "rpc", "id": call_id, "error": {"message": message, "code": code}}
+
+
+class RealtimeGroupsMixin:
+    """Joins and leaves channel layer groups, through the hub when REALTIME['MULTIPLEX'] is on."""
+
+    # Updates arriving while a replay is still being read, see replay_room
+    held_events = None
+
+    async def join_group(self, key):
+        if realtime_setting('MULTIPLEX'):
+            await get_hub(self.channel_layer).join(key, self)
+        else:
+            await self.channel_layer.group_add(key, self.channel_name)
+
+    async def leave_group(self, key):
+        if realtime_setting('MULTIPLEX'):
+            await get_hub(self.channel_layer).leave(key, self)
+        else:
+            await self.channel_layer.group_discard(key, self.channel_name)
+
+    async def replay_room(self, resume):
+        """Joins the room and replays what was missed since `resume`.
+
+        Joining first means nothing sent in between is lost, anything live
+        that was also replayed is skipped by its seq. The hub hands sockets
+        updates while they're still connecting though, so those are held
+        until the replay is out, or they'd overtake it.
+        """
+        self.held_events = []
+        try:
+            await self.join_group(self.room_key)
+            await self.replay_missed(resume)
+        finally:
+            held, self.held_events = self.held_events, None
+        for event in held:
+            await self.update(event)
+
+    def hold_event(self, event):
+        """Returns whether `event` has to wait for the replay to finish."""
+        if self.held_events is None:
+            return False
+        self.held_events.append(event)
+        return True
+
+
+class RealtimeConsumer(RealtimeGroupsMixin, AsyncJsonWebsocketConsumer):
     """This consumer helps hand off commits to Vue frontend.
 
     Example:
-        from asgiref.sync import async_to_sync
-        from channels.layers import get_channel_layer
         from realtime.helpers import make_realtime_room_key
-
-        channel_layer = get_channel_layer()
+        from realtime.publisher import get_publisher
 
         # TODO dont do this if generate results has not been clicked
-        async_to_sync(channel_layer.group_send)(
+        get_publisher().publish(
             make_realtime_room_key(user),
-            {
-                "type": "update",
-                "data": some_dictionary_of_data_for_frontend,
-                "commit": 'activities/update',
-            }
+            some_dictionary_of_data_for_frontend,
+            commit='activities/update',
         )
+
+    From async code await realtime.helpers.publish_update instead.
+
+    Plain `channel_layer.group_send` events with "data" still work, but they
+    get re-encoded by every socket in the group.
+
+    When REALTIME['COALESCE_WINDOW'] is set, updates are held for that many
+    seconds after the first one arrives, then sent together. Depending on
+    REALTIME['COALESCE_MODE'] only the latest update per commit is sent
+    ("latest"), or all of them go out in one "batch" frame ("batch").
+
+    Updates don't go straight down the socket, they wait in a bounded
+    SendQueue that a writer task drains. A slow client fills its own queue
+    (REALTIME['SEND_QUEUE_SIZE']) instead of the worker's memory, and
+    REALTIME['SEND_QUEUE_POLICY'] decides what to do once it's full.
+
+    With REALTIME['REPLAY_BUFFER_SIZE'] set, updates carry a "seq" number.
+    Reconnecting to "ws/?resume=<last seq seen>" replays what was missed, or
+    sends {"type": "resync"} when that's no longer possible and the client
+    needs to refetch its state.
+
+    Clients can also call registered realtime.rpc handlers over the socket:
+
+        {"type": "rpc", "id": 1, "method": "users.me", "params": {}}
+
+    which answers with {"type": "rpc", "id": 1, "result": ...} (or "error").
+    Several calls can go in one frame as {"type": "rpc", "calls": [...]} and
+    come back together as {"type": "rpc", "results": [...]}.
+
+    With REALTIME['MULTIPLEX'] on, sockets join their room through this
+    process' RealtimeHub instead of each joining the group themselves.
+
+    Sockets can also follow registered realtime.topics, which backend code
+    sends to with realtime.helpers.publish_to_topic:
+
+        {"type": "subscribe", "topic": "announcements"}
+
+    is answered with {"type": "subscribed", "topic": "announcements"}, and
+    "unsubscribe" works the same way. A socket can follow at most
+    REALTIME['MAX_TOPICS'] topics.
+
+    Every REALTIME['HEARTBEAT_INTERVAL'] seconds the server sends
+    {"type": "ping"}, which clients answer with {"type": "pong"}. Sockets we
+    haven't heard anything from in REALTIME['IDLE_TIMEOUT'] seconds (i.e.
+    half-open mobile connections), and ones open longer than
+    REALTIME['MAX_LIFETIME'] give or take REALTIME['MAX_LIFETIME_JITTER'],
+    are reaped: they leave their groups straight away, then get closed with
+    REALTIME['REAP_CLOSE_CODE']. Reaped sockets are counted in
+    utils.metrics under 'realtime.reaped.idle' and 'realtime.reaped.lifetime'.
+
+    Updates published with `delta=True` carry a "version", and may come as
+    {"type": "patch"} frames against an earlier version (see realtime.deltas).
+    Clients that don't have the patch's "base" version ask for the latest
+    document with
+
+        {"type": "snapshot", "commit": "things/update"}
+
+    and get it as a regular update frame.
+
+    Frames from the client are limited before they're parsed: ones over
+    REALTIME['MAX_FRAME_SIZE'] are refused with status 413, and ones past the
+    RECEIVE_RATE / RECEIVE_BYTE_RATE token buckets with status 429 (only the
+    first of a run of refused frames gets an answer). With REALTIME['RECEIVE_LIMIT_POLICY'] set
+    to "disconnect" the socket is closed instead. Both are counted in
+    utils.metrics, under 'realtime.receive.rejected' and
+    'realtime.receive.throttled'.
+
+    With REALTIME['LEAN_CONNECTIONS'] on, connected sockets only keep their
+    room key: the scope is emptied (see slim_scope) and, when multiplexing,
+    they don't get a channel of their own either.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.coalesce_window = realtime_setting('COALESCE_WINDOW')
+        self.coalesce_mode = realtime_setting('COALESCE_MODE')
+        self.pending_updates = []
+        self.flush_task = None
+        # The queue, writer and semaphore are only made once they're needed,
+        # most sockets sit idle most of the time
+        self.send_queue = None
+        self.writer_task = None
+        self.replayed_seq = 0
+        self.rpc_semaphore = None
+        self.rpc_tasks = set()
+        self.user_pk = None
+        self.room_key = None
+        self.topics = set()
+        self.heartbeat_task = None
+        self.last_seen = None
+        # Made on the first frame, most sockets only ever send pongs
+        self.frame_bucket = None
+        self.byte_bucket = None
+        self.refusing = False
+
+    @property
+    def channel_layer_alias(self):
+        # Multiplexed sockets get everything through the hub, so lean ones skip
+        # having a channel of their own (and the receive waiting on it)
+        if realtime_setting('LEAN_CONNECTIONS') and realtime_setting('MULTIPLEX'):
+            return None
+        return DEFAULT_CHANNEL_LAYER
+
     async def connect(self):
         if self.scope["user"].is_anonymous:
             # Reject the connection
@@ -34,40 +211,505 @@ class RealtimeConsumer(AsyncJsonWebsocketConsumer):
             return
 
         await self.accept()
+        self.last_seen = asyncio.get_running_loop().time()
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
 
         # We make a "group" where the "key" of the group is made from
         # make_realtime_room_key. This is the "channel layer" NOT the
         # "web socket" layer. When messages are sent to groups they're
         # handled by consumer methods.
-        await self.channel_layer.group_add(
-            make_realtime_room_key(self.scope['user']),
-            self.channel_name
-        )
+        self.user_pk = self.scope['user'].pk
+        self.room_key = make_realtime_room_key(self.scope['user'])
+        resume = parse_qs(self.scope.get('query_string', b'').decode()).get('resume')
+        if resume:
+            await self.replay_room(resume[0])
+        else:
+            await self.join_group(self.room_key)
 
-    async def disconnect(self):
-        await self.channel_layer.group_discard(
-            make_realtime_room_key(self.scope['user']),
-            self.channel_name
-        )
+        if realtime_setting('LEAN_CONNECTIONS'):
+            self.slim_scope()
+
+    def slim_scope(self):
+        """Drops the user, session, headers etc. from the scope, updates only need the room key.
+
+        The scope dict is shared with the auth middleware, so emptying it
+        frees the user for good. RPC calls and subscribes fetch the user
+        again when they need it, see get_user.
+        """
+        for key in [key for key in self.scope if key not in LEAN_SCOPE_KEYS]:
+            del self.scope[key]
+
+    async def get_user(self):
+        """Returns the socket's user, or closes the socket and returns None if it's gone."""
+        if 'user' in self.scope:
+            return self.scope['user']
+
+        user = await database_sync_to_async(
+            get_user_model().objects.filter(pk=self.user_pk, is_active=True).first
+        )()
+        if user is None:
+            await self.close()
+        return user
+
+    async def disconnect(self, code):
+        self.stop_tasks()
+        await self.leave_groups()
+
+    def stop_tasks(self):
+        current = asyncio.current_task()
+        for task in [self.flush_task, self.writer_task, self.heartbeat_task, *self.rpc_tasks]:
+            if task and task is not current:
+                task.cancel()
+
+    async def leave_groups(self):
+        if self.room_key:
+            await self.leave_group(self.room_key)
+            self.room_key = None
+        for topic in self.topics:
+            await self.leave_group(make_realtime_topic_key(topic))
+        self.topics = set()
 
     async def receive(self, text_data=None, bytes_data=None, **kwargs):
         """Wrapping the original receive to give back the user some kind of error."""
+        self.last_seen = asyncio.get_running_loop().time()
+        if not await self.check_limits(text_data if text_data is not None else bytes_data):
+            return
         try:
             await super().receive(text_data, bytes_data, **kwargs)
         except JSONDecodeError:
             await self.send_json({"message": "ERROR: Last message was not valid JSON!", "status": 400})
 
     async def receive_json(self, content, **kwargs):
-        # TODO: We can handle realtime commands here, if we want?!
-        pass
+        if isinstance(content, dict) and content.get('type') == 'rpc':
+            if len(self.rpc_tasks) >= realtime_setting('RPC_MAX_PENDING'):
+                await self.send_json(rpc_error(content.get('id'), "Too many pending calls", 429))
+                return
+
+            # Run calls in the background so updates keep flowing meanwhile
+            task = asyncio.ensure_future(self.handle_rpc(content))
+            self.rpc_tasks.add(task)
+            task.add_done_callback(self.rpc_tasks.discard)
+        elif isinstance(content, dict) and content.get('type') == 'subscribe':
+            await self.subscribe(content.get('topic'))
+        elif isinstance(content, dict) and content.get('type') == 'unsubscribe':
+            await self.unsubscribe(content.get('topic'))
+        elif isinstance(content, dict) and content.get('type') == 'snapshot':
+            await self.send_snapshot(content.get('commit'))
+
+    # ------------------------------------------------------------------------
+    # Inbound limits
+    # ------------------------------------------------------------------------
+    async def check_limits(self, data):
+        """Returns whether a frame from the client may be parsed and handled."""
+        size = len(data or '')
+        if size > realtime_setting('MAX_FRAME_SIZE'):
+            metrics.increment('realtime.receive.rejected')
+            await self.refuse(1009, {"message": "ERROR: Message too big!", "status": 413})
+            return False
+
+        if self.frame_bucket is None:
+            self.frame_bucket = make_bucket('RECEIVE_RATE', 'RECEIVE_BURST')
+            self.byte_bucket = make_bucket('RECEIVE_BYTE_RATE', 'RECEIVE_BYTE_BURST')
+        buckets = [(bucket, amount) for bucket, amount in [(self.frame_bucket, 1), (self.byte_bucket, size)] if bucket]
+        if not all(bucket.has(amount) for bucket, amount in buckets):
+            metrics.increment('realtime.receive.throttled')
+            await self.refuse(
+                realtime_setting('RECEIVE_LIMIT_CLOSE_CODE'),
+                {"message": "ERROR: Too many messages, slow down!", "status": 429},
+            )
+            return False
+
+        for bucket, amount in buckets:
+            bucket.take(amount)
+        self.refusing = False
+        return True
+
+    async def refuse(self, code, error):
+        """Tells the client `error`, or closes the socket with `code` under the "disconnect" policy.
+
+        Only the first of several frames refused in a row gets an answer,
+        refusing a flood shouldn't mean replying to all of it.
+        """
+        if self.refusing:
+            return
+        self.refusing = True
+        if realtime_setting('RECEIVE_LIMIT_POLICY') == DISCONNECT:
+            self.stop_tasks()
+            await self.leave_groups()
+            await self.close(code=code)
+        else:
+            await self.send_json(error)
+
+    # ------------------------------------------------------------------------
+    # Heartbeat
+    # ------------------------------------------------------------------------
+    async def heartbeat(self):
+        """Pings the client now and then, and reaps the socket once it's idle or too old."""
+        loop = asyncio.get_running_loop()
+        interval = realtime_setting('HEARTBEAT_INTERVAL')
+        idle_timeout = realtime_setting('IDLE_TIMEOUT')
+        max_lifetime = realtime_setting('MAX_LIFETIME')
+
+        expires_at = None
+        if max_lifetime:
+            # Spread sockets from the same deploy out, so they don't all reconnect at once
+            jitter = max_lifetime * realtime_setting('MAX_LIFETIME_JITTER')
+            expires_at = loop.time() + max_lifetime + random.uniform(-jitter, jitter)
+        next_ping = loop.time() + interval if interval else None
+
+        while True:
+            deadlines = [t for t in [next_ping, expires_at] if t is not None]
+            if idle_timeout:
+                deadlines.append(self.last_seen + idle_timeout)
+            if not deadlines:
+                return
+            await asyncio.sleep(max(0, min(deadlines) - loop.time()))
+
+            now = loop.time()
+            if expires_at is not None and now >= expires_at:
+                await self.reap('lifetime')
+                return
+            if idle_timeout and now - self.last_seen >= idle_timeout:
+                await self.reap('idle')
+                return
+            if next_ping is not None and now >= next_ping:
+                # Queued rather than sent, a half-open socket would never let
+                # this task get back to reaping it
+                await self.queue_frame(None, json.dumps({"type": "ping"}))
+                next_ping = now + interval
+
+    async def reap(self, reason):
+        """Leaves all groups right away, rather than whenever the disconnect comes through."""
+        metrics.increment(f'realtime.reaped.{reason}')
+        self.stop_tasks()
+        await self.leave_groups()
+        await self.close(code=realtime_setting('REAP_CLOSE_CODE'))
+
+    # ------------------------------------------------------------------------
+    # Topics
+    # ------------------------------------------------------------------------
+    async def subscribe(self, topic):
+        if not isinstance(topic, str):
+            await self.send_json({"message": "ERROR: topic must be a string!", "status": 400})
+            return
+
+        if topic not in self.topics:
+            if len(self.topics) >= realtime_setting('MAX_TOPICS'):
+                await self.send_json({"message": "ERROR: Subscribed to too many topics!", "status": 429})
+                return
+            user = await self.get_user()
+            if user is None:
+                return
+            if not await database_sync_to_async(topics.can_subscribe)(user, topic):
+                await self.send_json({"message": f"ERROR: Can't subscribe to {topic}!", "status": 403})
+                return
+            self.topics.add(topic)
+            await self.join_group(make_realtime_topic_key(topic))
+        await self.send_json({"type": "subscribed", "topic": topic})
+
+    async def unsubscribe(self, topic):
+        if isinstance(topic, str) and topic in self.topics:
+            self.topics.discard(topic)
+            await self.leave_group(make_realtime_topic_key(topic))
+        await self.send_json({"type": "unsubscribed", "topic": topic})
+
+    # ------------------------------------------------------------------------
+    # RPC
+    # ------------------------------------------------------------------------
+    async def handle_rpc(self, content):
+        user = await self.get_user()
+        if user is None:
+            return
+        if self.rpc_semaphore is None:
+            self.rpc_semaphore = asyncio.Semaphore(realtime_setting('RPC_MAX_CONCURRENCY'))
+
+        if 'calls' not in content:
+            await self.send_json({"type": "rpc", **await self.run_rpc_call(user, content)})
+            return
+
+        calls = content['calls']
+        if not isinstance(calls, list) or len(calls) > realtime_setting('RPC_MAX_BATCH_SIZE'):
+            await self.send_json(rpc_error(None, f"calls must be a list of at most {realtime_setting('RPC_MAX_BATCH_SIZE')} calls"))
+            return
+
+        results = await asyncio.gather(*[self.run_rpc_call(user, call) for call in calls])
+        await self.send_json({"type": "rpc", "results": results})
+
+    async def run_rpc_call(self, user, call):
+        """Returns the response for one call, with its "result" or "error"."""
+        if not isinstance(call, dict):
+            return {"id": None, "error": {"message": "Each call must be an object", "code": 400}}
+
+        response = {"id": call.get('id')}
+        try:
+            async with self.rpc_semaphore:
+                response["result"] = await rpc.call(user, call.get('method'), call.get('params', {}))
+        except rpc.RpcError as e:
+            response["error"] = {"message": e.message, "code": e.code}
+        except Exception:
+            logger.exception(f"Realtime RPC call to {call.get('method')} failed")
+            response["error"] = {"message": "Internal error", "code": 500}
+        return response
 
     # ------------------------------------------------------------------------
     # Methods below are "Groups" channel layer event handlers
     # ------------------------------------------------------------------------
     async def update(self, event):
         """Called from channel_layer.group_send's"""
-        await self.send(json.dumps({
-            "type": "update",
-            "data": event['data'],
-            "commit": event.get('commit')
-        }))
+        if self.hold_event(event):
+            return
+        if event.get('seq', self.replayed_seq + 1) <= self.replayed_seq:
+            # Already sent this one while replaying
+            return
+
+        text = event.get('text')
+        if text is None:
+            # Event wasn't made with publish_update, so encode it ourselves
+            text = encode_update(event['data'], event.get('commit'))
+
+        if not self.coalesce_window:
+            await self.queue_frame(event.get('commit'), text)
+            return
+
+        if self.coalesce_mode == 'latest' and event.get('commit') is not None:
+            # Only the newest update for a commit matters, drop the older one.
+            # Like SendQueue, frames without a commit (i.e. patches) all go out
+            self.pending_updates = [
+                (commit, pending) for commit, pending in self.pending_updates
+                if commit != event.get('commit')
+            ]
+        self.pending_updates.append((event.get('commit'), text))
+
+        if not self.flush_task:
+            self.flush_task = asyncio.ensure_future(self.flush_updates_later())
+
+    # ------------------------------------------------------------------------
+    # Replays
+    # ------------------------------------------------------------------------
+    async def replay_missed(self, resume):
+        replay_buffer = get_replay_buffer()
+        frames = None
+        if replay_buffer and resume.isdigit():
+            frames = await sync_to_async(replay_buffer.since)(self.room_key, int(resume))
+
+        if frames is None or len(frames) > realtime_setting('SEND_QUEUE_SIZE'):
+            # The send queue would drop some of a replay that big
+            await self.queue_frame(None, json.dumps({"type": "resync"}))
+            return
+
+        for text in frames:
+            await self.queue_frame(None, text)
+        self.replayed_seq = int(resume) + len(frames)
+
+    # ------------------------------------------------------------------------
+    # Deltas
+    # ------------------------------------------------------------------------
+    async def send_snapshot(self, commit):
+        """Sends the latest document for `commit`, for clients that can't apply a patch."""
+        latest = None
+        if isinstance(commit, str):
+            latest = await sync_to_async(get_delta_store().latest)(self.room_key, commit)
+        if latest is None:
+            await self.send_json({"message": f"ERROR: No snapshot for {commit}!", "status": 404})
+            return
+
+        version, data = latest
+        # Queued behind any updates already waiting, so it can't overtake them
+        await self.queue_frame(None, encode_update(data, commit, version=version))
+
+    # ------------------------------------------------------------------------
+    # Outgoing frames
+    # ------------------------------------------------------------------------
+    async def queue_frame(self, commit, text):
+        if self.send_queue is None:
+            self.send_queue = SendQueue(realtime_setting('SEND_QUEUE_SIZE'), realtime_setting('SEND_QUEUE_POLICY'))
+        if not self.send_queue.put(commit, text):
+            # Too far behind to catch up, let them reconnect and refetch
+            await self.close(realtime_setting('SEND_QUEUE_CLOSE_CODE'))
+            return
+
+        if self.writer_task is None:
+            self.writer_task = asyncio.ensure_future(self.write_frames())
+
+    async def write_frames(self):
+        """Sends queued frames until there are none left, the next queue_frame starts it again."""
+        try:
+            text = self.send_queue.pop()
+            while text is not None:
+                await self.send(text)
+                text = self.send_queue.pop()
+        finally:
+            self.writer_task = None
+
+    async def flush_updates_later(self):
+        await asyncio.sleep(self.coalesce_window)
+        self.flush_task = None
+        await self.flush_updates()
+
+    async def flush_updates(self):
+        """Sends everything held during the coalesce window."""
+        pending, self.pending_updates = self.pending_updates, []
+        texts = [text for _, text in pending]
+
+        if self.coalesce_mode == 'batch' and len(texts) > 1:
+            await self.queue_frame(None, encode_batch(texts))
+        else:
+            for commit, text in pending:
+                await self.queue_frame(commit, text)
+
+
+class RealtimeEventStreamConsumer(RealtimeGroupsMixin, AsyncHttpConsumer):
+    """Streams the user's updates as Server-Sent Events, for clients that only ever listen.
+
+        const events = new EventSource("/events/", { withCredentials: true })
+        events.onmessage = e => handle(JSON.parse(e.data))
+
+    Every event's data is the same frame RealtimeConsumer would send down a
+    websocket. With REALTIME['REPLAY_BUFFER_SIZE'] set, updates carry their
+    seq as the event id, so when the browser reconnects with Last-Event-ID
+    (or ?last_event_id=) it gets what it missed, or {"type": "resync"} when
+    that's no longer possible.
+
+    Events wait in a SendQueue like websocket frames do. A comment goes out
+    every REALTIME['HEARTBEAT_INTERVAL'] seconds so proxies keep the stream
+    open, and with REALTIME['MAX_LIFETIME'] set streams are ended after that
+    long, the browser reconnects by itself.
+
+    Clients can't send anything, so there are no RPC calls, topics or
+    snapshots. Updates sent with `delta=True` need the websocket.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_key = None
+        self.send_queue = None
+        self.writer_task = None
+        self.heartbeat_task = None
+        self.replayed_seq = 0
+        self.ended = False
+
+    async def http_request(self, message):
+        # Unlike AsyncHttpConsumer, keep going after handle() until the client goes away
+        if "body" in message:
+            self.body.append(message["body"])
+        if not message.get("more_body"):
+            await self.handle(b"".join(self.body))
+
+    async def handle(self, body):
+        if self.scope["user"].is_anonymous:
+            await self.send_response(403, b"", headers=[(b"Content-Type", b"text/plain")])
+            raise StopConsumer()
+
+        await self.send_headers(headers=[
+            (b"Content-Type", b"text/event-stream"),
+            (b"Cache-Control", b"no-cache"),
+            # Stops nginx from buffering the stream
+            (b"X-Accel-Buffering", b"no"),
+        ])
+        # Gets the headers out, the browser doesn't consider itself connected until then
+        await self.send_body(b"", more_body=True)
+
+        self.room_key = make_realtime_room_key(self.scope['user'])
+        last_event_id = self.get_last_event_id()
+        if last_event_id:
+            await self.replay_room(last_event_id)
+        else:
+            await self.join_group(self.room_key)
+
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+    def get_last_event_id(self):
+        for name, value in self.scope.get('headers', []):
+            if name.lower() == b'last-event-id':
+                return value.decode('latin1')
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return query.get('last_event_id', [None])[0]
+
+    async def disconnect(self):
+        self.stop_tasks()
+        if self.room_key:
+            await self.leave_group(self.room_key)
+            self.room_key = None
+
+    def stop_tasks(self):
+        current = asyncio.current_task()
+        for task in [self.writer_task, self.heartbeat_task]:
+            if task and task is not current:
+                task.cancel()
+
+    async def end_stream(self):
+        """Finishes the response, the client's disconnect then stops the consumer."""
+        if self.ended:
+            return
+        self.ended = True
+        self.stop_tasks()
+        await self.disconnect()
+        await self.send_body(b"")
+
+    async def heartbeat(self):
+        loop = asyncio.get_running_loop()
+        interval = realtime_setting('HEARTBEAT_INTERVAL')
+        max_lifetime = realtime_setting('MAX_LIFETIME')
+
+        expires_at = None
+        if max_lifetime:
+            jitter = max_lifetime * realtime_setting('MAX_LIFETIME_JITTER')
+            expires_at = loop.time() + max_lifetime + random.uniform(-jitter, jitter)
+
+        while True:
+            deadlines = [t for t in [loop.time() + interval if interval else None, expires_at] if t is not None]
+            if not deadlines:
+                return
+            await asyncio.sleep(max(0, min(deadlines) - loop.time()))
+            if expires_at is not None and loop.time() >= expires_at:
+                metrics.increment('realtime.reaped.lifetime')
+                await self.end_stream()
+                return
+            await self.queue_event(None, ": ping\n\n")
+
+    async def replay_missed(self, last_event_id):
+        replay_buffer = get_replay_buffer()
+        frames = None
+        if replay_buffer and last_event_id.isdigit():
+            frames = await sync_to_async(replay_buffer.since)(self.room_key, int(last_event_id))
+
+        if frames is None or len(frames) > realtime_setting('SEND_QUEUE_SIZE'):
+            await self.queue_event(None, encode_event_stream(json.dumps({"type": "resync"})))
+            return
+
+        for seq, text in enumerate(frames, start=int(last_event_id) + 1):
+            await self.queue_event(None, encode_event_stream(text, seq))
+        self.replayed_seq = int(last_event_id) + len(frames)
+
+    async def update(self, event):
+        """Called from channel_layer.group_send's, same as RealtimeConsumer.update."""
+        if self.hold_event(event):
+            return
+        if event.get('seq', self.replayed_seq + 1) <= self.replayed_seq:
+            return
+        text = event.get('text')
+        if text is None:
+            text = encode_update(event['data'], event.get('commit'))
+        await self.queue_event(event.get('commit'), encode_event_stream(text, event.get('seq')))
+
+    async def queue_event(self, commit, text):
+        if self.ended:
+            return
+        if self.send_queue is None:
+            self.send_queue = SendQueue(realtime_setting('SEND_QUEUE_SIZE'), realtime_setting('SEND_QUEUE_POLICY'))
+        if not self.send_queue.put(commit, text):
+            # Too far behind, it reconnects with its Last-Event-ID
+            await self.end_stream()
+            return
+
+        if self.writer_task is None:
+            self.writer_task = asyncio.ensure_future(self.write_events())
+
+    async def write_events(self):
+        try:
+            text = self.send_queue.pop()
+            while text is not None:
+                await self.send_body(text.encode(), more_body=True)
+                text = self.send_queue.pop()
+        finally:
+            self.writer_task = None
@@ -0,0 +1,123 @@
+from django.core.cache import caches
+
+from realtime.conf import realtime_setting
+
+
+class DeltaStore:
+    """Remembers the last document sent to each room per commit, to send the next one as a patch.
+
+    Every document gets the next version number for its room and commit.
+    When the RFC 6902 patch from the previous document is shorter than the
+    new document, sockets get
+
+        {"type": "patch", "patch": [...], "commit": ..., "base": 4, "version": 5}
+
+    otherwise the usual "update" frame with "version" added. Clients apply a
+    patch only when they have version "base", anything else (they missed
+    one, or just connected) is answered with a {"type": "snapshot"} request,
+    see RealtimeConsumer.
+
+    Like ReplayBuffer everything lives in a Django cache, which needs to be
+    shared between processes for deltas sent by one to be understood by
+    sockets on another.
+    """
+
+    def __init__(self, ttl, cache_alias='default'):
+        self.ttl = ttl
+        self.cache = caches[cache_alias]
+
+    def advance(self, room_key, commit, data):
+        """Stores `data` as the room's latest `commit`.
+
+        Returns its version, and the previous (version, document) or None.
+        """
+        return self.advance_many([room_key], commit, data)[room_key]
+
+    def advance_many(self, room_keys, commit, data):
+        """Stores `data` as the latest `commit` of every room in `room_keys`.
+
+        Returns a dict of room key -> (version, previous) like advance. Each
+        room costs an incr, the documents are read and written all at once.
+        """
+        keys = {room_key: self._document_key(room_key, commit) for room_key in room_keys}
+        versions = {room_key: self._next_version(key) for room_key, key in keys.items()}
+        stored = self.cache.get_many(list(keys.values()))
+
+        advanced = {}
+        documents = {}
+        for room_key, key in keys.items():
+            version, previous = versions[room_key], stored.get(key)
+            if previous is not None and previous[0] >= version:
+                # Another process stored a later document in the meantime,
+                # keep it and send this one whole
+                advanced[room_key] = (version, None)
+            else:
+                documents[key] = (version, data)
+                advanced[room_key] = (version, previous)
+        self.cache.set_many(documents, timeout=self.ttl)
+        return advanced
+
+    def latest(self, room_key, commit):
+        """Returns the room's latest (version, document) for `commit`, or None if it's gone."""
+        return self.cache.get(self._document_key(room_key, commit))
+
+    def _next_version(self, document_key):
+        # incr is atomic, so no two documents get the same version
+        key = f"{document_key}:version"
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # incr doesn't refresh the key's TTL, so it expires now and then.
+            # Carry on from the stored document, or start over without one
+            stored = self.cache.get(document_key)
+            self.cache.add(key, stored[0] if stored else 0, timeout=self.ttl)
+            return self.cache.incr(key)
+
+    def _document_key(self, room_key, commit):
+        return f"realtime_delta:{room_key}:{commit}"
+
+
+def get_delta_store():
+    return DeltaStore(realtime_setting('DELTA_TTL'), realtime_setting('DELTA_CACHE'))
+
+
+def make_patch(old, new, path=''):
+    """Returns RFC 6902 operations turning `old` into `new`.
+
+    Only uses "add", "remove" and "replace". Objects are compared key by
+    key and lists index by index, so inserting at the front of a list
+    replaces everything after it, which is fine for the state we send.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = []
+        for key in old:
+            if key not in new:
+                operations.append({"op": "remove", "path": _join(path, key)})
+        for key, value in new.items():
+            if key in old:
+                operations += make_patch(old[key], value, _join(path, key))
+            else:
+                operations.append({"op": "add", "path": _join(path, key), "value": value})
+        return operations
+
+    if isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        operations = []
+        common = min(len(old), len(new))
+        for index in range(common):
+            operations += make_patch(old[index], new[index], _join(path, index))
+        for index in range(common, len(new)):
+            operations.append({"op": "add", "path": _join(path, index), "value": new[index]})
+        # From the end, so earlier indexes stay put
+        for index in reversed(range(common, len(old))):
+            operations.append({"op": "remove", "path": _join(path, index)})
+        return operations
+
+    # Checking the type too, 1 == True but they aren't the same JSON
+    if type(old) is type(new) and old == new:
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _join(path, key):
+    # JSON pointer escaping, RFC 6901
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
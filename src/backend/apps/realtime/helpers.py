@@ -1,2 +1,191 @@
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+
+from realtime.deltas import get_delta_store, make_patch
+from realtime.replay import get_replay_buffer
+from utils import metrics
+
+
 def make_realtime_room_key(user):
-    return f"user_socket_{user.pk}"
+    return make_realtime_room_key_for_pk(user.pk)
+
+
+def make_realtime_room_key_for_pk(pk):
+    return f"user_socket_{pk}"
+
+
+def make_realtime_topic_key(name):
+    return f"topic_{name}"
+
+
+def encode_update(data, commit=None, version=None):
+    """Encodes the websocket frame for an update, this is what the browser receives."""
+    frame = {
+        "type": "update",
+        "data": data,
+        "commit": commit,
+    }
+    if version is not None:
+        frame["version"] = version
+    return json.dumps(frame)
+
+
+def encode_patch(patch, commit, base, version):
+    """Encodes the websocket frame for a delta update, see realtime.deltas."""
+    return json.dumps({
+        "type": "patch",
+        "patch": patch,
+        "commit": commit,
+        "base": base,
+        "version": version,
+    })
+
+
+def encode_batch(texts):
+    """Joins already encoded update frames into one "batch" frame, without decoding them."""
+    return '{"type": "batch", "updates": [' + ', '.join(texts) + ']}'
+
+
+def encode_event_stream(text, seq=None):
+    """Wraps an encoded frame as a Server-Sent Event, with `seq` as its id."""
+    event_id = f"id: {seq}\n" if seq is not None else ""
+    return f"{event_id}data: {text}\n\n"
+
+
+def make_update_event(data, commit=None, seq=None):
+    """Builds a channel layer "update" event with the frame already encoded.
+
+    Every consumer in the group forwards `text` as-is, so the payload is only
+    encoded once no matter how many sockets receive it.
+    """
+    event = {
+        "type": "update",
+        "commit": commit,
+        "text": encode_update(data, commit),
+    }
+    if seq is not None:
+        event = number_update_event(event, seq)
+    return event
+
+
+def make_delta_event(data, commit, version, previous):
+    """Builds the "update" event taking a room's `commit` to `data`, as a patch when that's shorter.
+
+    `version` and `previous` are what DeltaStore.advance returned for the room.
+    """
+    text = encode_update(data, commit, version=version)
+    if previous is not None:
+        base, document = previous
+        patch_text = encode_patch(make_patch(document, data), commit, base, version)
+        if len(patch_text) < len(text):
+            metrics.increment('realtime.deltas.patch')
+            # The commit is in the patch's text, the event has none so
+            # neither "latest" coalescing nor a coalescing SendQueue can
+            # drop a patch from the middle of a chain
+            return {"type": "update", "commit": None, "text": patch_text}
+
+    metrics.increment('realtime.deltas.full')
+    return {"type": "update", "commit": commit, "text": text}
+
+
+def number_update_event(event, seq):
+    """Returns a copy of an update event numbered `seq`, without encoding its data again."""
+    return {
+        **event,
+        "seq": seq,
+        "text": f'{event["text"][:-1]}, "seq": {seq}}}',
+    }
+
+
+async def publish_update(room_key, data, commit=None, channel_layer=None, delta=False):
+    """Sends an update to every socket in `room_key`, encoding it only once.
+
+    With `delta` the room remembers `data`, and the next delta update for
+    the same commit is sent as a JSON patch when that's smaller, see
+    realtime.deltas. Use it for big documents where little changes at a time.
+
+    Example:
+        await publish_update(
+            make_realtime_room_key(user),
+            some_dictionary_of_data_for_frontend,
+            commit='activities/update',
+        )
+
+    Sync code should use realtime.publisher.get_publisher().publish, which
+    batches instead of waiting on async_to_sync for every update.
+    """
+    channel_layer = channel_layer or get_channel_layer()
+    events = await _make_room_events([room_key], data, commit, delta)
+    await channel_layer.group_send(room_key, events[room_key])
+
+
+async def send_to_users(user_ids, data, commit=None, channel_layer=None, delta=False):
+    """Sends the same update to every user in `user_ids`.
+
+    Much cheaper than calling publish_update per user, the channel layer gets
+    all the rooms at once (see group_send_many). `delta` works like it does
+    for publish_update, each room gets a patch from its own last document.
+    """
+    room_keys = [make_realtime_room_key_for_pk(pk) for pk in user_ids]
+    if room_keys:
+        await group_send_many(await _make_room_events(room_keys, data, commit, delta), channel_layer)
+
+
+async def publish_to_topic(name, data, commit=None, channel_layer=None):
+    """Sends an update to every socket subscribed to topic `name`, see realtime.topics.
+
+    Topic updates aren't replayed to reconnecting sockets, clients should
+    refetch whatever their topics cover when they reconnect.
+    """
+    channel_layer = channel_layer or get_channel_layer()
+    await channel_layer.group_send(make_realtime_topic_key(name), make_update_event(data, commit))
+
+
+async def group_send_many(messages, channel_layer=None):
+    """Sends each group in `messages` (group -> message) its message.
+
+    Uses the channel layer's group_send_many when it has one, which batches
+    the round trips, otherwise sends to each group concurrently.
+    """
+    channel_layer = channel_layer or get_channel_layer()
+    if hasattr(channel_layer, 'group_send_many'):
+        await channel_layer.group_send_many(messages)
+    else:
+        await asyncio.gather(*[
+            channel_layer.group_send(group, message) for group, message in messages.items()
+        ])
+
+
+async def _make_room_events(room_keys, data, commit, delta=False):
+    """Returns an update event per user room, numbered for replays if they're on."""
+    replay_buffer = get_replay_buffer()
+    if replay_buffer or delta:
+        return await sync_to_async(_record_updates)(replay_buffer, room_keys, data, commit, delta)
+
+    # Without replays every room gets the exact same event, encoded once
+    event = make_update_event(data, commit)
+    return {room_key: event for room_key in room_keys}
+
+
+def _record_updates(replay_buffer, room_keys, data, commit, delta=False, event=None):
+    """Returns an update event per room, as deltas if `delta`, numbered and recorded in `replay_buffer` if given.
+
+    `event` is the update already made with make_update_event, for updates
+    that aren't deltas.
+    """
+    if delta:
+        advanced = get_delta_store().advance_many(room_keys, commit, data)
+        events = {room_key: make_delta_event(data, commit, *advanced[room_key]) for room_key in room_keys}
+    else:
+        event = event or make_update_event(data, commit)
+        events = {room_key: event for room_key in room_keys}
+
+    if replay_buffer:
+        # One incr per room for its seq, then every frame is stored at once
+        sequences = replay_buffer.next_sequences(list(events))
+        events = {room_key: number_update_event(event, sequences[room_key]) for room_key, event in events.items()}
+        replay_buffer.append_many({(room_key, event['seq']): event['text'] for room_key, event in events.items()})
+    return events
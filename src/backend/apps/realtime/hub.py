@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import weakref
+
+from channels.layers import get_channel_layer
+
+
+logger = logging.getLogger(__name__)
+
+# Channel layers forget group members after a day (group_expiry), so rooms
+# that stay open longer than that re-join now and then
+REJOIN_INTERVAL = 60 * 60
+# How long a room waits before receiving again after the channel layer failed
+RECEIVE_RETRY_DELAY = 1
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+class HubRoom:
+
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+        self.consumers = set()
+        self.listener = None
+
+
+class RealtimeHub:
+    """Shares one channel layer subscription per room between all the sockets
+    in this process.
+
+    Instead of every socket joining the room's group, the hub joins once with
+    its own channel and hands each message to the local sockets in memory. A
+    user with 10 tabs on the same worker is then 1 group member, not 10.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        self.rooms = {}
+        self.lock = asyncio.Lock()
+        self.rejoiner = None
+
+    async def join(self, room_key, consumer):
+        async with self.lock:
+            room = self.rooms.get(room_key)
+            if room is None:
+                room = self.rooms[room_key] = HubRoom(await self.channel_layer.new_channel())
+                await self.channel_layer.group_add(room_key, room.channel_name)
+                room.listener = asyncio.ensure_future(self._listen(room))
+            room.consumers.add(consumer)
+            if self.rejoiner is None:
+                self.rejoiner = asyncio.ensure_future(self._rejoin())
+
+    async def leave(self, room_key, consumer):
+        async with self.lock:
+            room = self.rooms.get(room_key)
+            if room is None:
+                return
+            room.consumers.discard(consumer)
+            if not room.consumers:
+                del self.rooms[room_key]
+                room.listener.cancel()
+                await self.channel_layer.group_discard(room_key, room.channel_name)
+            if not self.rooms and self.rejoiner is not None:
+                self.rejoiner.cancel()
+                self.rejoiner = None
+
+    async def _listen(self, room):
+        while True:
+            try:
+                message = await self.channel_layer.receive(room.channel_name)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # i.e. Redis went away for a moment, the room keeps listening once it's back
+                logger.exception(f"Realtime hub failed to receive on {room.channel_name}")
+                await asyncio.sleep(RECEIVE_RETRY_DELAY)
+                continue
+
+            for consumer in list(room.consumers):
+                try:
+                    await consumer.dispatch(message)
+                except Exception:
+                    # One broken socket shouldn't stop the rest of the room getting it
+                    logger.exception(f"Realtime hub failed to dispatch {message.get('type')}")
+
+    async def _rejoin(self):
+        """Re-joins every open room's group each REJOIN_INTERVAL, however long they've been quiet."""
+        while True:
+            await asyncio.sleep(REJOIN_INTERVAL)
+            for room_key in list(self.rooms):
+                async with self.lock:
+                    room = self.rooms.get(room_key)
+                    if room is None:
+                        continue
+                    try:
+                        await self.channel_layer.group_add(room_key, room.channel_name)
+                    except Exception:
+                        logger.exception(f"Realtime hub failed to re-join {room_key}")
+
+
+def get_hub(channel_layer=None):
+    """Returns this event loop's hub, every worker process has its own."""
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs[loop] = RealtimeHub(channel_layer or get_channel_layer())
+    return _hubs[loop]
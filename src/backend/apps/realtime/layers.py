@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+
+from collections import defaultdict
+
+from channels_redis.core import RedisChannelLayer
+
+from utils import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Several groups' messages for one process, see group_send_many
+BUNDLE_KEY = '__realtime_bundle__'
+
+# Same as channels_redis' group send script, except it also drops expired
+# messages itself, and the same key can show up more than once (one message
+# per group a non-process-local channel is in)
+GROUP_SEND_MANY_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, current_time - expiry)
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class RealtimeRedisChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer that can also send to lots of groups at once.
+
+    group_send does a few round trips per group, so sending to 5,000 user
+    rooms one by one is 5,000+ round trips. group_send_many looks up every
+    group's members in one pipelined round trip per shard, then delivers to
+    all of them with one script call per shard.
+
+    Every consumer (and hub room) in a process receives through the same
+    Redis key, which only holds `capacity` messages. So like group_send,
+    each process gets one message per call however many of its channels
+    are in the groups: one with an "__asgi_channel__" list when they all get
+    the same message, otherwise a bundle of every message and the channels
+    it's for, which receive_single unpacks. Every process has to use this
+    layer to understand bundles. Messages that didn't fit are logged and
+    counted in utils.metrics under 'realtime.layer.over_capacity'.
+    """
+
+    extensions = RedisChannelLayer.extensions + ["group_send_many"]
+
+    async def group_send_many(self, messages):
+        """Sends every group in `messages` (a dict of group -> message) its message."""
+        for group in messages:
+            assert self.valid_group_name(group), "Group name not valid"
+
+        members = await self._group_members(list(messages))
+
+        # Per Redis key, the channels getting each message, in order. Groups
+        # often share one message (send_to_users), which is then sent once
+        channel_keys = {}
+        for group, message in messages.items():
+            for channel in members[group]:
+                name = self.non_local_name(channel) if "!" in channel else channel
+                channel_key = self.prefix + name
+                if channel_key not in channel_keys:
+                    channel_keys[channel_key] = (self.consistent_hash(name), self.get_capacity(channel), {})
+                _, _, channels_by_message = channel_keys[channel_key]
+                channels_by_message.setdefault(id(message), (message, []))[1].append(channel)
+
+        # Bucket every delivery by the shard its channel key lives on
+        deliveries = defaultdict(list)
+        for channel_key, (index, capacity, channels_by_message) in channel_keys.items():
+            for message in self._pack(channel_key, list(channels_by_message.values())):
+                deliveries[index].append((channel_key, self.serialize(message), capacity))
+
+        await asyncio.gather(*[
+            self._deliver(index, shard_deliveries)
+            for index, shard_deliveries in deliveries.items()
+        ])
+
+    def _pack(self, channel_key, pairs):
+        """Returns the messages to push on `channel_key` for (message, channels) `pairs`."""
+        if len(pairs) == 1:
+            message, channels = pairs[0]
+            return [{**message, "__asgi_channel__": channels}]
+        if not channel_key.endswith("!"):
+            # Received with a plain receive_single, which can't unpack bundles
+            return [{**message, "__asgi_channel__": channels} for message, channels in pairs]
+        return [{BUNDLE_KEY: [[channels, message] for message, channels in pairs]}]
+
+    async def receive_single(self, channel):
+        channel, message = await super().receive_single(channel)
+        if BUNDLE_KEY not in message:
+            return channel, message
+
+        # receive() buffers what we return for its channels, the rest is
+        # buffered here first so every channel gets its messages in order
+        *pairs, (last_channels, last_message) = message[BUNDLE_KEY]
+        for channels, bundled in pairs:
+            for name in channels:
+                self.receive_buffer[name].put_nowait(bundled)
+        return last_channels, last_message
+
+    async def _group_members(self, groups):
+        """Returns a dict of group -> channel names, pipelined per shard."""
+        groups_by_shard = defaultdict(list)
+        for group in groups:
+            groups_by_shard[self.consistent_hash(group)].append(group)
+
+        async def lookup(index, shard_groups):
+            async with self.connection(index) as connection:
+                pipeline = connection.pipeline()
+                results = []
+                for group in shard_groups:
+                    key = self._group_key(group)
+                    pipeline.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+                    results.append(pipeline.zrange(key, 0, -1))
+                await pipeline.execute()
+            return {
+                group: [name.decode('utf8') for name in await result]
+                for group, result in zip(shard_groups, results)
+            }
+
+        members = {}
+        for shard_members in await asyncio.gather(*[
+            lookup(index, shard_groups) for index, shard_groups in groups_by_shard.items()
+        ]):
+            members.update(shard_members)
+        return members
+
+    async def _deliver(self, index, deliveries):
+        keys = [channel_key for channel_key, _, _ in deliveries]
+        args = [message for _, message, _ in deliveries]
+        args += [capacity for _, _, capacity in deliveries]
+        args += [time.time(), self.expiry]
+
+        async with self.connection(index) as connection:
+            over_capacity = await connection.eval(GROUP_SEND_MANY_LUA, keys=keys, args=args)
+        if over_capacity:
+            metrics.increment('realtime.layer.over_capacity', over_capacity)
+            logger.warning(f"{over_capacity} of {len(keys)} channel keys over capacity in group_send_many")
@@ -0,0 +1,29 @@
+import time
+
+
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+
+
+class TokenBucket:
+    """Allows `rate` units a second on average, and bursts of up to `burst` at once.
+
+    Starts full, so a new socket can send its first `burst` frames straight
+    away (i.e. subscribing to all its topics).
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated_at = clock()
+
+    def has(self, amount=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens >= amount
+
+    def take(self, amount=1):
+        self.tokens -= amount
@@ -0,0 +1,204 @@
+import asyncio
+import atexit
+import copy
+import logging
+import threading
+
+from collections import defaultdict
+from functools import partial
+
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from realtime.conf import realtime_setting
+from realtime.helpers import (
+    _record_updates,
+    group_send_many,
+    make_realtime_room_key_for_pk,
+    make_realtime_topic_key,
+    make_update_event,
+)
+from realtime.replay import get_replay_buffer
+
+
+logger = logging.getLogger(__name__)
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+class Publisher:
+    """Sends realtime updates from sync code (views, commands, signals) in batches.
+
+    Calling async_to_sync(publish_update) from a view hops onto an event loop
+    and waits on the channel layer for every single update. The publisher
+    instead queues updates and returns straight away, a background thread
+    with its own event loop sends whatever has been queued every
+    `flush_interval` seconds (or once `max_batch_size` are waiting), all
+    rooms at once through group_send_many.
+
+    Updates published inside a transaction are only queued once it commits,
+    and are dropped if it rolls back, so the frontend never hears about rows
+    that don't exist.
+
+        from realtime.publisher import get_publisher
+
+        publisher = get_publisher()
+        for thing in things:
+            publisher.publish(make_realtime_room_key(thing.owner), ThingSerializer(thing).data, commit='things/update')
+
+    Updates are encoded when they're published (delta ones, which need the
+    document itself, are copied instead), so changing `data` afterwards
+    doesn't change what gets sent.
+
+    flush() blocks until everything queued so far is sent, close() flushes
+    and stops the thread. Updates published after close() are logged and
+    dropped.
+    """
+
+    def __init__(self, channel_layer=None, flush_interval=None, max_batch_size=None, using=None):
+        self.channel_layer = channel_layer
+        self.flush_interval = realtime_setting('PUBLISHER_FLUSH_INTERVAL') if flush_interval is None else flush_interval
+        self.max_batch_size = max_batch_size or realtime_setting('PUBLISHER_MAX_BATCH_SIZE')
+        self.using = using
+        self.pending = []
+        self.flush_scheduled = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.send_lock = None
+
+    def publish(self, room_key, data, commit=None, delta=False):
+        """Queues an update for every socket in `room_key`, see helpers.publish_update."""
+        self._queue([room_key], data, commit, replay=True, delta=delta)
+
+    def send_to_users(self, user_ids, data, commit=None, delta=False):
+        """Queues the same update for every user in `user_ids`, see helpers.send_to_users."""
+        room_keys = [make_realtime_room_key_for_pk(pk) for pk in user_ids]
+        if room_keys:
+            self._queue(room_keys, data, commit, replay=True, delta=delta)
+
+    def publish_to_topic(self, name, data, commit=None):
+        """Queues an update for topic `name`, see helpers.publish_to_topic."""
+        self._queue([make_realtime_topic_key(name)], data, commit, replay=False, delta=False)
+
+    def flush(self):
+        """Sends everything queued so far, returning once it's been handed to the channel layer."""
+        if self.loop is None:
+            # Nothing was ever queued
+            return
+        asyncio.run_coroutine_threadsafe(self._send_pending(), self._get_loop()).result()
+
+    def close(self):
+        """Flushes, then stops the background thread. Anything published afterwards is dropped."""
+        with self.lock:
+            self.closed = True
+        self.flush()
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._cancel_flushes(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+
+    def _queue(self, groups, data, commit, replay, delta):
+        # Callers may change `data` once we return, so it's sent as it is now
+        payload = copy.deepcopy(data) if delta else make_update_event(data, commit)
+        # Outside of a transaction on_commit calls us back right away
+        transaction.on_commit(partial(self._enqueue, (groups, payload, commit, replay, delta)), using=self.using)
+
+    def _enqueue(self, update):
+        with self.lock:
+            if self.closed:
+                # Raising here would break whatever request just committed
+                logger.error(f"Realtime publisher is closed, dropping update to {len(update[0])} groups")
+                return
+            self.pending.append(update)
+            full = len(self.pending) >= self.max_batch_size
+            schedule = full or not self.flush_scheduled
+            self.flush_scheduled = True
+
+        if schedule:
+            asyncio.run_coroutine_threadsafe(self._flush_later(0 if full else self.flush_interval), self._get_loop())
+
+    def _get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                started = threading.Event()
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self._run, args=(started,), name='realtime-publisher', daemon=True)
+                self.thread.start()
+                started.wait()
+            return self.loop
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.send_lock = asyncio.Lock()
+        started.set()
+        self.loop.run_forever()
+
+    async def _flush_later(self, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            await self._send_pending()
+        except Exception:
+            # Nobody is waiting on this flush to tell, so at least log it
+            logger.exception("Realtime publisher failed to send updates")
+
+    async def _cancel_flushes(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send_pending(self):
+        # Flushes take turns so updates to a room can't overtake each other
+        async with self.send_lock:
+            with self.lock:
+                updates, self.pending = self.pending, []
+                self.flush_scheduled = False
+            if not updates:
+                return
+
+            # Each group can only get one message per group_send_many, so a
+            # group with several updates gets them over several rounds, in order
+            rounds = []
+            depth = defaultdict(int)
+            for group, event in self._make_events(updates):
+                if depth[group] == len(rounds):
+                    rounds.append({})
+                rounds[depth[group]][group] = event
+                depth[group] += 1
+
+            for messages in rounds:
+                await group_send_many(messages, self.channel_layer or get_channel_layer())
+
+    def _make_events(self, updates):
+        """Returns (group, event) pairs for `updates`, numbered for replays if they're on.
+
+        This thread only sends updates, so it's fine for the replay buffer's
+        and delta store's cache calls to block it.
+        """
+        replay_buffer = get_replay_buffer()
+        events = []
+        for groups, payload, commit, replay, delta in updates:
+            if delta:
+                events += _record_updates(replay_buffer if replay else None, groups, payload, commit, delta=True).items()
+            elif replay and replay_buffer:
+                events += _record_updates(replay_buffer, groups, None, commit, event=payload).items()
+            else:
+                events += [(group, payload) for group in groups]
+        return events
+
+
+def get_publisher():
+    """Returns this process' shared Publisher, which is flushed when the process exits."""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher()
+            atexit.register(_publisher.flush)
+        return _publisher
@@ -0,0 +1,65 @@
+from collections import deque
+
+from utils import metrics
+
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+
+class SendQueue:
+    """Bounded queue of frames waiting to go out on one socket.
+
+    When the queue is full `policy` decides what happens to a new frame:
+
+        drop_oldest -- the oldest waiting frame is thrown away
+        coalesce    -- a waiting frame with the same commit is replaced, if
+                       there isn't one the oldest frame is thrown away
+        disconnect  -- put() returns False and the socket should be closed
+
+    Frames with a `commit` of None are never coalesced.
+    """
+
+    def __init__(self, max_size, policy=DROP_OLDEST):
+        assert policy in (DROP_OLDEST, COALESCE, DISCONNECT), f"Unknown send queue policy: {policy}"
+        self.max_size = max_size
+        self.policy = policy
+        self.frames = deque()
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, commit, text):
+        """Adds a frame, returns False if the socket is too slow and should be disconnected."""
+        if len(self.frames) >= self.max_size:
+            if self.policy == DISCONNECT:
+                metrics.increment('realtime.send_queue.disconnected')
+                return False
+
+            if self.policy == COALESCE and commit is not None and self._replace(commit, text):
+                self.coalesced += 1
+                metrics.increment('realtime.send_queue.coalesced')
+                return True
+
+            self.frames.popleft()
+            self.dropped += 1
+            metrics.increment('realtime.send_queue.dropped')
+
+        self.frames.append((commit, text))
+        return True
+
+    def pop(self):
+        """Returns the next frame's text, or None if there isn't one."""
+        if not self.frames:
+            return None
+        _, text = self.frames.popleft()
+        return text
+
+    def _replace(self, commit, text):
+        for index, (queued_commit, _) in enumerate(self.frames):
+            if queued_commit == commit:
+                # Moves to the back of the queue, it's newer than what's in between
+                del self.frames[index]
+                self.frames.append((commit, text))
+                return True
+        return False
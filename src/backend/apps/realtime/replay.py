@@ -0,0 +1,72 @@
+from django.core.cache import caches
+
+from realtime.conf import realtime_setting
+
+
+class ReplayBuffer:
+    """Remembers the last `size` update frames sent to each room for `ttl` seconds.
+
+    Each update gets the next sequence number for its room. A socket that
+    reconnects with the last sequence number it saw can get what it missed,
+    instead of refetching everything.
+
+    Everything lives in a Django cache, so it needs to be one that's shared
+    between processes (i.e. Redis) for replays to work across workers.
+    """
+
+    def __init__(self, size, ttl, cache_alias='default'):
+        self.size = size
+        self.ttl = ttl
+        self.cache = caches[cache_alias]
+
+    def next_sequence(self, room_key):
+        return self.next_sequences([room_key])[room_key]
+
+    def next_sequences(self, room_keys):
+        """Returns the next sequence number of every room in `room_keys`, one incr each."""
+        sequences = {}
+        for room_key in room_keys:
+            key = self._sequence_key(room_key)
+            try:
+                sequences[room_key] = self.cache.incr(key)
+            except ValueError:
+                # The room's first update
+                self.cache.add(key, 0, timeout=None)
+                sequences[room_key] = self.cache.incr(key)
+        return sequences
+
+    def append(self, room_key, sequence, text):
+        self.append_many({(room_key, sequence): text})
+
+    def append_many(self, frames):
+        """Stores a dict of (room key, sequence) -> frame text, all at once."""
+        self.cache.set_many({
+            self._frame_key(room_key, sequence): text for (room_key, sequence), text in frames.items()
+        }, timeout=self.ttl)
+
+    def since(self, room_key, last_sequence):
+        """Returns the frames sent after `last_sequence`, or None if some of them are gone."""
+        current = self.cache.get(self._sequence_key(room_key), 0)
+        if last_sequence > current or current - last_sequence > self.size:
+            return None
+
+        keys = [self._frame_key(room_key, sequence) for sequence in range(last_sequence + 1, current + 1)]
+        frames = self.cache.get_many(keys)
+        if len(frames) != len(keys):
+            # Some expired, there's a hole we can't fill
+            return None
+        return [frames[key] for key in keys]
+
+    def _sequence_key(self, room_key):
+        return f"realtime_replay:{room_key}:sequence"
+
+    def _frame_key(self, room_key, sequence):
+        return f"realtime_replay:{room_key}:{sequence}"
+
+
+def get_replay_buffer():
+    """Returns the configured ReplayBuffer, or None if replays are turned off."""
+    size = realtime_setting('REPLAY_BUFFER_SIZE')
+    if not size:
+        return None
+    return ReplayBuffer(size, realtime_setting('REPLAY_BUFFER_TTL'), realtime_setting('REPLAY_CACHE'))
@@ -0,0 +1,66 @@
+"""Request/response calls over the realtime socket, so the frontend can get
+things without a new HTTP request each time.
+
+Apps register handlers in their own `rpc.py`, which gets found automatically:
+
+    from realtime import rpc
+
+    @rpc.register('things.list')
+    def list_things(user, page=1):
+        return ThingSerializer(Thing.objects.filter(owner=user), many=True).data
+
+Handlers get the socket's user plus whatever "params" were sent. Plain
+functions run in a thread so they can use the ORM, async ones run on the
+event loop. Raise RpcError to send a specific error back. Params the
+handler doesn't take, or missing ones, are answered with a 400.
+"""
+import asyncio
+import inspect
+
+from channels.db import database_sync_to_async
+from django.utils.module_loading import autodiscover_modules
+
+
+_handlers = {}
+_discovered = False
+
+
+class RpcError(Exception):
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def register(name):
+    def decorator(func):
+        _handlers[name] = func
+        return func
+    return decorator
+
+
+def get_handler(name):
+    global _discovered
+    if not _discovered:
+        autodiscover_modules('rpc')
+        _discovered = True
+    return _handlers.get(name)
+
+
+async def call(user, method, params):
+    """Runs the handler registered for `method` and returns its result."""
+    handler = get_handler(method)
+    if handler is None:
+        raise RpcError(f"Unknown method: {method}", code=404)
+    if not isinstance(params, dict):
+        raise RpcError("params must be an object")
+    try:
+        inspect.signature(handler).bind(user, **params)
+    except TypeError as e:
+        # Or it'd be raised by the call below, and look like the handler broke
+        raise RpcError(f"Bad params for {method}: {e}")
+
+    if asyncio.iscoroutinefunction(handler):
+        return await handler(user, **params)
+    return await database_sync_to_async(handler)(user, **params)
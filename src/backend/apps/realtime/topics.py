@@ -0,0 +1,42 @@
+"""Named topics sockets can subscribe to, on top of their own user room.
+
+Apps register the topics they publish to in their own `topics.py`, which
+gets found automatically:
+
+    from realtime import topics
+
+    topics.register('announcements')
+    topics.register('staff_alerts', can_subscribe=lambda user: user.is_staff)
+
+Browsers subscribe with {"type": "subscribe", "topic": "announcements"} and
+backend code sends with realtime.helpers.publish_to_topic. Topics that
+aren't registered can't be subscribed to.
+"""
+import re
+
+from django.utils.module_loading import autodiscover_modules
+
+
+_topics = {}
+_discovered = False
+
+
+def register(name, can_subscribe=None):
+    # Topic names end up in channel layer group names
+    assert re.match(r'^[a-zA-Z0-9_.-]{1,80}$', name), f"Invalid topic name: {name}"
+    _topics[name] = can_subscribe or _anyone
+
+
+def can_subscribe(user, name):
+    """Whether `user` may subscribe to topic `name`. Checks can hit the database."""
+    global _discovered
+    if not _discovered:
+        autodiscover_modules('topics')
+        _discovered = True
+
+    check = _topics.get(name)
+    return check is not None and check(user)
+
+
+def _anyone(user):
+    return True
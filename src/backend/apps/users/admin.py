@@ -1,7 +1,132 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connection
+from django.db.models import Exists, OuterRef
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from . import models
+from .bulk import BulkAction
+from .conf import users_setting
+from .search import annotate_rank, annotate_search, filter_search
+
+
+# Query string parameter for the last id of the previous page, in keyset pagination
+AFTER_VAR = 'after'
+
+
+class UserChangeList(ChangeList):
+    """ChangeList with a large table mode.
+
+    Once users_user holds USERS['ADMIN_LARGE_TABLE_ROWS'] rows, by Postgres'
+    estimate, counts are Postgres' estimates too and the full count isn't
+    shown. Pages ordered by id, the default, are fetched after the last id
+    of the previous one instead of at an OFFSET, with links to the next
+    and the first page only.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.large_table = is_large_table(args[0])
+        self.keyset = False
+        self.after = request.GET.get(AFTER_VAR)
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Filtering or ordering starts again from the first page
+        if AFTER_VAR not in (new_params or {}):
+            remove = [*(remove or []), AFTER_VAR]
+        return super().get_query_string(new_params, remove)
+
+    def get_ordering(self, request, queryset):
+        # Best search matches first, unless a column was clicked
+        if self.query and ORDER_VAR not in self.params:
+            return ['-search_rank', '-pk']
+        return super().get_ordering(request, queryset)
+
+    def get_results(self, request):
+        if not self.large_table:
+            return super().get_results(request)
+
+        self.result_count = estimate_count(self.queryset)
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+
+        if self.query or ORDER_VAR in self.params:
+            # Ranked or sorted by a column, no keyset to page on
+            self.paginator = EstimatedCountPaginator(self.queryset, self.list_per_page)
+            self.multi_page = self.result_count > self.list_per_page
+            try:
+                self.result_list = self.paginator.page(self.page_num).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+            return
+
+        queryset = self.queryset
+        if self.after:
+            try:
+                queryset = queryset.filter(pk__gt=int(self.after))
+            except ValueError:
+                raise IncorrectLookupParameters
+        results = list(queryset[:self.list_per_page + 1])
+        self.keyset = True
+        self.multi_page = False
+        self.result_list = results[:self.list_per_page]
+        self.next_page_url = None
+        if len(results) > self.list_per_page:
+            self.next_page_url = self.get_query_string({AFTER_VAR: self.result_list[-1].pk})
+        self.first_page_url = self.get_query_string() if self.after else None
+
+
+class EstimatedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
+
+
+class GroupFilter(admin.SimpleListFilter):
+    """Filters users by group, without the join and DISTINCT of list_filter's 'groups'.
+
+    Lists the first USERS['ADMIN_GROUP_CHOICES'] groups by name, and the
+    one being filtered on.
+    """
+    title = _('groups')
+    parameter_name = 'group'
+
+    def lookups(self, request, model_admin):
+        groups = list(Group.objects.order_by('name').values_list('id', 'name')[:users_setting('ADMIN_GROUP_CHOICES')])
+        if self.value() and self.value().isdigit() and int(self.value()) not in dict(groups):
+            groups += Group.objects.filter(pk=self.value()).values_list('id', 'name')
+        return groups
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        if not self.value().isdigit():
+            raise IncorrectLookupParameters
+        memberships = models.User.groups.through.objects.filter(user_id=OuterRef('pk'), group_id=self.value())
+        return queryset.filter(Exists(memberships))
+
+
+class UserActionForm(ActionForm):
+    # An id rather than a <select>, which would list every group on every changelist load
+    group = forms.ModelChoiceField(
+        Group.objects.all(), required=False, label=_('Group id'),
+        widget=forms.NumberInput(attrs={'placeholder': _('Group id')}),
+    )
 
 
 class CustomUserAdmin(UserAdmin):
@@ -20,11 +145,78 @@ class CustomUserAdmin(UserAdmin):
         }),
     )
     list_display = ('email', 'first_name', 'last_name', 'is_staff')
-    list_filter = ('is_staff', 'is_superuser', 'is_active', 'groups')
+    list_filter = ('is_staff', 'is_superuser', 'is_active', GroupFilter)
+    # Searched through users.search's trigram indexes, see get_search_results
     search_fields = ('first_name', 'last_name', 'email')
     ordering = ('id', 'email')
     filter_horizontal = ('groups', 'user_permissions',)
     readonly_fields = ["date_joined", "last_login"]
+    action_form = UserActionForm
+    actions = ['activate_users', 'deactivate_users', 'add_users_to_group', 'remove_users_from_group']
+
+    def get_changelist(self, request, **kwargs):
+        return UserChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        queryset = filter_search(annotate_search(queryset), search_term)
+        return annotate_rank(queryset, search_term), False
+
+    @admin.action(permissions=['change'], description=_('Activate selected users'))
+    def activate_users(self, request, queryset):
+        self.start_bulk_action(request, queryset, 'activate')
+
+    @admin.action(permissions=['change'], description=_('Deactivate selected users'))
+    def deactivate_users(self, request, queryset):
+        self.start_bulk_action(request, queryset, 'deactivate')
+
+    @admin.action(permissions=['change'], description=_('Add selected users to group'))
+    def add_users_to_group(self, request, queryset):
+        self.start_bulk_action(request, queryset, 'add_to_group', needs_group=True)
+
+    @admin.action(permissions=['change'], description=_('Remove selected users from group'))
+    def remove_users_from_group(self, request, queryset):
+        self.start_bulk_action(request, queryset, 'remove_from_group', needs_group=True)
+
+    def start_bulk_action(self, request, queryset, action, needs_group=False):
+        """Starts a users.bulk.BulkAction, which reports its progress over the realtime socket."""
+        group_id = None
+        if needs_group:
+            # Only the group, the action form's own action field has no choices here
+            try:
+                group = forms.ModelChoiceField(Group.objects.all()).clean(request.POST.get('group'))
+            except ValidationError:
+                self.message_user(request, _('Pick a group for this action.'), messages.ERROR)
+                return
+            group_id = group.pk
+        BulkAction(request.user.pk, action, queryset, group_id=group_id).start()
+        self.message_user(request, _('Started updating the selected users, progress is sent to your realtime socket.'))
+
+
+def is_large_table(model):
+    threshold = users_setting('ADMIN_LARGE_TABLE_ROWS')
+    return threshold is not None and estimate_table_rows(model) >= threshold
+
+
+def estimate_table_rows(model):
+    """Postgres' estimate of the rows in `model`'s table, as of its last ANALYZE."""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        # -1 for tables that were never analyzed
+        return max(int(cursor.fetchone()[0]), 0)
+
+
+def estimate_count(queryset):
+    """Postgres' estimate of the rows in `queryset`, from its query plan."""
+    if not queryset.query.where and not queryset.query.distinct:
+        rows = estimate_table_rows(queryset.model)
+        if rows:
+            return rows
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        return int(cursor.fetchone()[0][0]['Plan']['Plan Rows'])
 
 
 admin.site.register(models.User, CustomUserAdmin)
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class UsersConfig(AppConfig):
+    name = 'users'
+
+    def ready(self):
+        # Connects the token cache's invalidation receivers
+        from users import authentication  # noqa: F401
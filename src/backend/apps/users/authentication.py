@@ -0,0 +1,177 @@
+import pickle
+import threading
+import time
+
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from users.conf import users_setting
+from utils import metrics
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that remembers tokens for a little while.
+
+    TokenAuthentication reads the token and its user from Postgres on every
+    request, which for clients polling /api/users/me/ is most of what the
+    request does. With USERS['TOKEN_CACHE_TTL'] set (it's off by default),
+    valid tokens are kept for that many seconds in a per process LRU of
+    USERS['TOKEN_CACHE_SIZE'] entries, and in the USERS['TOKEN_CACHE'] Django
+    cache when there is one, so processes share their lookups.
+
+    Deleting a token or saving its user (deactivating them, say) forgets it
+    right away in this process and the shared cache. Other processes' LRUs
+    only catch up after the TTL, a revoked token keeps working there until
+    then, so keep it short. Hits and misses are counted under
+    'users.token_cache', see get_hit_ratio.
+    """
+
+    def authenticate_credentials(self, key):
+        if not users_setting('TOKEN_CACHE_TTL'):
+            return super().authenticate_credentials(key)
+
+        cache = get_token_cache()
+        token = cache.get(key)
+        if token is None:
+            looked_up_at = time.time()
+            # Raises for unknown tokens and inactive users, neither is cached
+            user, token = super().authenticate_credentials(key)
+            cache.set(key, token, looked_up_at=looked_up_at)
+        return token.user, token
+
+
+class TokenCache:
+    """Tokens, with their users, in a bounded LRU and optionally a shared Django cache.
+
+    Entries are kept pickled, so every request gets its own user instance
+    to change rather than one shared with concurrent requests. forget()
+    remembers when it forgot a token for `ttl` seconds (in the shared cache
+    too), so a lookup that started before that doesn't put it back.
+    """
+
+    def __init__(self, ttl, size, cache_alias=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.shared = caches[cache_alias] if cache_alias else None
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.forgotten = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, data = entry
+                if expires > self.clock():
+                    self.entries.move_to_end(key)
+                    metrics.increment('users.token_cache.hit')
+                    return pickle.loads(data)
+                del self.entries[key]
+
+        if self.shared is not None:
+            data = self.shared.get(_cache_key(key))
+            if data is not None:
+                metrics.increment('users.token_cache.shared_hit')
+                self._remember(key, data)
+                return pickle.loads(data)
+
+        metrics.increment('users.token_cache.miss')
+        return None
+
+    def set(self, key, token, looked_up_at=None):
+        """Caches `token`, unless it was forgotten since `looked_up_at` (a time.time())."""
+        if looked_up_at is not None and self._forgotten_since(key, looked_up_at):
+            return
+        data = pickle.dumps(token)
+        self._remember(key, data)
+        if self.shared is not None:
+            self.shared.set(_cache_key(key), data, self.ttl)
+
+    def forget(self, key):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.forgotten.pop(key, None)
+            self.forgotten[key] = now
+            while next(iter(self.forgotten.values())) < now - self.ttl:
+                self.forgotten.popitem(last=False)
+        if self.shared is not None:
+            self.shared.delete(_cache_key(key))
+            self.shared.set(_forgotten_key(key), now, self.ttl)
+
+    def clear(self):
+        """Empties this process' LRU, the shared cache is left alone."""
+        with self.lock:
+            self.entries.clear()
+
+    def _forgotten_since(self, key, since):
+        with self.lock:
+            forgotten_at = self.forgotten.get(key)
+        if forgotten_at is None and self.shared is not None:
+            forgotten_at = self.shared.get(_forgotten_key(key))
+        return forgotten_at is not None and forgotten_at >= since
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def get_token_cache():
+    """Returns this process' TokenCache for the current USERS settings."""
+    key = (users_setting('TOKEN_CACHE_TTL'), users_setting('TOKEN_CACHE_SIZE'), users_setting('TOKEN_CACHE'))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = TokenCache(*key)
+        return _caches[key]
+
+
+def get_hit_ratio():
+    """Share of cached token lookups that didn't need the database, None before any."""
+    hits = metrics.get_count('users.token_cache.hit') + metrics.get_count('users.token_cache.shared_hit')
+    total = hits + metrics.get_count('users.token_cache.miss')
+    return hits / total if total else None
+
+
+def _cache_key(key):
+    return f"users_token:{key}"
+
+
+def _forgotten_key(key):
+    return f"users_token_forgotten:{key}"
+
+
+# ----------------------------------------------------------------------------
+# Invalidation, connected in UsersConfig.ready. Queryset .update()s skip the
+# signals, they call forget_tokens_for_users themselves.
+# ----------------------------------------------------------------------------
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    if users_setting('TOKEN_CACHE_TTL'):
+        get_token_cache().forget(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def forget_user_tokens(sender, instance, created, **kwargs):
+    if not created:
+        forget_tokens_for_users([instance.pk])
+
+
+def forget_tokens_for_users(user_ids):
+    """Forgets the cached tokens of `user_ids`, for changes that skip User.save()."""
+    if users_setting('TOKEN_CACHE_TTL'):
+        cache = get_token_cache()
+        for key in Token.objects.filter(user_id__in=user_ids).values_list('key', flat=True):
+            cache.forget(key)
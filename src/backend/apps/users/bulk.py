@@ -0,0 +1,138 @@
+"""Bulk changes to many users at once, off the request thread.
+
+Saving tens of thousands of users one by one inside an admin request holds
+locks on all of them until it times out. The admin's bulk actions start a
+BulkAction instead, which runs on a background thread in chunks:
+
+    USERS['BULK_ACTION_CHUNK_SIZE']  users per UPDATE, each chunk is its own
+                                     short transaction
+    USERS['BULK_ACTION_WORKERS']     bulk actions running at once, others wait
+
+After every chunk the acting user gets an update with the progress on
+their realtime socket, with commit 'users/bulk_action':
+
+    {"id": "...", "action": "deactivate", "done": 2000, "total": 35000, "finished": false}
+
+with "error" set if the action failed halfway. Chunks already done stay
+done, there's no rolling back the whole action.
+
+Deactivated users' API tokens and cached realtime logins are forgotten as
+each chunk commits, so they can't authenticate again. Sockets they already
+have open stay open until they disconnect.
+"""
+import logging
+import threading
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from django.db.models import F
+
+from realtime.auth import forget_users as forget_realtime_users
+from realtime.helpers import make_realtime_room_key_for_pk
+from realtime.publisher import get_publisher
+from users.authentication import forget_tokens_for_users
+from users.conf import users_setting
+
+
+COMMIT = 'users/bulk_action'
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class BulkAction:
+    """Applies `action` to every user in `queryset`, a chunk at a time.
+
+    Actions are "activate", "deactivate", "add_to_group" and
+    "remove_from_group", the last two need `group_id`. The queryset is
+    walked by id, so it can be any filtered admin selection and only one
+    chunk of ids is in memory at a time.
+    """
+    actions = ('activate', 'deactivate', 'add_to_group', 'remove_from_group')
+
+    def __init__(self, actor_id, action, queryset, group_id=None, chunk_size=None):
+        assert action in self.actions, f"Unknown bulk action: {action}"
+        assert group_id is not None or action not in ('add_to_group', 'remove_from_group'), f"{action} needs a group"
+        self.id = uuid.uuid4().hex
+        self.actor_id = actor_id
+        self.action = action
+        self.ids = queryset.order_by('pk').values_list('pk', flat=True)
+        self.group_id = group_id
+        self.chunk_size = chunk_size or users_setting('BULK_ACTION_CHUNK_SIZE')
+        self.total = None
+        self.done = 0
+
+    def start(self):
+        """Runs the action on the bulk action pool, returns its Future."""
+        return get_bulk_executor().submit(self.run_in_thread)
+
+    def run_in_thread(self):
+        try:
+            return self.run()
+        finally:
+            # Pool threads keep their own connection, like request threads
+            close_old_connections()
+
+    def run(self):
+        try:
+            self.total = self.ids.count()
+            last_id = None
+            while True:
+                chunk = self.ids if last_id is None else self.ids.filter(pk__gt=last_id)
+                chunk = list(chunk[:self.chunk_size])
+                if not chunk:
+                    break
+                with transaction.atomic():
+                    self.apply(chunk)
+                self.done += len(chunk)
+                last_id = chunk[-1]
+                self.report(finished=False)
+            self.report(finished=True)
+        except Exception as e:
+            logger.exception("Bulk %s of users failed", self.action)
+            self.report(finished=True, error=str(e))
+            raise
+
+    def apply(self, user_ids):
+        User = get_user_model()
+        if self.action in ('activate', 'deactivate'):
+            # update() skips User.save(), so bump version for ETags here
+            User.objects.filter(pk__in=user_ids).update(is_active=self.action == 'activate', version=F('version') + 1)
+            if self.action == 'deactivate':
+                transaction.on_commit(lambda: self.forget_users(user_ids))
+        elif self.action == 'add_to_group':
+            User.groups.through.objects.bulk_create(
+                [User.groups.through(user_id=user_id, group_id=self.group_id) for user_id in user_ids],
+                ignore_conflicts=True,
+            )
+        else:
+            User.groups.through.objects.filter(user_id__in=user_ids, group_id=self.group_id).delete()
+
+    def forget_users(self, user_ids):
+        forget_tokens_for_users(user_ids)
+        forget_realtime_users(user_ids)
+
+    def report(self, finished, error=None):
+        progress = {
+            "id": self.id,
+            "action": self.action,
+            "done": self.done,
+            "total": self.total,
+            "finished": finished,
+        }
+        if error is not None:
+            progress["error"] = error
+        get_publisher().publish(make_realtime_room_key_for_pk(self.actor_id), progress, commit=COMMIT)
+
+
+def get_bulk_executor():
+    """Returns this process' thread pool for bulk actions."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(users_setting('BULK_ACTION_WORKERS'), thread_name_prefix='users-bulk')
+        return _executor
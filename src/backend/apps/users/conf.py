@@ -0,0 +1,25 @@
+from django.conf import settings
+
+
+DEFAULTS = {
+    'HASHING_EXECUTOR': 'process',
+    'HASHING_WORKERS': None,
+    'HASHING_MAX_PENDING': 32,
+    'PBKDF2_ITERATIONS': None,
+    'ARGON2_TIME_COST': None,
+    'ARGON2_MEMORY_COST': None,
+    'BCRYPT_ROUNDS': None,
+    'TOKEN_CACHE_TTL': None,
+    'TOKEN_CACHE_SIZE': 10_000,
+    'TOKEN_CACHE': None,
+    'ADMIN_LARGE_TABLE_ROWS': 100_000,
+    'ADMIN_GROUP_CHOICES': 50,
+    'BULK_ACTION_CHUNK_SIZE': 1000,
+    'BULK_ACTION_WORKERS': 1,
+    'EXPORT_CHUNK_SIZE': 2000,
+}
+
+
+def users_setting(name):
+    """Looks up `name` in settings.USERS, falling back to our defaults."""
+    return getattr(settings, 'USERS', {}).get(name, DEFAULTS[name])
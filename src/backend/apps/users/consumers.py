@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+from django.http import QueryDict
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+
+from users.authentication import CachedTokenAuthentication
+from users.export import UserExport
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserExportConsumer(AsyncHttpConsumer):
+    """Streams users.export.UserExport to staff, from /api/users/export/.
+
+        GET /api/users/export/?format=ndjson&fields=id,email&is_active=true
+
+    Django 3.2 iterates streaming responses on the event loop under ASGI,
+    where it can't query the database, so this is a channels consumer like
+    the event stream. Each export reads through its server-side cursor, in
+    its transaction, on a thread of its own, one chunk at a time: the next
+    chunk is only fetched once the last one was sent, and a client going
+    away stops the export.
+
+    Authenticates with the session, or a token like ManageUserView.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream_task = None
+
+    async def http_request(self, message):
+        # Unlike AsyncHttpConsumer, keep going after handle() until the client goes away
+        if "body" in message:
+            self.body.append(message["body"])
+        if not message.get("more_body"):
+            await self.handle(b"".join(self.body))
+
+    async def handle(self, body):
+        user = await self.get_user()
+        if user is None or not user.is_staff:
+            await self.respond(403 if user else 401, {"detail": "You do not have permission to perform this action."})
+            raise StopConsumer()
+
+        query = QueryDict(self.scope.get('query_string', b'').decode())
+        try:
+            export = await database_sync_to_async(UserExport.from_params)(query)
+        except ValidationError as e:
+            await self.respond(400, e.detail)
+            raise StopConsumer()
+
+        await self.send_headers(headers=[
+            (b"Content-Type", export.content_type.encode()),
+            (b"Content-Disposition", f'attachment; filename="{export.filename}"'.encode()),
+            (b"X-Accel-Buffering", b"no"),
+        ])
+        self.stream_task = asyncio.ensure_future(self.stream(export))
+
+    async def get_user(self):
+        """Returns the token's or the session's user, None for anonymous requests."""
+        for name, value in self.scope.get('headers', []):
+            if name.lower() == b'authorization':
+                words = value.decode('latin1').split()
+                if len(words) == 2 and words[0].lower() == 'token':
+                    try:
+                        user, token = await database_sync_to_async(CachedTokenAuthentication().authenticate_credentials)(words[1])
+                    except AuthenticationFailed:
+                        return None
+                    return user
+        user = self.scope.get('user')
+        return user if user is not None and user.is_authenticated else None
+
+    async def stream(self, export):
+        loop = asyncio.get_running_loop()
+        # The cursor and its transaction belong to this thread's connection,
+        # every chunk has to come from it and it's closed there too
+        executor = ThreadPoolExecutor(1, thread_name_prefix='users-export')
+        chunks = export.chunks()
+        try:
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await self.send_body(chunk.encode(), more_body=True)
+            except asyncio.CancelledError:
+                # The client went away, there's no response left to finish
+                raise
+            except Exception:
+                # Headers are out, all we can do is cut the export short
+                logger.exception("User export failed")
+            await self.send_body(b"")
+        finally:
+            executor.submit(_close, chunks)
+            executor.shutdown(wait=False)
+            self.stream_task = None
+
+    async def disconnect(self):
+        if self.stream_task is not None:
+            self.stream_task.cancel()
+
+    async def respond(self, status, data):
+        await self.send_response(status, json.dumps(data).encode(), headers=[(b"Content-Type", b"application/json")])
+
+
+def _close(chunks):
+    chunks.close()
+    # The thread goes away with its connection
+    connection.close()
@@ -5,6 +5,7 @@ https://factoryboy.readthedocs.io/en/latest/recipes.html
 import factory
 
 from django.contrib.auth import get_user_model
+from django.db import connection
 
 
 class UserFactory(factory.django.DjangoModelFactory):
@@ -24,3 +25,53 @@ class UserFactory(factory.django.DjangoModelFactory):
         else:
             self.set_password('factoryuserpass')
         self.save()
+
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Daniel', 'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Betty', 'Mark', 'Margaret', 'Donald', 'Sandra',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', 'Ramirez', 'Lewis', 'Robinson',
+]
+
+
+def generate_users(count, email_domain):
+    """Makes sure there are `count` users @`email_domain`, generated by Postgres in batches.
+
+    Much faster than factories for benchmark sized tables. They have no
+    usable password, and the table is analyzed afterwards.
+    """
+    existing = get_user_model().objects.filter(email__endswith=f'@{email_domain}').count()
+    batch = 100_000
+    with connection.cursor() as cursor:
+        for start in range(existing, count, batch):
+            cursor.execute(
+                "INSERT INTO users_user (password, email, first_name, last_name, date_joined, last_login,"
+                " is_active, is_staff, is_superuser, version)"
+                " SELECT '!', 'bench-' || i || '-' || left(md5(i::text), 8) || %s,"
+                " (%s::text[])[1 + i %% %s], (%s::text[])[1 + (i / %s) %% %s],"
+                " now(), now(), true, false, false, 1"
+                " FROM generate_series(%s, %s) i",
+                [
+                    f'@{email_domain}',
+                    FIRST_NAMES, len(FIRST_NAMES),
+                    LAST_NAMES, len(FIRST_NAMES), len(LAST_NAMES),
+                    start, min(start + batch, count) - 1,
+                ],
+            )
+        cursor.execute("ANALYZE users_user")
+
+
+def delete_generated_users(email_domain):
+    """Deletes generate_users' users in one DELETE.
+
+    The ORM's delete() fetches every user to collect and cascade to its
+    related rows, which takes longer than making them. Generated users have
+    no related rows, so there's nothing to cascade to.
+    """
+    users = get_user_model().objects.filter(email__endswith=f'@{email_domain}')
+    users._raw_delete(users.db)
@@ -0,0 +1,33 @@
+from django.db.models import TextField
+from django.db.models.functions import Cast, Lower
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+
+def filter_users(queryset, params):
+    """Filters users on `is_active` and `is_staff` (true/false) and an `email` prefix.
+
+    Each is backed by an index from 0004_user_list_indexes. Raises
+    ValidationError for values that aren't booleans.
+
+    The email prefix index only keeps a page flat-cost when the prefix is
+    selective. UserListView pages by -id, so Postgres either reads every
+    matching email and sorts them, or walks ids newest first until a page
+    matches. Either way that's linear in the matching users, or in the
+    users it skips, for prefixes like "a" on a big table.
+    """
+    for field in ('is_active', 'is_staff'):
+        if field in params:
+            try:
+                value = serializers.BooleanField().to_internal_value(params[field])
+            except ValidationError as e:
+                raise ValidationError({field: e.detail})
+            queryset = queryset.filter(**{field: value})
+
+    if params.get('email'):
+        # Matches users_user_email_prefix_idx, citext's own LIKE can't use an index
+        queryset = queryset.annotate(
+            email_lower=Lower(Cast('email', TextField())),
+        ).filter(email_lower__startswith=params['email'].lower())
+
+    return queryset
@@ -0,0 +1,51 @@
+"""Django's password hashers, with work factors from settings.USERS.
+
+Django hardcodes them per release, these take them from
+
+    USERS['PBKDF2_ITERATIONS']   PBKDF2PasswordHasher, PBKDF2SHA1PasswordHasher
+    USERS['ARGON2_TIME_COST']    Argon2PasswordHasher
+    USERS['ARGON2_MEMORY_COST']  Argon2PasswordHasher, in KiB
+    USERS['BCRYPT_ROUNDS']       BCryptSHA256PasswordHasher, BCryptPasswordHasher
+
+None keeps Django's default. Algorithms and hash formats are Django's, so
+existing hashes still verify, and once a work factor changes passwords are
+rehashed with it on their next login.
+
+See `./manage.py calibrate_hashers` for picking them on the current host.
+"""
+from django.contrib.auth import hashers
+
+from users.conf import users_setting
+
+
+class SettingsWorkFactorMixin:
+    # Hasher attribute -> USERS setting
+    work_factors = {}
+
+    def __init__(self, **work_factors):
+        # Instance attributes rather than properties reading settings, so
+        # hashers still pickle to HashingPool's worker processes as they are
+        for attribute, setting in self.work_factors.items():
+            value = work_factors.get(attribute, users_setting(setting))
+            if value is not None:
+                setattr(self, attribute, value)
+
+
+class PBKDF2PasswordHasher(SettingsWorkFactorMixin, hashers.PBKDF2PasswordHasher):
+    work_factors = {'iterations': 'PBKDF2_ITERATIONS'}
+
+
+class PBKDF2SHA1PasswordHasher(SettingsWorkFactorMixin, hashers.PBKDF2SHA1PasswordHasher):
+    work_factors = {'iterations': 'PBKDF2_ITERATIONS'}
+
+
+class Argon2PasswordHasher(SettingsWorkFactorMixin, hashers.Argon2PasswordHasher):
+    work_factors = {'time_cost': 'ARGON2_TIME_COST', 'memory_cost': 'ARGON2_MEMORY_COST'}
+
+
+class BCryptSHA256PasswordHasher(SettingsWorkFactorMixin, hashers.BCryptSHA256PasswordHasher):
+    work_factors = {'rounds': 'BCRYPT_ROUNDS'}
+
+
+class BCryptPasswordHasher(SettingsWorkFactorMixin, hashers.BCryptPasswordHasher):
+    work_factors = {'rounds': 'BCRYPT_ROUNDS'}
@@ -0,0 +1,157 @@
+"""Password hashing off the request thread, in a bounded pool.
+
+Password hashers are slow on purpose. Under ASGI Django runs every sync
+view on one shared thread, so a burst of logins hashing there holds up all
+other sync requests in the process. The async views in users.views hash
+through HashingPool instead:
+
+    USERS['HASHING_EXECUTOR']     "process" (default, no GIL contention) or "thread"
+    USERS['HASHING_WORKERS']      pool size, defaults to the number of CPUs
+    USERS['HASHING_MAX_PENDING']  hashes running or waiting before new ones
+                                  raise HashingPoolBusy, which views answer
+                                  with a 503 straight away
+
+See `./manage.py benchmark_logins`.
+"""
+import asyncio
+import multiprocessing
+import threading
+
+from asgiref.sync import sync_to_async
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import authenticate as sync_authenticate, get_user_model, user_login_failed
+from django.contrib.auth.hashers import get_hasher, identify_hasher, is_password_usable
+
+from users.conf import users_setting
+from utils import metrics
+
+
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class HashingPoolBusy(Exception):
+    pass
+
+
+class HashingPool:
+
+    def __init__(self, executor='process', workers=None, max_pending=32):
+        assert executor in ('process', 'thread'), f"Unknown hashing executor: {executor}"
+        self.executor_type = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    async def check_password(self, password, encoded):
+        """Same as django.contrib.auth.hashers.check_password, minus the setter, see must_update."""
+        if password is None or not is_password_usable(encoded):
+            return False
+        try:
+            hasher = identify_hasher(encoded)
+        except ValueError:
+            return False
+        # Same as check_password, a wrong password for an outdated hash takes
+        # as long as it would for an up to date one
+        preferred = get_hasher('default')
+        harden = hasher.algorithm == preferred.algorithm and preferred.must_update(encoded)
+        # Hashers are plain objects, so they pickle fine to worker processes
+        return await self.run(_check, hasher, password, encoded, harden)
+
+    async def make_password(self, password):
+        """Same as django.contrib.auth.hashers.make_password, for a usable password."""
+        hasher = get_hasher('default')
+        return await self.run(_encode, hasher, password, hasher.salt())
+
+    async def run(self, fn, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                metrics.increment('users.hashing.rejected')
+                raise HashingPoolBusy()
+            self.pending += 1
+            if self.executor is None:
+                self.executor = self._make_executor()
+        try:
+            return await asyncio.wrap_future(self.executor.submit(fn, *args))
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _make_executor(self):
+        if self.executor_type == 'thread':
+            return ThreadPoolExecutor(self.workers, thread_name_prefix='password-hashing')
+        # Forking a process with an event loop and threads running isn't safe
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_hashing_pool():
+    """Returns this process' HashingPool for the current USERS settings."""
+    key = (users_setting('HASHING_EXECUTOR'), users_setting('HASHING_WORKERS'), users_setting('HASHING_MAX_PENDING'))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = HashingPool(*key)
+        return _pools[key]
+
+
+def must_update(encoded):
+    """Whether a password hashed as `encoded` should be hashed again with the preferred hasher."""
+    preferred = get_hasher('default')
+    return identify_hasher(encoded).algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+async def authenticate(request, email, password):
+    """django.contrib.auth.authenticate for email and password, hashing in the pool.
+
+    Does what ModelBackend does: checks the password, rehashes it when the
+    hasher settings changed, and refuses inactive users. Other backends
+    can't be run like this, so with ModelBackend not configured it falls
+    back to authenticate() on Django's sync thread.
+
+    Raises HashingPoolBusy when the pool is full.
+    """
+    if MODEL_BACKEND not in settings.AUTHENTICATION_BACKENDS:
+        return await sync_to_async(sync_authenticate)(request, email=email, password=password)
+
+    pool = get_hashing_pool()
+    User = get_user_model()
+    user = await sync_to_async(User._default_manager.filter(**{User.USERNAME_FIELD: email}).first)()
+    if user is None:
+        # Hash anyway, so how long this takes doesn't tell whether the email exists
+        await pool.make_password(password)
+    elif await pool.check_password(password, user.password) and user.is_active:
+        if must_update(user.password):
+            user.password = await pool.make_password(password)
+            await sync_to_async(user.save)(update_fields=['password'])
+        user.backend = MODEL_BACKEND
+        return user
+
+    await sync_to_async(user_login_failed.send)(
+        sender=__name__,
+        credentials={User.USERNAME_FIELD: email, 'password': '********************'},
+        request=request,
+    )
+    return None
+
+
+# These run in the pool, where Django's settings may not be configured
+
+
+def _check(hasher, password, encoded, harden):
+    is_correct = hasher.verify(password, encoded)
+    if not is_correct and harden:
+        hasher.harden_runtime(password, encoded)
+    return is_correct
+
+
+def _encode(hasher, password, salt):
+    return hasher.encode(password, salt)
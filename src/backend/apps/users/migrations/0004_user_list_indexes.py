@@ -0,0 +1,29 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently so big tables stay writable meanwhile
+    atomic = False
+
+    dependencies = [
+        ('users', '0003_user_version'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(fields=['is_active', 'id'], name='users_user_active_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(condition=models.Q(is_staff=True), fields=['id'], name='users_user_staff_id_idx'),
+        ),
+        # Django 3.2 can't give expression indexes an opclass, and LIKE
+        # prefixes need text_pattern_ops unless the database uses the C locale
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_email_prefix_idx '
+            'ON users_user (lower(email::text) text_pattern_ops)',
+            'DROP INDEX CONCURRENTLY IF EXISTS users_user_email_prefix_idx',
+        ),
+    ]
@@ -0,0 +1,30 @@
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently so big tables stay writable meanwhile
+    atomic = False
+
+    dependencies = [
+        ('users', '0004_user_list_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        AddIndexConcurrently(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['first_name'], name='users_user_first_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['last_name'], name='users_user_last_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        # gin_trgm_ops is for text, not citext, so this one is on email::text
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_email_trgm_idx '
+            'ON users_user USING gin ((email::text) gin_trgm_ops)',
+            'DROP INDEX CONCURRENTLY IF EXISTS users_user_email_trgm_idx',
+        ),
+    ]
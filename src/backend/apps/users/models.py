@@ -1,5 +1,6 @@
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.postgres.fields import CIEmailField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 
@@ -7,12 +8,16 @@ from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 class CustomUserManager(BaseUserManager):
     use_in_migrations = True
 
-    def _create_user(self, email, password, **extra_fields):
+    def _create_user(self, email, password, password_hash=None, **extra_fields):
         if not email:
             raise ValueError('The given email must be set')
         email = self.normalize_email(email)
         user = self.model(email=email, **extra_fields)
-        user.set_password(password)
+        if password_hash is None:
+            user.set_password(password)
+        else:
+            # Already hashed by users.hashing, off the request thread
+            user.password = password_hash
         user.save(using=self._db)
         return user
 
@@ -45,8 +50,32 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
+    # Bumped on every save(), for ETags. Queryset .update()s have to bump it themselves
+    version = models.PositiveIntegerField(default=1, editable=False)
 
     objects = CustomUserManager()
 
+    class Meta:
+        indexes = [
+            # For UserListView, which pages through users by id
+            models.Index(fields=['is_active', 'id'], name='users_user_active_id_idx'),
+            models.Index(fields=['id'], condition=models.Q(is_staff=True), name='users_user_staff_id_idx'),
+            # Also users_user_email_prefix_idx, on lower(email) in 0004_user_list_indexes
+            # For users.search, with users_user_email_trgm_idx in 0005_user_search_indexes
+            GinIndex(fields=['first_name'], opclasses=['gin_trgm_ops'], name='users_user_first_name_trgm_idx'),
+            GinIndex(fields=['last_name'], opclasses=['gin_trgm_ops'], name='users_user_last_name_trgm_idx'),
+        ]
+
     def __str__(self):
         return self.email
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+
+    @property
+    def etag(self):
+        return f'"{self.pk}-{self.version}"'
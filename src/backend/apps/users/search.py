@@ -0,0 +1,62 @@
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import CharField, Lookup, Q, TextField
+from django.db.models.functions import Cast, Greatest
+from django.utils.text import smart_split, unescape_string_literal
+
+
+# Columns the users_user_*_trgm_idx indexes from 0005_user_search_indexes
+# are on. email is citext, its index is on email::text
+SEARCH_FIELDS = ('first_name', 'last_name', 'email_text')
+
+
+@CharField.register_lookup
+@TextField.register_lookup
+class TrigramContains(Lookup):
+    """`field::text ILIKE '%value%'`, which gin_trgm_ops indexes can answer.
+
+    Django's icontains is `UPPER(field::text) LIKE UPPER(...)` instead,
+    which no trigram index on the column matches.
+    """
+    lookup_name = 'trigram_contains'
+
+    def process_rhs(self, qn, connection):
+        rhs, params = super().process_rhs(qn, connection)
+        return rhs, [f'%{connection.ops.prep_for_like_query(param)}%' for param in params]
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs}::text ILIKE {rhs}', lhs_params + rhs_params
+
+
+def annotate_search(queryset):
+    """Adds the email_text annotation filter_search needs."""
+    return queryset.annotate(email_text=Cast('email', TextField()))
+
+
+def filter_search(queryset, term):
+    """Users where every word of `term` is in their name or email, like the admin's search_fields.
+
+    Words under 3 letters have no trigrams, they still match but read the
+    whole index.
+    """
+    for word in smart_split(term):
+        if word.startswith(('"', "'")) and word[0] == word[-1]:
+            word = unescape_string_literal(word)
+        queryset = queryset.filter(
+            Q(*[(f'{field}__trigram_contains', word) for field in SEARCH_FIELDS], _connector=Q.OR)
+        )
+    return queryset
+
+
+def annotate_rank(queryset, term):
+    """Adds search_rank, the best trigram similarity of `term` to a user's name or email."""
+    return queryset.annotate(
+        search_rank=Greatest(*[TrigramSimilarity(field, term) for field in SEARCH_FIELDS]),
+    )
+
+
+def search_users(queryset, term):
+    """Users matching `term`, best matches first."""
+    queryset = annotate_search(queryset)
+    return annotate_rank(filter_search(queryset, term), term).order_by('-search_rank', '-id')
@@ -1,5 +1,5 @@
 from dj_rest_auth.serializers import PasswordResetSerializer
-from django.contrib.auth import get_user_model, authenticate
+from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import PasswordResetForm
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
@@ -64,27 +64,25 @@ class UserSerializer(serializers.ModelSerializer):
             user.save()
             
         return user
+
+
+class UserListSerializer(serializers.ModelSerializer):
+    """Read only users for UserListView"""
+
+    class Meta:
+        model = User
+        fields = ('id', 'email', 'first_name', 'last_name', 'date_joined', 'is_active', 'is_staff')
+        read_only_fields = fields
+
+
 class AuthTokenSerializer(serializers.Serializer):
-    """Serializer for the user authentication object"""
+    """Serializer for the user authentication object
+
+    Only checks the fields are there, CreateTokenView checks the password
+    off the request thread with users.hashing.authenticate.
+    """
     email = serializers.CharField()
     password = serializers.CharField(
         style={'input_type': 'password'},
         trim_whitespace=False
     )
-
-    def validate(self, attrs):
-        """Validate and authenticate user"""
-        email = attrs.get('email')
-        password = attrs.get('password')
-
-        user = authenticate(
-            request=self.context.get('request'),
-            username=email,
-            password=password
-        )
-        if not user:
-            msg = ('Unable to authenticate with provided credentials')
-            raise serializers.ValidationError(msg, code='authentication')
-
-        attrs['user'] = user
-        return attrs
\ No newline at end of file
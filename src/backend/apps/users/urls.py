@@ -1,10 +1,12 @@
 from django.urls import path
 
-from users.views import CreateUserView, CreateTokenView, ManageUserView
+from users.views import CreateUserView, CreateTokenView, ManageUserView, UserListView, UserSearchView
 
 app_name = 'users'
 
 urlpatterns = [
+    path('', UserListView.as_view(), name='list'),
+    path('search/', UserSearchView.as_view(), name='search'),
     path('create/', CreateUserView.as_view(), name='create'),
     path('token/', CreateTokenView.as_view(), name='token'),
     path('me/', ManageUserView.as_view(), name='me'),
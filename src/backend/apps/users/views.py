@@ -1,59 +1,247 @@
-from django.contrib.auth import authenticate, login
-from rest_framework.authtoken.views import ObtainAuthToken
+import asyncio
+
+from asgiref.sync import sync_to_async
+from functools import update_wrapper
+from django.contrib.auth import SESSION_KEY, get_user_model, login
+from django.db import transaction
+from django.utils.cache import parse_etags
+from django.utils.decorators import classonlymethod
+from django.views import View
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.pagination import CursorPagination
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
 from rest_framework.settings import api_settings
-from rest_framework import views, status, generics, authentication, permissions
-from rest_framework.exceptions import ValidationError
-from rest_framework.permissions import AllowAny
+from rest_framework import status, generics, permissions
 from rest_framework.response import Response
 
-from users.serializers import LoginSerializer, UserSerializer, AuthTokenSerializer
+from users.authentication import CachedTokenAuthentication
+from users.filters import filter_users
+from users.hashing import HashingPoolBusy, authenticate, get_hashing_pool
+from users.search import search_users
+from users.serializers import LoginSerializer, UserSerializer, UserListSerializer, AuthTokenSerializer
+
+
+class AsyncAPIView(View):
+    """Async view that takes and answers requests like a DRF APIView.
+
+    DRF views can't be async, and under ASGI every sync view shares one
+    thread. Views hashing passwords use this instead, so the hashing happens
+    in users.hashing's pool while the event loop and that thread stay free.
+
+    Subclasses implement `async def post(self, request)`, reading the body
+    with `self.get_data(request)` and returning `self.respond(...)`.
+    Like APIView, requests aren't CSRF checked unless they come from a
+    logged in session.
+    """
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        # Django 3.2 only runs views as async when they're coroutine functions
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+
+        update_wrapper(async_view, view)
+        # Not csrf_exempt(), its wrapper would be sync again
+        async_view.csrf_exempt = True
+        return async_view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            await sync_to_async(self.enforce_csrf)(request)
+            response = super().dispatch(request, *args, **kwargs)
+            # options() and http_method_not_allowed() aren't async
+            return await response if asyncio.iscoroutine(response) else response
+        except HashingPoolBusy:
+            response = self.respond(
+                {"detail": "Too many logins at once, try again in a moment."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+            response['Retry-After'] = '1'
+            return response
+        except APIException as e:
+            return self.respond({"detail": e.detail}, status=e.status_code)
+
+    def enforce_csrf(self, request):
+        if request.session.get(SESSION_KEY):
+            SessionAuthentication().enforce_csrf(request)
+
+    def get_data(self, request):
+        """Returns the parsed request body, same as APIView's request.data."""
+        return Request(request, parsers=[parser() for parser in self.parser_classes]).data
+
+    def respond(self, data=None, status=status.HTTP_200_OK):
+        response = Response(data, status=status)
+        response.accepted_renderer = JSONRenderer()
+        response.accepted_media_type = JSONRenderer.media_type
+        response.renderer_context = {}
+        return response.render()
+
+    def http_method_not_allowed(self, request, *args, **kwargs):
+        response = self.respond(
+            {"detail": f'Method "{request.method}" not allowed.'},
+            status=status.HTTP_405_METHOD_NOT_ALLOWED,
+        )
+        response['Allow'] = ', '.join(self._allowed_methods())
+        return response
 
 
 # TODO: Add to api docs ??
-class LoginView(views.APIView):
-    permission_classes = [AllowAny]
-    serializer_class = LoginSerializer
+class LoginView(AsyncAPIView):
 
-    def post(self, request, format=None):
-        serializer = self.serializer_class(data=self.request.data, context={'request': request})
-        serializer.is_valid(raise_exception=True)
+    async def post(self, request):
+        serializer = LoginSerializer(data=self.get_data(request), context={'request': request})
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        user = authenticate(
-            email=serializer.validated_data.get('email'),
-            password=serializer.validated_data.get('password')
+        user = await authenticate(
+            request,
+            serializer.validated_data.get('email'),
+            serializer.validated_data.get('password')
         )
 
         if user is not None:
-            # Set expiry (in seconds) BEFORE inactivity logs you out.
-            if serializer.validated_data['remember_me']:
-                expiry = 60 * 60 * 24 * 7 * 2  # 2 weeks
-            else:
-                expiry = 0  # Session only cookie
-            request.session.set_expiry(expiry)  # set_expiry must be called before login!
-
-            login(request, user)
+            await sync_to_async(self.login)(request, user, serializer.validated_data['remember_me'])
+            return self.respond(status=status.HTTP_200_OK)
+        else:
+            return self.respond({"non_field_errors": ["Incorrect login information."]}, status=status.HTTP_400_BAD_REQUEST)
 
-            return Response(status=status.HTTP_200_OK)
+    def login(self, request, user, remember_me):
+        # Set expiry (in seconds) BEFORE inactivity logs you out.
+        if remember_me:
+            expiry = 60 * 60 * 24 * 7 * 2  # 2 weeks
         else:
-            raise ValidationError({"non_field_errors": ["Incorrect login information."]})
+            expiry = 0  # Session only cookie
+        request.session.set_expiry(expiry)  # set_expiry must be called before login!
 
-class CreateUserView(generics.CreateAPIView):
+        login(request, user)
+
+
+class CreateUserView(AsyncAPIView):
     """Create a new user in the system"""
-    permission_classes = [AllowAny]
-    serializer_class = UserSerializer
 
-class CreateTokenView(ObtainAuthToken):
+    async def post(self, request):
+        serializer = UserSerializer(data=self.get_data(request), context={'request': request})
+        if not await sync_to_async(serializer.is_valid)():
+            return self.respond(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        password_hash = await get_hashing_pool().make_password(serializer.validated_data['password'])
+        await sync_to_async(serializer.save)(password_hash=password_hash)
+        return self.respond(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class CreateTokenView(AsyncAPIView):
     """Create a new auth token for user"""
-    serializer_class = AuthTokenSerializer
-    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+
+    async def post(self, request):
+        serializer = AuthTokenSerializer(data=self.get_data(request), context={'request': request})
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        user = await authenticate(request, serializer.validated_data['email'], serializer.validated_data['password'])
+        if not user:
+            return self.respond(
+                {"non_field_errors": ["Unable to authenticate with provided credentials"]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        token, created = await sync_to_async(Token.objects.get_or_create)(user=user)
+        return self.respond({'token': token.key})
 
 
 class ManageUserView(generics.RetrieveUpdateAPIView):
-    """Manage the authenticated user"""
+    """Manage the authenticated user
+
+    Responses carry the user's ETag. GETs with a matching If-None-Match get
+    a 304 without serializing the user, and updates with an If-Match that
+    doesn't match the user's current version get a 412.
+    """
     serializer_class = UserSerializer
-    authentication_classes = (authentication.TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_object(self):
         """Retrieve and return authenticated user"""
         return self.request.user
+
+    def retrieve(self, request, *args, **kwargs):
+        user = self.get_object()
+        if etag_matches(user, request.headers.get('If-None-Match')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(self.get_serializer(user).data)
+        response['ETag'] = user.etag
+        return response
+
+    def update(self, request, *args, **kwargs):
+        with transaction.atomic():
+            # request.user may come from the token cache, check against the row
+            user = get_user_model().objects.select_for_update().get(pk=request.user.pk)
+            if_match = request.headers.get('If-Match')
+            if if_match is not None and not etag_matches(user, if_match):
+                return Response(
+                    {"detail": "The user has changed since it was fetched."},
+                    status=status.HTTP_412_PRECONDITION_FAILED,
+                    headers={'ETag': user.etag},
+                )
+
+            serializer = self.get_serializer(user, data=request.data, partial=kwargs.pop('partial', False))
+            serializer.is_valid(raise_exception=True)
+            self.perform_update(serializer)
+
+        return Response(serializer.data, headers={'ETag': serializer.instance.etag})
+
+
+class UserPagination(CursorPagination):
+    """Pages by id, so every page is an index range scan without OFFSET or COUNT(*)"""
+    ordering = '-id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class UserListView(generics.ListAPIView):
+    """List users for staff, newest first, filtered with users.filters.filter_users"""
+    serializer_class = UserListSerializer
+    pagination_class = UserPagination
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get_queryset(self):
+        return filter_users(get_user_model().objects.all(), self.request.query_params)
+
+
+class UserSearchView(generics.ListAPIView):
+    """Search users by name and email for staff, best matches first
+
+    Takes the search in `q` and returns up to `limit` (default 20, at most
+    100) users, ranked by trigram similarity.
+    """
+    serializer_class = UserListSerializer
+    pagination_class = None
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (permissions.IsAdminUser,)
+    max_limit = 100
+
+    def get_queryset(self):
+        params = self.request.query_params
+        if not params.get('q', '').strip():
+            raise ValidationError({'q': ["This field is required."]})
+        try:
+            limit = min(max(int(params.get('limit', 20)), 1), self.max_limit)
+        except ValueError:
+            raise ValidationError({'limit': ["A valid integer is required."]})
+        return search_users(get_user_model().objects.all(), params['q'])[:limit]
+
+
+def etag_matches(user, header):
+    """Whether an If-Match/If-None-Match header lists the user's ETag."""
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or user.etag in etags
@@ -0,0 +1,33 @@
+"""Process-local counters for things we want to keep an eye on.
+
+These reset when the process restarts and aren't shared between workers,
+they're meant to be read from a shell, a health check or a benchmark.
+"""
+import threading
+
+from collections import Counter
+
+
+_counts = Counter()
+_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counts[name] += amount
+
+
+def get_count(name):
+    return _counts[name]
+
+
+def get_counts(prefix=''):
+    """Returns all counters whose name starts with `prefix`."""
+    with _lock:
+        return {name: count for name, count in _counts.items() if name.startswith(prefix)}
+
+
+def reset_counts(prefix=''):
+    with _lock:
+        for name in [name for name in _counts if name.startswith(prefix)]:
+            del _counts[name]
@@ -8,14 +8,20 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings.base')
 asgi_application = get_asgi_application()
 
-from channels.auth import AuthMiddlewareStack
-from realtime.consumers import RealtimeConsumer
+from realtime.auth import CachedAuthMiddlewareStack
+from realtime.consumers import RealtimeConsumer, RealtimeEventStreamConsumer
+from users.consumers import UserExportConsumer
 
 
 application = ProtocolTypeRouter({
-    "http": asgi_application,
+    "http": URLRouter([
+        # Only these consumers need the user here, Django does its own auth
+        url(r"^events/$", CachedAuthMiddlewareStack(RealtimeEventStreamConsumer.as_asgi())),
+        url(r"^api/users/export/$", CachedAuthMiddlewareStack(UserExportConsumer.as_asgi())),
+        url(r"", asgi_application),
+    ]),
 
-    "websocket": AuthMiddlewareStack(
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter([
             url(r"^ws/$", RealtimeConsumer.as_asgi()),
         ])
@@ -45,6 +45,7 @@ THIRD_PARTY_APPS = (
 OUR_APPS = (
     'users',
     'commands',
+    'realtime',
 )
 INSTALLED_APPS = THIRD_PARTY_APPS + OUR_APPS
 
@@ -146,6 +147,14 @@ CORS_ALLOW_CREDENTIALS = True
 
 SESSION_COOKIE_HTTPONLY = True
 
+# Django's, with work factors from USERS below
+PASSWORD_HASHERS = (
+    'users.hashers.PBKDF2PasswordHasher',
+    'users.hashers.PBKDF2SHA1PasswordHasher',
+    'users.hashers.Argon2PasswordHasher',
+    'users.hashers.BCryptSHA256PasswordHasher',
+)
+
 
 # =============================================================================
 # Storage
@@ -206,7 +215,8 @@ TEMPLATED_EMAIL_FILE_EXTENSION = 'html'  # for nice highlighting, instead of .em
 # ============================================================================
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # Adds group_send_many, for sending to lots of rooms in a few round trips
+        'BACKEND': 'realtime.layers.RealtimeRedisChannelLayer',
         'CONFIG': {
             "hosts": [os.environ.get('REDIS_URL', 'redis://redis:6379')],
         },
@@ -214,6 +224,129 @@ CHANNEL_LAYERS = {
 }
 
 
+# ============================================================================
+# Realtime
+# ============================================================================
+REALTIME = {
+    # Seconds to hold updates for, so repeats of the same commit to a socket
+    # collapse into one frame. None sends every update right away.
+    'COALESCE_WINDOW': None,
+    # "latest" only sends the newest update per commit, "batch" sends every
+    # update from the window together in one frame
+    'COALESCE_MODE': 'latest',
+    # Frames each socket can have waiting before SEND_QUEUE_POLICY kicks in,
+    # one of "drop_oldest", "coalesce" (by commit) or "disconnect"
+    'SEND_QUEUE_SIZE': 100,
+    'SEND_QUEUE_POLICY': 'drop_oldest',
+    # Close code used when the "disconnect" policy hangs up on a slow socket
+    'SEND_QUEUE_CLOSE_CODE': 4008,
+    # How many recent updates (and for how many seconds) each room keeps, so
+    # reconnecting sockets can catch up instead of refetching. None turns it
+    # off. REPLAY_CACHE must be shared between workers, i.e. Redis. Sockets
+    # that missed more than SEND_QUEUE_SIZE updates are told to resync.
+    'REPLAY_BUFFER_SIZE': None,
+    'REPLAY_BUFFER_TTL': 60,
+    'REPLAY_CACHE': 'default',
+    # RPC calls each socket runs at once, how many more frames of calls can
+    # wait behind those, and how many calls fit in one batch frame
+    'RPC_MAX_CONCURRENCY': 4,
+    'RPC_MAX_PENDING': 32,
+    'RPC_MAX_BATCH_SIZE': 20,
+    # Sockets share one channel layer subscription per room per process,
+    # instead of each socket being its own group member
+    'MULTIPLEX': True,
+    # Topics (see realtime.topics) each socket can subscribe to at once
+    'MAX_TOPICS': 20,
+    # realtime.publisher.Publisher sends what sync code queued this often (in
+    # seconds), or sooner once this many updates are waiting
+    'PUBLISHER_FLUSH_INTERVAL': 0.01,
+    'PUBLISHER_MAX_BATCH_SIZE': 500,
+    # Seconds websocket connects can reuse a cached session and user instead
+    # of reading both from the database, None always reads them. Like
+    # REPLAY_CACHE, AUTH_CACHE must be shared between workers so logouts and
+    # password changes reach all of them.
+    'AUTH_CACHE_TTL': None,
+    'AUTH_CACHE': 'default',
+    # Seconds between pings to each socket, and without hearing anything back
+    # (pongs included) before it's reaped. None turns either off.
+    'HEARTBEAT_INTERVAL': 30,
+    'IDLE_TIMEOUT': 75,
+    # Seconds a socket may stay open before it's reaped so it reconnects,
+    # randomly moved by up to this fraction of it. None never reaps.
+    'MAX_LIFETIME': None,
+    'MAX_LIFETIME_JITTER': 0.1,
+    # Close code reaped sockets get
+    'REAP_CLOSE_CODE': 4009,
+    # Connected sockets forget their scope (user, session, headers...) to
+    # save memory, RPC calls and subscribes then fetch the user each time
+    'LEAN_CONNECTIONS': False,
+    # Whether sockets may use permessage-deflate, and the frame size in bytes
+    # below which frames go uncompressed anyway. Only applies when served
+    # with `./manage.py serve`, see realtime.compression.
+    'COMPRESSION': True,
+    'COMPRESSION_THRESHOLD': 256,
+    # How long rooms remember the last document sent with `delta=True`, and
+    # the cache it's kept in, see realtime.deltas. Like REPLAY_CACHE it has
+    # to be shared between processes.
+    'DELTA_TTL': 60 * 60,
+    'DELTA_CACHE': 'default',
+    # Limits on what each socket may send us. Frames over MAX_FRAME_SIZE
+    # characters aren't parsed at all, and beyond RECEIVE_BURST frames /
+    # RECEIVE_BYTE_BURST characters sockets get RECEIVE_RATE frames and
+    # RECEIVE_BYTE_RATE characters a second (None turns a limit off). Past
+    # that frames are dropped ("drop"), or the socket is closed with
+    # RECEIVE_LIMIT_CLOSE_CODE ("disconnect").
+    'MAX_FRAME_SIZE': 64 * 1024,
+    'RECEIVE_RATE': 10,
+    'RECEIVE_BURST': 50,
+    'RECEIVE_BYTE_RATE': 64 * 1024,
+    'RECEIVE_BYTE_BURST': 256 * 1024,
+    'RECEIVE_LIMIT_POLICY': 'drop',
+    'RECEIVE_LIMIT_CLOSE_CODE': 4029,
+}
+
+
+# =============================================================================
+# Users
+# =============================================================================
+USERS = {
+    # Passwords are hashed off the event loop, by a pool of "process"es or
+    # "thread"s (threads only help with hashers releasing the GIL, like
+    # argon2 and bcrypt), HASHING_WORKERS of them (None: one per CPU). When
+    # HASHING_MAX_PENDING hashes are already waiting, logins get a 503.
+    'HASHING_EXECUTOR': 'process',
+    'HASHING_WORKERS': None,
+    'HASHING_MAX_PENDING': 32,
+    # Password hasher work factors, unset keeps Django's. Pick them per dyno
+    # size with `./manage.py calibrate_hashers`, passwords hashed with other
+    # ones are rehashed on their next login.
+    'PBKDF2_ITERATIONS': int(os.environ.get('PBKDF2_ITERATIONS', 0)) or None,
+    'ARGON2_TIME_COST': int(os.environ.get('ARGON2_TIME_COST', 0)) or None,
+    'ARGON2_MEMORY_COST': int(os.environ.get('ARGON2_MEMORY_COST', 0)) or None,
+    'BCRYPT_ROUNDS': int(os.environ.get('BCRYPT_ROUNDS', 0)) or None,
+    # Seconds CachedTokenAuthentication may reuse a token lookup (None for
+    # every request to read Postgres), in a LRU of TOKEN_CACHE_SIZE tokens per
+    # process and, if set, the TOKEN_CACHE Django cache shared between them.
+    # Deleted tokens and changed users are forgotten in this process and
+    # TOKEN_CACHE at once, in other processes' LRUs after TOKEN_CACHE_TTL,
+    # so a revoked token keeps working that long. Off unless set.
+    'TOKEN_CACHE_TTL': int(os.environ.get('TOKEN_CACHE_TTL', 0)) or None,
+    'TOKEN_CACHE_SIZE': 10_000,
+    'TOKEN_CACHE': None,
+    # From ADMIN_LARGE_TABLE_ROWS users (None: never) the user admin's
+    # changelist shows estimated counts and pages by id. Its group filter
+    # lists ADMIN_GROUP_CHOICES groups at most.
+    'ADMIN_LARGE_TABLE_ROWS': 100_000,
+    'ADMIN_GROUP_CHOICES': 50,
+    # The user admin's bulk actions update BULK_ACTION_CHUNK_SIZE users per
+    # transaction, on BULK_ACTION_WORKERS background threads, see users.bulk.
+    'BULK_ACTION_CHUNK_SIZE': 1000,
+    'BULK_ACTION_WORKERS': 1,
+    # User exports fetch and send EXPORT_CHUNK_SIZE rows at a time, see users.export.
+    'EXPORT_CHUNK_SIZE': 2000,
+}
+
+
 # =============================================================================
 # Logging
 # =============================================================================
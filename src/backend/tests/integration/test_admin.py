@@ -1,7 +1,17 @@
 from django.urls import reverse
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import caches
+import threading
 
-from tests.utils import CkcAPITestCase, CkcAPIClient
+from concurrent.futures import Future
+from django.test import override_settings
+from unittest.mock import patch
+
+from users.admin import CustomUserAdmin
+from users.bulk import COMMIT, BulkAction
+
+from tests.utils import CkcAPITestCase, CkcAPIClient, CkcAPITransactionTestCase
 
 
 class AdminSiteTests(CkcAPITestCase):
@@ -40,4 +50,168 @@ class AdminSiteTests(CkcAPITestCase):
 
     def test_user_creation_page_works(self):
         resp = self.client.get(reverse('admin:users_user_add'))
-        assert resp.status_code == 200
\ No newline at end of file
+        assert resp.status_code == 200
+
+    def test_search_ranks_best_matches_first(self):
+        """Test the changelist searches through users.search, best matches first"""
+        other = get_user_model().objects.create_user(
+            first_name='Administrator', last_name='Other', email='someone@testing.com', password='Password1!'
+        )
+        res = self.client.get(reverse('admin:users_user_changelist'), {'q': 'admin'})
+        users = list(res.context['cl'].result_list)
+        self.assertEqual(users[:2], [self.user, self.admin_user])
+        self.assertIn(other, users)
+
+        res = self.client.get(reverse('admin:users_user_changelist'), {'q': 'admin other'})
+        self.assertEqual(list(res.context['cl'].result_list), [other])
+
+        res = self.client.get(reverse('admin:users_user_changelist'), {'q': 'admin', 'o': '1'})
+        self.assertEqual(res.status_code, 200)
+
+    def test_group_filter(self):
+        group = Group.objects.create(name='editors')
+        self.user.groups.add(group)
+        url = reverse('admin:users_user_changelist')
+        res = self.client.get(url)
+        self.assertContains(res, 'editors')
+
+        res = self.client.get(url, {'group': group.pk})
+        self.assertEqual(list(res.context['cl'].result_list), [self.user])
+
+        res = self.client.get(url, {'group': 'nope'})
+        self.assertRedirects(res, f'{url}?e=1')
+
+
+@override_settings(USERS={'ADMIN_LARGE_TABLE_ROWS': 0})
+@patch.object(CustomUserAdmin, 'list_per_page', 2)
+class LargeTableAdminTests(CkcAPITestCase):
+    """Test the user changelist pages by id and doesn't count users once the table is large"""
+
+    def setUp(self):
+        self.client = CkcAPIClient()
+        self.admin_user = get_user_model().objects.create_superuser(email='admin@test.com', password='Password1!')
+        self.client.force_login(self.admin_user)
+        self.users = [self.admin_user] + [
+            get_user_model().objects.create_user(email=f'user{i}@test.com', password='Password1!')
+            for i in range(3)
+        ]
+        self.url = reverse('admin:users_user_changelist')
+
+    def test_keyset_pages(self):
+        seen = []
+        url = self.url
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            cl = res.context['cl']
+            self.assertTrue(cl.keyset)
+            self.assertIsNone(cl.full_result_count)
+            seen += list(cl.result_list)
+            url = cl.next_page_url and f'{self.url}{cl.next_page_url}'
+        self.assertEqual(seen, self.users)
+        self.assertContains(res, 'First page')
+
+    def test_sorted_by_column_uses_estimated_counts(self):
+        res = self.client.get(self.url, {'o': '1'})
+        cl = res.context['cl']
+        self.assertFalse(cl.keyset)
+        self.assertEqual(len(cl.result_list), 2)
+        self.assertIsNone(cl.full_result_count)
+
+    def test_bad_cursor(self):
+        res = self.client.get(self.url, {'after': 'nope'})
+        self.assertRedirects(res, f'{self.url}?e=1')
+
+
+class WaitingExecutor:
+    """Runs bulk actions on a thread of their own, and waits for them to finish"""
+
+    def submit(self, fn, *args):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return future
+
+
+@patch('users.bulk.get_bulk_executor', WaitingExecutor)
+@patch('users.bulk.get_publisher')
+class BulkActionTests(CkcAPITransactionTestCase):
+    """Test bulk actions on users run in chunks and report their progress"""
+
+    def setUp(self):
+        self.client = CkcAPIClient()
+        self.admin_user = get_user_model().objects.create_superuser(email='admin@test.com', password='Password1!')
+        self.client.force_login(self.admin_user)
+        self.users = [
+            get_user_model().objects.create_user(email=f'user{i}@test.com', password='Password1!')
+            for i in range(5)
+        ]
+        self.group = Group.objects.create(name='editors')
+
+    def progress(self, get_publisher):
+        for call in get_publisher.return_value.publish.call_args_list:
+            self.assertEqual(call.args[0], f'user_socket_{self.admin_user.pk}')
+            self.assertEqual(call.kwargs['commit'], COMMIT)
+        return [call.args[1] for call in get_publisher.return_value.publish.call_args_list]
+
+    def test_deactivate_in_chunks(self, get_publisher):
+        queryset = get_user_model().objects.exclude(pk=self.admin_user.pk)
+        with patch('users.bulk.forget_tokens_for_users') as forget:
+            BulkAction(self.admin_user.pk, 'deactivate', queryset, chunk_size=2).start().result()
+
+        self.assertFalse(queryset.filter(is_active=True).exists())
+        self.assertTrue(get_user_model().objects.get(pk=self.admin_user.pk).is_active)
+        self.assertEqual(self.users[0].version + 1, queryset.get(pk=self.users[0].pk).version)
+        self.assertEqual([call.args[0] for call in forget.call_args_list], [
+            [user.pk for user in self.users[:2]], [user.pk for user in self.users[2:4]], [self.users[4].pk],
+        ])
+        self.assertEqual(
+            [(progress['done'], progress['total'], progress['finished']) for progress in self.progress(get_publisher)],
+            [(2, 5, False), (4, 5, False), (5, 5, False), (5, 5, True)],
+        )
+
+    def test_deactivate_forgets_realtime_logins(self, get_publisher):
+        cache = caches['default']
+        cache.set_many({f'realtime_auth:user:{user.pk}': user for user in self.users})
+
+        queryset = get_user_model().objects.filter(pk__in=[user.pk for user in self.users[:3]])
+        BulkAction(self.admin_user.pk, 'deactivate', queryset, chunk_size=2).start().result()
+
+        self.assertEqual(
+            [f'realtime_auth:user:{user.pk}' for user in self.users[3:]],
+            list(cache.get_many([f'realtime_auth:user:{user.pk}' for user in self.users])),
+        )
+
+    def test_admin_group_actions(self, get_publisher):
+        url = reverse('admin:users_user_changelist')
+        selected = [user.pk for user in self.users[:3]]
+        res = self.client.post(url, {'action': 'add_users_to_group', '_selected_action': selected, 'group': self.group.pk})
+        self.assertRedirects(res, url)
+        self.assertEqual(sorted(self.group.user_set.values_list('pk', flat=True)), selected)
+        self.assertTrue(self.progress(get_publisher)[-1]['finished'])
+
+        res = self.client.post(url, {'action': 'remove_users_from_group', '_selected_action': selected[:1], 'group': self.group.pk})
+        self.assertEqual(sorted(self.group.user_set.values_list('pk', flat=True)), selected[1:])
+
+        res = self.client.post(url, {'action': 'remove_users_from_group', '_selected_action': selected}, follow=True)
+        self.assertContains(res, 'Pick a group for this action.')
+        self.assertEqual(self.group.user_set.count(), 2)
+
+    def test_group_field_doesnt_list_groups(self, get_publisher):
+        res = self.client.get(reverse('admin:users_user_changelist'))
+        self.assertContains(res, 'type="number" name="group"')
+        self.assertNotContains(res, '<select name="group"')
+
+    def test_failures_are_reported(self, get_publisher):
+        with patch.object(BulkAction, 'apply', side_effect=RuntimeError("Nope")):
+            with self.assertRaises(RuntimeError):
+                BulkAction(self.admin_user.pk, 'activate', get_user_model().objects.all()).run()
+        self.assertEqual(self.progress(get_publisher)[-1]['error'], "Nope")
@@ -1,8 +1,14 @@
+from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.utils import OperationalError
+from django.test import override_settings
 
+import json
+
+from io import StringIO
 from unittest.mock import patch
-from tests.utils import CkcAPITestCase, CkcAPIClient
+from tests.utils import CkcAPITestCase, CkcAPIClient, CkcAPITransactionTestCase
 
 class CommandTests(CkcAPITestCase):
 
@@ -23,4 +29,115 @@ class CommandTests(CkcAPITestCase):
             gi.side_effect = [OperationalError] * 5 + [True]
             call_command('wait_for_db')
             # check that operationalerror is called 6 times.
-            self.assertEqual(gi.call_count, 6)
\ No newline at end of file
+            self.assertEqual(gi.call_count, 6)
+
+    def test_benchmark_fanout(self):
+        """Test fan-out benchmark reports a row per group size"""
+        out = StringIO()
+        call_command('benchmark_fanout', sizes='1,5', rounds=2, items=2, stdout=out)
+        self.assertEqual(len(out.getvalue().strip().splitlines()), 3)
+
+    def test_benchmark_multiplex(self):
+        """Test multiplex benchmark shows the hub sending one message per worker"""
+        out = StringIO()
+        call_command('benchmark_multiplex', tabs='6', workers=2, rounds=2, stdout=out)
+        self.assertEqual(out.getvalue().strip().splitlines()[-1].split(), ['6', '2', '6.0', '2.0'])
+
+    def test_benchmark_compression(self):
+        """Test compression benchmark reports a row per payload size"""
+        out = StringIO()
+        call_command('benchmark_compression', items='1,64', rounds=3, stdout=out)
+        lines = out.getvalue().strip().splitlines()
+        self.assertEqual(len(lines), 3)
+        raw, deflated = lines[-1].split()[:2]
+        self.assertLess(int(deflated), int(raw))
+
+    def test_calibrate_hashers(self):
+        """Test hasher calibration recommends settings and counts passwords to rehash"""
+        hashers = ['users.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher']
+        get_user_model().objects.create_user('md5@test.com', 'testing')
+        with override_settings(PASSWORD_HASHERS=hashers, USERS={'PBKDF2_ITERATIONS': 10_000}):
+            get_user_model().objects.create_user('pbkdf2@test.com', 'testing')
+
+            out, err = StringIO(), StringIO()
+            call_command('calibrate_hashers', target_ms=50, samples=3, stdout=out, stderr=err)
+            lines = out.getvalue().strip().splitlines()
+            self.assertEqual(lines[1].split()[:3], ['PBKDF2_ITERATIONS', 'pbkdf2_sha256', '10000'])
+            self.assertGreater(int(lines[1].split()[5]), 10_000)
+            self.assertEqual(lines[-1], "Rehashed on next login: 1 of 2 users with a password now, 2 with these settings")
+            self.assertIn("Skipping md5", err.getvalue())
+
+            out = StringIO()
+            call_command('calibrate_hashers', target_ms=50, samples=3, env=True, stdout=out, stderr=StringIO())
+            self.assertRegex(out.getvalue(), r'^PBKDF2_ITERATIONS=\d+\n$')
+
+    def test_benchmark_user_search(self):
+        """Test user search benchmark reports a row per search and cleans up after itself"""
+        out = StringIO()
+        call_command('benchmark_user_search', users=100, rounds=1, searches='bench-7-,smith', stdout=out)
+        lines = out.getvalue().strip().splitlines()
+        self.assertEqual([line.split()[:2] for line in lines[1:]], [['bench-7-', '1'], ['smith', '30']])
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_export_users(self):
+        """Test users export as CSV or NDJSON, with the fields and filters asked for"""
+        get_user_model().objects.create_user('b@test.com', 'testing', first_name='B')
+        get_user_model().objects.create_user('a@test.com', 'testing', first_name='A', is_active=False)
+
+        out = StringIO()
+        call_command('export_users', fields='email,first_name', chunk_size=1, stdout=out)
+        self.assertEqual(out.getvalue(), 'email,first_name\r\nb@test.com,B\r\na@test.com,A\r\n')
+
+        out = StringIO()
+        call_command('export_users', format='ndjson', fields='email,is_active', is_active='false', stdout=out)
+        self.assertEqual(out.getvalue(), '{"email": "a@test.com", "is_active": false}\n')
+
+        with self.assertRaises(CommandError):
+            call_command('export_users', fields='email,password')
+
+    def test_benchmark_user_export(self):
+        """Test export benchmark reports every row exported and cleans up after itself"""
+        out = StringIO()
+        call_command('benchmark_user_export', users=50, chunk_size=7, stdout=out)
+        lines = out.getvalue().strip().splitlines()
+        self.assertEqual([line.split()[:3] for line in lines[1:]], [
+            ['stream', 'csv', '50'], ['stream', 'ndjson', '50'], ['list', 'csv', '50'], ['list', 'ndjson', '50'],
+        ])
+        self.assertFalse(get_user_model().objects.exists())
+
+
+class LoadTestCommandTests(CkcAPITransactionTestCase):
+
+    def test_loadtest_realtime(self):
+        """Test realtime load test delivers every update and cleans up after itself"""
+        out = StringIO()
+        call_command('loadtest_realtime', sockets=4, users=2, rate=20, duration=0.1, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['connected'], 4)
+        self.assertEqual(report['messages_received'], report['messages_expected'])
+        self.assertEqual(set(report['fanout_latency_ms']), {'p50', 'p95', 'p99'})
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_loadtest_realtime_sse(self):
+        """Test realtime load test can go through the event stream instead"""
+        out = StringIO()
+        call_command('loadtest_realtime', sockets=4, users=2, rate=20, duration=0.1, transport='sse', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['transport'], report['connected']), ('sse', 4))
+        self.assertEqual(report['messages_received'], report['messages_expected'])
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_benchmark_logins(self):
+        """Test login benchmark reports a row per mode and cleans up after itself"""
+        out = StringIO()
+        call_command(
+            'benchmark_logins', modes='sync,thread', logins=4, concurrency=2,
+            hasher='django.contrib.auth.hashers.MD5PasswordHasher', stdout=out,
+        )
+        lines = out.getvalue().strip().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['mode', 'sync', 'thread'])
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_loadtest_realtime_uvicorn_needs_redis(self):
+        with self.assertRaises(CommandError):
+            call_command('loadtest_realtime', server='uvicorn')
@@ -0,0 +1,1466 @@
+import asyncio
+import gc
+import json
+import os
+import time
+import tracemalloc
+import unittest
+import zlib
+
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.test import override_settings
+from unittest.mock import Mock, patch
+from websockets.frames import OP_TEXT, Frame
+
+from realtime import rpc, topics
+from realtime.auth import CachedAuthMiddlewareStack, get_hit_ratio, resolve_user
+from realtime.compression import ThresholdPerMessageDeflate, get_extension_factories
+from realtime.consumers import RealtimeConsumer, RealtimeEventStreamConsumer
+from realtime.deltas import DeltaStore, make_patch
+from realtime.hub import RealtimeHub
+from realtime.layers import RealtimeRedisChannelLayer
+from realtime.limits import TokenBucket
+from realtime.publisher import Publisher
+from realtime.helpers import (
+    _record_updates,
+    group_send_many,
+    make_realtime_room_key,
+    make_update_event,
+    publish_to_topic,
+    publish_update,
+    send_to_users,
+)
+from realtime.queues import SendQueue
+from realtime.replay import ReplayBuffer, get_replay_buffer
+from tests.utils import CkcAPITestCase, CkcAPITransactionTestCase
+from utils import metrics
+
+
+def make_communicator(user, path="/ws/"):
+    communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), path)
+    communicator.scope['user'] = user
+    return communicator
+
+
+class RealtimeConsumerTests(CkcAPITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    async def test_anonymous_user_is_rejected(self):
+        communicator = make_communicator(AnonymousUser())
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_published_update_is_forwarded(self):
+        communicator = make_communicator(self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+        frame = json.loads(await communicator.receive_from())
+        self.assertEqual(frame, {"type": "update", "data": {"id": 1}, "commit": 'things/update'})
+
+        await communicator.disconnect()
+
+    async def test_pre_encoded_text_is_sent_unchanged(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        event = make_update_event({"id": 1}, commit='things/update')
+        await get_channel_layer().group_send(self.room_key, event)
+        self.assertEqual(await communicator.receive_from(), event['text'])
+
+        await communicator.disconnect()
+
+    async def test_plain_group_send_is_still_encoded(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await get_channel_layer().group_send(self.room_key, {
+            "type": "update",
+            "data": {"id": 2},
+            "commit": 'things/update',
+        })
+        frame = json.loads(await communicator.receive_from())
+        self.assertEqual(frame['data'], {"id": 2})
+
+        await communicator.disconnect()
+
+    async def test_invalid_json_gets_an_error(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await communicator.send_to(text_data="{not json")
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['status'], 400)
+
+        await communicator.disconnect()
+
+
+class RealtimeCoalescingTests(CkcAPITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    @override_settings(REALTIME={'COALESCE_WINDOW': 0.05, 'COALESCE_MODE': 'latest'})
+    async def test_repeated_commits_collapse_to_latest(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        for i in range(5):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+
+        first = await communicator.receive_json_from()
+        second = await communicator.receive_json_from()
+        self.assertEqual(first, {"type": "update", "data": {"count": 4}, "commit": 'counter/set'})
+        self.assertEqual(second['commit'], 'things/update')
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'COALESCE_WINDOW': 0.05, 'COALESCE_MODE': 'latest'})
+    async def test_patches_are_not_collapsed(self):
+        cache.clear()
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        document = {"rows": list(range(50))}
+        await publish_update(self.room_key, document, commit='things/set', delta=True)
+        await communicator.receive_json_from()
+
+        for i in range(2):
+            document = {"rows": [*document["rows"], i]}
+            await publish_update(self.room_key, document, commit='things/set', delta=True)
+        first = await communicator.receive_json_from()
+        second = await communicator.receive_json_from()
+        self.assertEqual((first['type'], first['base'], first['version']), ('patch', 1, 2))
+        self.assertEqual((second['type'], second['base'], second['version']), ('patch', 2, 3))
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'COALESCE_WINDOW': 0.05, 'COALESCE_MODE': 'batch'})
+    async def test_updates_merge_into_batch_frame(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        for i in range(3):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([update['data'] for update in frame['updates']], [{"count": 0}, {"count": 1}, {"count": 2}])
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'COALESCE_WINDOW': 0.05, 'COALESCE_MODE': 'batch'})
+    async def test_single_update_is_not_wrapped_in_batch(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await publish_update(self.room_key, {"count": 1}, commit='counter/set')
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'update')
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'COALESCE_WINDOW': 10})
+    async def test_disconnect_cancels_pending_flush(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await publish_update(self.room_key, {"count": 1}, commit='counter/set')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class SendQueueTests(CkcAPITestCase):
+
+    def setUp(self):
+        metrics.reset_counts('realtime.')
+
+    def test_frames_come_out_in_order(self):
+        queue = SendQueue(10)
+        queue.put('a', '1')
+        queue.put('b', '2')
+        self.assertEqual(queue.pop(), '1')
+        self.assertEqual(queue.pop(), '2')
+        self.assertIsNone(queue.pop())
+
+    def test_drop_oldest_policy(self):
+        queue = SendQueue(2, 'drop_oldest')
+        for text in '123':
+            self.assertTrue(queue.put('a', text))
+        self.assertEqual([text for _, text in queue.frames], ['2', '3'])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(metrics.get_count('realtime.send_queue.dropped'), 1)
+
+    def test_coalesce_policy_replaces_same_commit(self):
+        queue = SendQueue(2, 'coalesce')
+        queue.put('a', '1')
+        queue.put('b', '2')
+        queue.put('a', '3')
+        self.assertEqual(list(queue.frames), [('b', '2'), ('a', '3')])
+        self.assertEqual(queue.coalesced, 1)
+        self.assertEqual(metrics.get_count('realtime.send_queue.coalesced'), 1)
+
+    def test_coalesce_policy_falls_back_to_dropping(self):
+        queue = SendQueue(2, 'coalesce')
+        queue.put('a', '1')
+        queue.put(None, '2')
+        queue.put('b', '3')
+        queue.put(None, '4')
+        self.assertEqual(list(queue.frames), [('b', '3'), (None, '4')])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_disconnect_policy(self):
+        queue = SendQueue(1, 'disconnect')
+        self.assertTrue(queue.put('a', '1'))
+        self.assertFalse(queue.put('a', '2'))
+        self.assertEqual(metrics.get_count('realtime.send_queue.disconnected'), 1)
+
+
+class StuckConsumer(RealtimeConsumer):
+    """Never finishes sending a frame, like a client on a dead network."""
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await asyncio.Event().wait()
+
+
+class SlowSocketTests(CkcAPITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    @override_settings(REALTIME={'SEND_QUEUE_SIZE': 2, 'SEND_QUEUE_POLICY': 'disconnect', 'SEND_QUEUE_CLOSE_CODE': 4008})
+    async def test_slow_socket_is_disconnected(self):
+        communicator = WebsocketCommunicator(StuckConsumer.as_asgi(), "/ws/")
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+
+        # One frame is stuck being written, two more fill the queue
+        for i in range(4):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4008})
+        await communicator.disconnect()
+
+
+class ReplayBufferTests(CkcAPITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.buffer = ReplayBuffer(size=3, ttl=60)
+
+    def add_frames(self, count):
+        for _ in range(count):
+            seq = self.buffer.next_sequence('room')
+            self.buffer.append('room', seq, f"frame {seq}")
+
+    def test_returns_frames_after_sequence(self):
+        self.add_frames(3)
+        self.assertEqual(self.buffer.since('room', 1), ["frame 2", "frame 3"])
+        self.assertEqual(self.buffer.since('room', 3), [])
+
+    def test_gap_too_big(self):
+        self.add_frames(5)
+        self.assertIsNone(self.buffer.since('room', 1))
+        self.assertEqual(len(self.buffer.since('room', 2)), 3)
+
+    def test_sequence_from_the_future(self):
+        self.add_frames(1)
+        self.assertIsNone(self.buffer.since('room', 10))
+
+    def test_expired_frames(self):
+        self.add_frames(2)
+        cache.delete('realtime_replay:room:2')
+        self.assertIsNone(self.buffer.since('room', 0))
+
+
+@override_settings(REALTIME={'REPLAY_BUFFER_SIZE': 3, 'REPLAY_BUFFER_TTL': 60})
+class RealtimeReplayTests(CkcAPITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    async def test_updates_carry_sequence_numbers(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await publish_update(self.room_key, {"count": 1}, commit='counter/set')
+        await publish_update(self.room_key, {"count": 2}, commit='counter/set')
+        self.assertEqual((await communicator.receive_json_from())['seq'], 1)
+        self.assertEqual((await communicator.receive_json_from())['seq'], 2)
+
+        await communicator.disconnect()
+
+    async def test_resume_replays_missed_updates(self):
+        for i in range(3):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+
+        communicator = make_communicator(self.user, "/ws/?resume=1")
+        await communicator.connect()
+
+        self.assertEqual((await communicator.receive_json_from())['data'], {"count": 1})
+        self.assertEqual((await communicator.receive_json_from())['data'], {"count": 2})
+
+        # Live updates keep going from there
+        await publish_update(self.room_key, {"count": 3}, commit='counter/set')
+        self.assertEqual((await communicator.receive_json_from())['seq'], 4)
+
+        await communicator.disconnect()
+
+    async def test_resume_skips_live_updates_already_replayed(self):
+        await publish_update(self.room_key, {"count": 0}, commit='counter/set')
+        communicator = make_communicator(self.user, "/ws/?resume=0")
+        await communicator.connect()
+        self.assertEqual((await communicator.receive_json_from())['seq'], 1)
+
+        # The same event arriving live again is dropped
+        await get_channel_layer().group_send(self.room_key, make_update_event({"count": 0}, 'counter/set', seq=1))
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    async def test_live_updates_during_replay_come_after_it(self):
+        for i in range(3):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+
+        since = ReplayBuffer.since
+
+        def since_then_publish(buffer, room_key, last_sequence):
+            frames = since(buffer, room_key, last_sequence)
+            async_to_sync(publish_update)(self.room_key, {"count": 3}, commit='counter/set')
+            # Gives the hub time to hand it over while the replay is still being read
+            time.sleep(0.1)
+            return frames
+
+        communicator = make_communicator(self.user, "/ws/?resume=1")
+        with patch.object(ReplayBuffer, 'since', since_then_publish):
+            await communicator.connect()
+            seqs = [(await communicator.receive_json_from())['seq'] for _ in range(3)]
+        self.assertEqual(seqs, [2, 3, 4])
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    async def test_resume_too_far_back_requires_resync(self):
+        for i in range(5):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+
+        communicator = make_communicator(self.user, "/ws/?resume=1")
+        await communicator.connect()
+        self.assertEqual(await communicator.receive_json_from(), {"type": "resync"})
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'REPLAY_BUFFER_SIZE': 5, 'SEND_QUEUE_SIZE': 2})
+    async def test_resume_bigger_than_send_queue_requires_resync(self):
+        for i in range(3):
+            await publish_update(self.room_key, {"count": i}, commit='counter/set')
+
+        communicator = make_communicator(self.user, "/ws/?resume=0")
+        await communicator.connect()
+        self.assertEqual(await communicator.receive_json_from(), {"type": "resync"})
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={})
+    async def test_resume_without_replay_buffer_requires_resync(self):
+        communicator = make_communicator(self.user, "/ws/?resume=1")
+        await communicator.connect()
+        self.assertEqual(await communicator.receive_json_from(), {"type": "resync"})
+
+        await communicator.disconnect()
+
+
+@rpc.register('tests.echo')
+async def echo(user, **params):
+    return params
+
+
+@rpc.register('tests.fail')
+def fail(user, code=400):
+    if code == 400:
+        raise rpc.RpcError("Nope")
+    raise RuntimeError("Something broke")
+
+
+class RealtimeRpcTests(CkcAPITransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test',
+            first_name='Test',
+        )
+
+    async def call(self, communicator, frame):
+        await communicator.send_json_to({"type": "rpc", **frame})
+        return await communicator.receive_json_from()
+
+    async def test_users_me(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        response = await self.call(communicator, {"id": 1, "method": "users.me"})
+        self.assertEqual(response, {
+            "type": "rpc",
+            "id": 1,
+            "result": {"id": self.user.pk, "email": "test@test.com", "first_name": "Test", "last_name": None},
+        })
+
+        await communicator.disconnect()
+
+    async def test_batched_calls(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        response = await self.call(communicator, {"calls": [
+            {"id": 1, "method": "tests.echo", "params": {"a": 1}},
+            {"id": 2, "method": "tests.fail"},
+            {"id": 3, "method": "tests.missing"},
+            "not a call",
+        ]})
+        self.assertEqual(response, {"type": "rpc", "results": [
+            {"id": 1, "result": {"a": 1}},
+            {"id": 2, "error": {"message": "Nope", "code": 400}},
+            {"id": 3, "error": {"message": "Unknown method: tests.missing", "code": 404}},
+            {"id": None, "error": {"message": "Each call must be an object", "code": 400}},
+        ]})
+
+        await communicator.disconnect()
+
+    async def test_bad_calls(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        response = await self.call(communicator, {"id": 1, "method": "tests.fail", "params": {"code": 500}})
+        self.assertEqual(response['error'], {"message": "Internal error", "code": 500})
+
+        response = await self.call(communicator, {"id": 2, "method": "tests.echo", "params": []})
+        self.assertEqual(response['error']['code'], 400)
+
+        response = await self.call(communicator, {"id": 3, "method": "tests.fail", "params": {"nope": 1}})
+        self.assertEqual(response['error'], {
+            "message": "Bad params for tests.fail: got an unexpected keyword argument 'nope'", "code": 400,
+        })
+
+        response = await self.call(communicator, {"calls": {}})
+        self.assertEqual(response['error']['code'], 400)
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'RPC_MAX_PENDING': 0})
+    async def test_too_many_pending_calls(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        response = await self.call(communicator, {"id": 1, "method": "tests.echo"})
+        self.assertEqual(response['error']['code'], 429)
+
+        await communicator.disconnect()
+
+
+class RealtimeHubTests(CkcAPITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    async def test_tabs_share_one_group_member(self):
+        tabs = [make_communicator(self.user) for _ in range(3)]
+        for tab in tabs:
+            await tab.connect()
+        self.assertEqual(len(get_channel_layer().groups[self.room_key]), 1)
+
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+        for tab in tabs:
+            self.assertEqual((await tab.receive_json_from())['data'], {"id": 1})
+
+        for tab in tabs:
+            await tab.disconnect()
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+
+    @override_settings(REALTIME={'MULTIPLEX': False})
+    async def test_without_multiplexing_every_tab_joins(self):
+        tabs = [make_communicator(self.user) for _ in range(2)]
+        for tab in tabs:
+            await tab.connect()
+        self.assertEqual(len(get_channel_layer().groups[self.room_key]), 2)
+
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+        for tab in tabs:
+            self.assertEqual((await tab.receive_json_from())['data'], {"id": 1})
+            await tab.disconnect()
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+
+    async def test_broken_socket_does_not_stop_the_room(self):
+        received = []
+
+        class Broken:
+            async def dispatch(self, message):
+                raise ValueError("Broken")
+
+        class Working:
+            async def dispatch(self, message):
+                received.append(message)
+
+        hub = RealtimeHub(get_channel_layer())
+        await hub.join('hub_test_room', Broken())
+        working = Working()
+        await hub.join('hub_test_room', working)
+
+        await get_channel_layer().group_send('hub_test_room', {"type": "update"})
+        while not received:
+            await asyncio.sleep(0.01)
+        self.assertEqual(received, [{"type": "update"}])
+
+        await hub.leave('hub_test_room', working)
+        await hub.leave('not_a_room', working)
+        self.assertIn('hub_test_room', hub.rooms)
+
+    async def test_receive_errors_do_not_stop_the_room(self):
+        received = []
+
+        class Listening:
+            async def dispatch(self, message):
+                received.append(message)
+
+        layer = FlakyChannelLayer()
+        room_hub = RealtimeHub(layer)
+        listening = Listening()
+        with patch('realtime.hub.RECEIVE_RETRY_DELAY', 0), self.assertLogs('realtime.hub', 'ERROR'):
+            await room_hub.join('hub_test_room', listening)
+            await layer.messages.put({"type": "update"})
+            while not received:
+                await asyncio.sleep(0.01)
+        self.assertEqual(received, [{"type": "update"}])
+        await room_hub.leave('hub_test_room', listening)
+
+    async def test_quiet_rooms_rejoin(self):
+        layer = FlakyChannelLayer()
+        room_hub = RealtimeHub(layer)
+        listening = object()
+        with patch('realtime.hub.REJOIN_INTERVAL', 0.01), self.assertLogs('realtime.hub', 'ERROR'):
+            await room_hub.join('hub_test_room', listening)
+            while len(layer.joined) < 3:
+                await asyncio.sleep(0.01)
+        self.assertEqual(set(layer.joined), {('hub_test_room', 'flaky!1')})
+
+        await room_hub.leave('hub_test_room', listening)
+        self.assertIsNone(room_hub.rejoiner)
+
+
+class FlakyChannelLayer:
+    """Fails the first receive, then hands out whatever is put in `messages`."""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.joined = []
+        self.failed = False
+
+    async def new_channel(self):
+        return 'flaky!1'
+
+    async def group_add(self, group, channel):
+        self.joined.append((group, channel))
+
+    async def group_discard(self, group, channel):
+        pass
+
+    async def receive(self, channel):
+        if not self.failed:
+            self.failed = True
+            raise ConnectionError("Channel layer went away")
+        return await self.messages.get()
+
+
+topics.register('tests.news')
+topics.register('tests.staff', can_subscribe=lambda user: user.is_staff)
+
+
+class RealtimeBroadcastTests(CkcAPITransactionTestCase):
+
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user(email=f'test{i}@test.com', password='test')
+            for i in range(3)
+        ]
+
+    async def test_send_to_users(self):
+        communicators = [make_communicator(user) for user in self.users]
+        for communicator in communicators:
+            await communicator.connect()
+
+        await send_to_users([user.pk for user in self.users[:2]], {"id": 1}, commit='things/update')
+        for communicator in communicators[:2]:
+            self.assertEqual((await communicator.receive_json_from())['data'], {"id": 1})
+        self.assertTrue(await communicators[2].receive_nothing())
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_group_send_many_without_layer_support(self):
+        # The in memory layer has no group_send_many, so this is the fallback
+        communicators = [make_communicator(user) for user in self.users[:2]]
+        for communicator in communicators:
+            await communicator.connect()
+
+        await group_send_many({
+            make_realtime_room_key(user): make_update_event({"id": user.pk}, commit='things/update')
+            for user in self.users[:2]
+        })
+        for user, communicator in zip(self.users, communicators):
+            self.assertEqual((await communicator.receive_json_from())['data'], {"id": user.pk})
+            await communicator.disconnect()
+
+    async def test_subscribe_to_topic(self):
+        communicator = make_communicator(self.users[0])
+        await communicator.connect()
+
+        await communicator.send_json_to({"type": "subscribe", "topic": "tests.news"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "subscribed", "topic": "tests.news"})
+
+        await publish_to_topic('tests.news', {"id": 1}, commit='news/update')
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "update", "data": {"id": 1}, "commit": 'news/update'},
+        )
+
+        await communicator.send_json_to({"type": "unsubscribe", "topic": "tests.news"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "unsubscribed", "topic": "tests.news"})
+        await publish_to_topic('tests.news', {"id": 2}, commit='news/update')
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    async def test_cannot_subscribe_to_unknown_or_forbidden_topics(self):
+        communicator = make_communicator(self.users[0])
+        await communicator.connect()
+
+        for topic in ['tests.nope', 'tests.staff']:
+            await communicator.send_json_to({"type": "subscribe", "topic": topic})
+            self.assertEqual((await communicator.receive_json_from())['status'], 403)
+
+        await communicator.send_json_to({"type": "subscribe", "topic": ['tests.news']})
+        self.assertEqual((await communicator.receive_json_from())['status'], 400)
+
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'MAX_TOPICS': 0})
+    async def test_too_many_topics(self):
+        communicator = make_communicator(self.users[0])
+        await communicator.connect()
+
+        await communicator.send_json_to({"type": "subscribe", "topic": "tests.news"})
+        self.assertEqual((await communicator.receive_json_from())['status'], 429)
+
+        await communicator.disconnect()
+
+    async def test_disconnect_leaves_topics(self):
+        communicator = make_communicator(self.users[0])
+        await communicator.connect()
+        await communicator.send_json_to({"type": "subscribe", "topic": "tests.news"})
+        await communicator.receive_json_from()
+
+        await communicator.disconnect()
+        self.assertNotIn('topic_tests.news', get_channel_layer().groups)
+
+
+@unittest.skipUnless(os.environ.get('TEST_REDIS_URL'), "Needs a Redis to talk to in TEST_REDIS_URL")
+class RealtimeRedisChannelLayerTests(CkcAPITestCase):
+
+    def setUp(self):
+        metrics.reset_counts('realtime.layer')
+
+    async def make_layer(self, **kwargs):
+        layer = RealtimeRedisChannelLayer(hosts=[os.environ['TEST_REDIS_URL']], prefix='realtime_test', **kwargs)
+        await layer.flush()
+        return layer
+
+    async def join_rooms(self, layer, count):
+        # Channels from one layer share its process' Redis key, like sockets in a worker
+        channels = [await layer.new_channel() for _ in range(count)]
+        for index, channel in enumerate(channels):
+            await layer.group_add(f'room_{index}', channel)
+        return channels
+
+    async def test_every_room_in_a_process_gets_its_message(self):
+        layer = await self.make_layer()
+        channels = await self.join_rooms(layer, 500)
+
+        await layer.group_send_many({f'room_{index}': {"type": "update", "index": index} for index in range(500)})
+        received = await receive_all(layer, channels)
+        self.assertEqual([message['index'] for message in received], list(range(500)))
+        self.assertEqual(metrics.get_count('realtime.layer.over_capacity'), 0)
+
+        # The same message for every room goes out once, and still reaches them all
+        message = {"type": "update", "text": "same"}
+        await layer.group_send_many({f'room_{index}': message for index in range(500)})
+        received = await receive_all(layer, channels)
+        self.assertEqual(received, [message] * 500)
+
+        await layer.flush()
+        await layer.close_pools()
+
+    async def test_channels_get_their_messages_in_order(self):
+        layer = await self.make_layer()
+        channel, = await self.join_rooms(layer, 1)
+        await layer.group_add('topic_news', channel)
+
+        await layer.group_send_many({'room_0': {"type": "update", "n": 1}, 'topic_news': {"type": "update", "n": 2}})
+        self.assertEqual([message['n'] for message in await receive_all(layer, [channel, channel])], [1, 2])
+
+        await layer.flush()
+        await layer.close_pools()
+
+    async def test_over_capacity_is_counted(self):
+        layer = await self.make_layer(capacity=1)
+        channels = await self.join_rooms(layer, 2)
+
+        with self.assertLogs('realtime.layers', 'WARNING'):
+            for round in range(2):
+                await layer.group_send_many({f'room_{index}': {"type": "update", "round": round} for index in range(2)})
+        self.assertEqual(metrics.get_count('realtime.layer.over_capacity'), 1)
+        received = await receive_all(layer, channels)
+        self.assertEqual([message['round'] for message in received], [0, 0])
+
+        await layer.flush()
+        await layer.close_pools()
+
+
+async def receive_all(layer, channels):
+    """Receives a message on each of `channels`, failing rather than waiting forever for lost ones."""
+    received = []
+    for channel in channels:
+        received.append(await asyncio.wait_for(layer.receive(channel), timeout=5))
+    return received
+
+
+class RecordingChannelLayer:
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send_many(self, messages):
+        self.sent.append({group: message['text'] for group, message in messages.items()})
+
+
+class PublisherTests(CkcAPITestCase):
+
+    def setUp(self):
+        self.channel_layer = RecordingChannelLayer()
+        # Long enough that only flush() sends anything
+        self.publisher = Publisher(self.channel_layer, flush_interval=60)
+        self.addCleanup(self.publisher.close)
+
+    def test_updates_are_sent_together_on_flush(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.publisher.publish('room_1', {"id": 1}, commit='things/update')
+            self.publisher.send_to_users([2, 3], {"id": 2}, commit='things/update')
+            self.publisher.publish_to_topic('news', {"id": 3}, commit='news/update')
+        self.assertEqual(self.channel_layer.sent, [])
+
+        self.publisher.flush()
+        self.assertEqual(len(self.channel_layer.sent), 1)
+        self.assertEqual(
+            sorted(self.channel_layer.sent[0]),
+            ['room_1', 'topic_news', 'user_socket_2', 'user_socket_3'],
+        )
+        self.assertEqual(json.loads(self.channel_layer.sent[0]['user_socket_3'])['data'], {"id": 2})
+
+    def test_updates_to_a_room_keep_their_order(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                self.publisher.publish('room_1', {"id": i}, commit='things/update')
+            self.publisher.publish('room_2', {"id": 10}, commit='things/update')
+        self.publisher.flush()
+
+        self.assertEqual(
+            [[json.loads(text)['data']['id'] for text in messages.values()] for messages in self.channel_layer.sent],
+            [[0, 10], [1], [2]],
+        )
+
+    def test_rolled_back_updates_are_not_sent(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.publisher.publish('room_1', {"id": 1})
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.publisher.publish('room_2', {"id": 2})
+        self.publisher.flush()
+
+        self.assertEqual([list(messages) for messages in self.channel_layer.sent], [['room_2']])
+
+    def test_sends_in_the_background(self):
+        publisher = Publisher(self.channel_layer, flush_interval=0.01)
+        self.addCleanup(publisher.close)
+        with self.captureOnCommitCallbacks(execute=True):
+            publisher.publish('room_1', {"id": 1})
+
+        for _ in range(100):
+            if self.channel_layer.sent:
+                break
+            time.sleep(0.01)
+        self.assertEqual(list(self.channel_layer.sent[0]), ['room_1'])
+
+    def test_full_batch_is_sent_right_away(self):
+        publisher = Publisher(self.channel_layer, flush_interval=60, max_batch_size=2)
+        self.addCleanup(publisher.close)
+        with self.captureOnCommitCallbacks(execute=True):
+            publisher.publish('room_1', {"id": 1})
+            publisher.publish('room_2', {"id": 2})
+
+        for _ in range(100):
+            if self.channel_layer.sent:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.channel_layer.sent[0]), ['room_1', 'room_2'])
+
+    def test_data_is_sent_as_published(self):
+        data = {"id": 1}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.publisher.publish('room_1', data, commit='things/update')
+            data["id"] = 2
+        self.publisher.flush()
+        self.assertEqual(json.loads(self.channel_layer.sent[0]['room_1'])['data'], {"id": 1})
+
+    def test_updates_after_close_are_dropped(self):
+        self.publisher.close()
+        with self.assertLogs('realtime.publisher', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.publisher.publish('room_1', {"id": 1})
+        self.assertEqual(self.publisher.pending, [])
+
+
+@override_settings(REALTIME={'AUTH_CACHE_TTL': 30})
+class CachedAuthTests(CkcAPITransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset_counts('realtime.auth_cache')
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.client.login(email='test@test.com', password='test')
+        self.session_key = self.client.cookies['sessionid'].value
+
+    def resolve(self):
+        return resolve_user(SessionStore(self.session_key))
+
+    def test_second_lookup_skips_the_database(self):
+        self.assertEqual(self.resolve(), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(), self.user)
+        self.assertEqual(get_hit_ratio(), 0.5)
+
+    def test_logout_forgets_the_session(self):
+        self.resolve()
+        self.client.logout()
+        self.assertTrue(self.resolve().is_anonymous)
+
+    def test_password_change_logs_out(self):
+        self.resolve()
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertTrue(self.resolve().is_anonymous)
+
+    def test_deactivated_user_is_anonymous(self):
+        self.resolve()
+        self.user.is_active = False
+        self.user.save()
+        self.assertTrue(self.resolve().is_anonymous)
+
+    def test_no_session(self):
+        self.assertTrue(resolve_user(SessionStore()).is_anonymous)
+        self.assertIsNone(get_hit_ratio())
+
+    async def test_websocket_connect(self):
+        communicator = WebsocketCommunicator(
+            CachedAuthMiddlewareStack(RealtimeConsumer.as_asgi()),
+            "/ws/",
+            headers=[(b"cookie", f"sessionid={self.session_key}".encode())],
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'AUTH_CACHE_TTL': None})
+    async def test_websocket_connect_without_cache(self):
+        communicator = WebsocketCommunicator(
+            CachedAuthMiddlewareStack(RealtimeConsumer.as_asgi()),
+            "/ws/",
+            headers=[(b"cookie", f"sessionid={self.session_key}".encode())],
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+        self.assertIsNone(get_hit_ratio())
+
+
+class HeartbeatTests(CkcAPITestCase):
+
+    def setUp(self):
+        metrics.reset_counts('realtime.reaped')
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    @override_settings(REALTIME={'HEARTBEAT_INTERVAL': 0.05, 'IDLE_TIMEOUT': None})
+    async def test_sends_pings(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+        self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'HEARTBEAT_INTERVAL': None, 'IDLE_TIMEOUT': 0.1})
+    async def test_idle_socket_is_reaped(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4009})
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+        self.assertEqual(metrics.get_count('realtime.reaped.idle'), 1)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'HEARTBEAT_INTERVAL': None, 'IDLE_TIMEOUT': 0.2})
+    async def test_pongs_keep_socket_alive(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+        for _ in range(5):
+            await asyncio.sleep(0.1)
+            await communicator.send_json_to({"type": "pong"})
+
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+        self.assertEqual((await communicator.receive_json_from())['data'], {"id": 1})
+        self.assertEqual(metrics.get_count('realtime.reaped.idle'), 0)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'HEARTBEAT_INTERVAL': 0.02, 'IDLE_TIMEOUT': 0.1})
+    async def test_stuck_socket_is_reaped(self):
+        communicator = WebsocketCommunicator(StuckConsumer.as_asgi(), "/ws/")
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+
+        # Pings can't go out, which mustn't stop the reaping
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4009})
+        self.assertEqual(metrics.get_count('realtime.reaped.idle'), 1)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'HEARTBEAT_INTERVAL': None, 'MAX_LIFETIME': 0.1, 'MAX_LIFETIME_JITTER': 0})
+    async def test_old_socket_is_reaped(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4009})
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+        self.assertEqual(metrics.get_count('realtime.reaped.lifetime'), 1)
+        await communicator.disconnect()
+
+
+class ConnectionMemoryTests(CkcAPITestCase):
+    """Fails when idle sockets start costing more memory than they used to.
+
+    Measured in process, so each socket also includes the test client's
+    side of it. Sockets take ~25 KB (~20 KB lean) on Python 3.11, a little
+    more on 3.9 and with coverage on, the budgets leave room for that.
+    """
+    SOCKETS = 100
+    BUDGET = 36 * 1024
+    LEAN_BUDGET = 28 * 1024
+
+    async def measure(self, sockets=SOCKETS):
+        # Every socket gets its own user, like it would from the auth middleware
+        users = [
+            get_user_model()(pk=i, email=f'test{i}@test.com', first_name='First', last_name='Last')
+            for i in range(sockets)
+        ]
+        communicators = []
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for user in users:
+            communicator = make_communicator(user)
+            communicator.scope['headers'] = [(b'cookie', b'sessionid=abcdefghijklmnopqrstuvwxyz012345')]
+            await communicator.connect()
+            communicators.append(communicator)
+        del users, user, communicator
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        return sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / sockets
+
+    async def test_memory_per_socket(self):
+        # Run everything once first, so one-off allocations (imports, caches,
+        # coverage recording lines it hadn't seen) don't count against sockets
+        await self.measure(sockets=5)
+        with override_settings(REALTIME={'LEAN_CONNECTIONS': True}):
+            await self.measure(sockets=5)
+
+        per_socket = await self.measure()
+        self.assertLess(per_socket, self.BUDGET)
+
+        with override_settings(REALTIME={'LEAN_CONNECTIONS': True}):
+            lean_per_socket = await self.measure()
+        self.assertLess(lean_per_socket, self.LEAN_BUDGET)
+        self.assertLess(lean_per_socket, per_socket * 0.9)
+
+
+@override_settings(REALTIME={'LEAN_CONNECTIONS': True})
+class LeanConnectionTests(CkcAPITransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    async def test_scope_is_slimmed_down(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+        self.assertEqual(set(communicator.scope), {'type', 'path'})
+
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+        self.assertEqual((await communicator.receive_json_from())['data'], {"id": 1})
+        await communicator.disconnect()
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+
+    async def test_user_is_fetched_for_rpc_and_topics(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await communicator.send_json_to({"type": "rpc", "id": 1, "method": "users.me"})
+        self.assertEqual((await communicator.receive_json_from())['result']['email'], 'test@test.com')
+        await communicator.send_json_to({"type": "subscribe", "topic": "tests.staff"})
+        self.assertEqual((await communicator.receive_json_from())['status'], 403)
+        await communicator.disconnect()
+
+    async def test_socket_closes_once_user_is_gone(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+        await database_sync_to_async(self.user.delete)()
+
+        await communicator.send_json_to({"type": "rpc", "id": 1, "method": "users.me"})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        await communicator.disconnect()
+
+
+class CompressionTests(CkcAPITestCase):
+
+    def negotiate(self):
+        factory, = get_extension_factories()
+        _, extension = factory.process_request_params([], [])
+        return extension
+
+    @override_settings(REALTIME={'COMPRESSION_THRESHOLD': 100})
+    def test_only_big_frames_are_compressed(self):
+        extension = self.negotiate()
+        self.assertIsInstance(extension, ThresholdPerMessageDeflate)
+
+        small = extension.encode(Frame(fin=True, opcode=OP_TEXT, data=b'{"type": "ping"}'))
+        self.assertFalse(small.rsv1)
+        self.assertEqual(small.data, b'{"type": "ping"}')
+
+        data = json.dumps([{"id": i, "name": f"Item {i}"} for i in range(20)]).encode()
+        big = extension.encode(Frame(fin=True, opcode=OP_TEXT, data=data))
+        self.assertTrue(big.rsv1)
+        self.assertLess(len(big.data), len(data))
+        decoder = zlib.decompressobj(wbits=-15)
+        self.assertEqual(decoder.decompress(big.data + b'\x00\x00\xff\xff'), data)
+
+        # Skipping the small one in between didn't upset the compressor's context
+        again = extension.encode(Frame(fin=True, opcode=OP_TEXT, data=data))
+        self.assertLess(len(again.data), len(big.data))
+        self.assertEqual(decoder.decompress(again.data + b'\x00\x00\xff\xff'), data)
+
+    @override_settings(REALTIME={'COMPRESSION': False})
+    def test_compression_can_be_turned_off(self):
+        self.assertEqual(get_extension_factories(), [])
+
+
+def apply_patch(document, patch):
+    """Same as the frontend's utils/json_patch.js, for checking our patches apply."""
+    document = json.loads(json.dumps(document))
+    root = {"": document}
+    for operation in patch:
+        keys = [key.replace('~1', '/').replace('~0', '~') for key in operation['path'].split('/')]
+        parent = root
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        key = int(keys[-1]) if isinstance(parent, list) else keys[-1]
+        if operation['op'] == 'remove':
+            del parent[key]
+        elif operation['op'] == 'add' and isinstance(parent, list):
+            parent.insert(key, operation['value'])
+        else:
+            parent[key] = operation['value']
+    return root[""]
+
+
+class DeltaTests(CkcAPITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+        self.document = {
+            "id": 1,
+            "name": "Thing",
+            "tags": ["a", "b"],
+            "rows": [{"id": i, "value": i * 10} for i in range(20)],
+        }
+
+    def test_make_patch(self):
+        new = {
+            "id": 1,
+            "name": "Renamed",
+            "tags": ["a"],
+            "rows": self.document["rows"] + [{"id": 20, "value": 200}],
+            "a/b~c": True,
+        }
+        patch = make_patch(self.document, new)
+        self.assertEqual(patch, [
+            {"op": "replace", "path": "/name", "value": "Renamed"},
+            {"op": "remove", "path": "/tags/1"},
+            {"op": "add", "path": "/rows/20", "value": {"id": 20, "value": 200}},
+            {"op": "add", "path": "/a~1b~0c", "value": True},
+        ])
+        self.assertEqual(apply_patch(self.document, patch), new)
+        self.assertEqual(make_patch(self.document, self.document), [])
+        self.assertEqual(make_patch({"x": 1}, {"x": True}), [{"op": "replace", "path": "/x", "value": True}])
+
+    async def test_small_changes_are_sent_as_patches(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await publish_update(self.room_key, self.document, commit='things/set', delta=True)
+        full = await communicator.receive_json_from()
+        self.assertEqual((full['type'], full['version'], full['data']), ('update', 1, self.document))
+
+        changed = {**self.document, "name": "Renamed"}
+        await publish_update(self.room_key, changed, commit='things/set', delta=True)
+        patch = await communicator.receive_json_from()
+        self.assertEqual(
+            (patch['type'], patch['commit'], patch['base'], patch['version']),
+            ('patch', 'things/set', 1, 2),
+        )
+        self.assertEqual(apply_patch(full['data'], patch['patch']), changed)
+
+        # Rewriting everything is cheaper to send whole
+        await publish_update(self.room_key, {"id": 2}, commit='things/set', delta=True)
+        self.assertEqual(await communicator.receive_json_from(), {
+            "type": "update", "data": {"id": 2}, "commit": "things/set", "version": 3,
+        })
+
+        # Updates without delta are left alone
+        await publish_update(self.room_key, {"id": 3}, commit='things/set')
+        self.assertNotIn('version', await communicator.receive_json_from())
+        await communicator.disconnect()
+
+    async def test_snapshot(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await communicator.send_json_to({"type": "snapshot", "commit": "things/set"})
+        self.assertEqual((await communicator.receive_json_from())['status'], 404)
+
+        await publish_update(self.room_key, self.document, commit='things/set', delta=True)
+        await publish_update(self.room_key, {**self.document, "id": 2}, commit='things/set', delta=True)
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"type": "snapshot", "commit": "things/set"})
+        self.assertEqual(await communicator.receive_json_from(), {
+            "type": "update", "data": {**self.document, "id": 2}, "commit": "things/set", "version": 2,
+        })
+        await communicator.disconnect()
+
+    def test_later_documents_are_kept(self):
+        store = DeltaStore(ttl=60)
+        self.assertEqual(store.advance(self.room_key, 'things/set', {"id": 1}), (1, None))
+
+        # Another process got a later version stored first
+        cache.set(f"realtime_delta:{self.room_key}:things/set", (5, {"id": 5}))
+        self.assertEqual(store.advance(self.room_key, 'things/set', {"id": 2}), (2, None))
+        self.assertEqual(store.latest(self.room_key, 'things/set'), (5, {"id": 5}))
+
+    @override_settings(REALTIME={'REPLAY_BUFFER_SIZE': 3})
+    def test_rooms_share_cache_round_trips(self):
+        rooms = [f'room_{i}' for i in range(3)]
+        _record_updates(get_replay_buffer(), rooms, self.document, 'things/set', delta=True)
+
+        # Only the calls made to the cache, not the ones it makes to itself
+        spy = Mock(wraps=caches['default'])
+        with patch('realtime.replay.caches', {'default': spy}), patch('realtime.deltas.caches', {'default': spy}):
+            events = _record_updates(get_replay_buffer(), rooms, {**self.document, "id": 2}, 'things/set', delta=True)
+
+        self.assertEqual([json.loads(event['text'])['seq'] for event in events.values()], [2, 2, 2])
+        # An incr for each room's version and seq, everything else is batched
+        self.assertEqual(Counter(name for name, _, _ in spy.method_calls), {'incr': 6, 'get_many': 1, 'set_many': 2})
+
+    @override_settings(REALTIME={'REPLAY_BUFFER_SIZE': 3})
+    async def test_patches_are_replayed(self):
+        await publish_update(self.room_key, self.document, commit='things/set', delta=True)
+        await publish_update(self.room_key, {**self.document, "id": 2}, commit='things/set', delta=True)
+
+        communicator = make_communicator(self.user, "/ws/?resume=1")
+        await communicator.connect()
+        patch = await communicator.receive_json_from()
+        self.assertEqual((patch['type'], patch['seq'], patch['base']), ('patch', 2, 1))
+        await communicator.disconnect()
+
+    def test_publisher_sends_patches(self):
+        channel_layer = RecordingChannelLayer()
+        publisher = Publisher(channel_layer, flush_interval=60)
+        self.addCleanup(publisher.close)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            publisher.publish('room_1', self.document, commit='things/set', delta=True)
+            publisher.send_to_users([2], self.document, commit='things/set', delta=True)
+            publisher.publish('room_1', {**self.document, "id": 2}, commit='things/set', delta=True)
+        publisher.flush()
+
+        frames = [json.loads(text) for messages in channel_layer.sent for text in messages.values()]
+        self.assertEqual([(frame['type'], frame['version']) for frame in frames], [
+            ('update', 1), ('update', 1), ('patch', 2),
+        ])
+
+
+def make_event_stream(user, headers=(), query_string=b""):
+    return ApplicationCommunicator(RealtimeEventStreamConsumer.as_asgi(), {
+        "type": "http",
+        "method": "GET",
+        "path": "/events/",
+        "headers": list(headers),
+        "query_string": query_string,
+        "user": user,
+    })
+
+
+async def receive_events(communicator, count):
+    """Returns the next `count` events as (id, data) pairs, skipping comments."""
+    events = []
+    buffer = ""
+    while len(events) < count:
+        buffer += (await communicator.receive_output())['body'].decode()
+        while "\n\n" in buffer and len(events) < count:
+            event, buffer = buffer.split("\n\n", 1)
+            fields = dict(line.split(": ", 1) for line in event.splitlines() if not line.startswith(":"))
+            if 'data' in fields:
+                events.append((fields.get('id'), json.loads(fields['data'])))
+    return events
+
+
+@override_settings(REALTIME={'REPLAY_BUFFER_SIZE': 3})
+class EventStreamTests(CkcAPITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+        self.room_key = make_realtime_room_key(self.user)
+
+    async def start(self, communicator):
+        await communicator.send_input({"type": "http.request", "body": b""})
+        start = await communicator.receive_output()
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b"Content-Type", b"text/event-stream"), start['headers'])
+        self.assertEqual(await communicator.receive_output(), {
+            "type": "http.response.body", "body": b"", "more_body": True,
+        })
+
+    async def stop(self, communicator):
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait()
+
+    async def test_updates_are_streamed(self):
+        communicator = make_event_stream(self.user)
+        await self.start(communicator)
+
+        await publish_update(self.room_key, {"id": 1}, commit='things/update')
+        (event_id, frame), = await receive_events(communicator, 1)
+        self.assertEqual(event_id, '1')
+        self.assertEqual((frame['type'], frame['data'], frame['seq']), ('update', {"id": 1}, 1))
+
+        await self.stop(communicator)
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+
+    async def test_last_event_id_replays_missed_updates(self):
+        for i in range(3):
+            await publish_update(self.room_key, {"id": i}, commit='things/update')
+
+        communicator = make_event_stream(self.user, headers=[(b"last-event-id", b"1")])
+        await self.start(communicator)
+        events = await receive_events(communicator, 2)
+        self.assertEqual([(event_id, frame['data']['id']) for event_id, frame in events], [('2', 1), ('3', 2)])
+        await self.stop(communicator)
+
+        communicator = make_event_stream(self.user, query_string=b"last_event_id=100")
+        await self.start(communicator)
+        self.assertEqual(await receive_events(communicator, 1), [(None, {"type": "resync"})])
+        await self.stop(communicator)
+
+    @override_settings(REALTIME={'HEARTBEAT_INTERVAL': 0.01, 'MAX_LIFETIME': 0.05, 'MAX_LIFETIME_JITTER': 0})
+    async def test_heartbeat_and_lifetime(self):
+        communicator = make_event_stream(self.user)
+        await self.start(communicator)
+
+        self.assertEqual(await communicator.receive_output(), {
+            "type": "http.response.body", "body": b": ping\n\n", "more_body": True,
+        })
+        message = await communicator.receive_output()
+        while message['more_body']:
+            message = await communicator.receive_output()
+        self.assertEqual(message['body'], b"")
+        self.assertNotIn(self.room_key, get_channel_layer().groups)
+        await self.stop(communicator)
+
+
+class EventStreamRoutingTests(CkcAPITransactionTestCase):
+
+    async def test_routing(self):
+        from asgi import application
+
+        communicator = HttpCommunicator(application, "GET", "/events/")
+        self.assertEqual((await communicator.get_response())['status'], 403)
+
+        # Everything else still goes to Django
+        communicator = HttpCommunicator(application, "GET", "/api/users/me/")
+        self.assertEqual((await communicator.get_response())['status'], 401)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ReceiveLimitTests(CkcAPITestCase):
+
+    def setUp(self):
+        metrics.reset_counts()
+        self.user = get_user_model().objects.create_user(
+            email='test@test.com',
+            password='test'
+        )
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, burst=3, clock=clock)
+        for _ in range(3):
+            self.assertTrue(bucket.has())
+            bucket.take()
+        self.assertFalse(bucket.has())
+
+        clock.now = 0.5
+        self.assertTrue(bucket.has())
+        self.assertFalse(bucket.has(2))
+
+        # Never fills past the burst
+        clock.now = 100
+        self.assertTrue(bucket.has(3))
+        self.assertFalse(bucket.has(4))
+
+    @override_settings(REALTIME={'MAX_FRAME_SIZE': 100})
+    async def test_big_frames_are_not_parsed(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await communicator.send_to(text_data="[" * 101)
+        self.assertEqual((await communicator.receive_json_from())['status'], 413)
+        # Only the first of several in a row is answered
+        await communicator.send_to(text_data="[" * 101)
+        await communicator.send_json_to({"type": "unsubscribe", "topic": "news"})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'unsubscribed')
+        self.assertEqual(metrics.get_count('realtime.receive.rejected'), 2)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'RECEIVE_RATE': 0.001, 'RECEIVE_BURST': 2})
+    async def test_fast_sockets_are_throttled(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        for _ in range(5):
+            await communicator.send_to(text_data="not json")
+        self.assertEqual((await communicator.receive_json_from())['status'], 400)
+        self.assertEqual((await communicator.receive_json_from())['status'], 400)
+        self.assertEqual((await communicator.receive_json_from())['status'], 429)
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(metrics.get_count('realtime.receive.throttled'), 3)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'RECEIVE_BYTE_RATE': 0.001, 'RECEIVE_BYTE_BURST': 30})
+    async def test_byte_rate(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+
+        await communicator.send_to(text_data="x" * 20)
+        self.assertEqual((await communicator.receive_json_from())['status'], 400)
+        await communicator.send_to(text_data="x" * 20)
+        self.assertEqual((await communicator.receive_json_from())['status'], 429)
+        await communicator.disconnect()
+
+    @override_settings(REALTIME={'RECEIVE_RATE': 0.001, 'RECEIVE_BURST': 1, 'RECEIVE_LIMIT_POLICY': 'disconnect'})
+    async def test_abusive_sockets_are_disconnected(self):
+        communicator = make_communicator(self.user)
+        await communicator.connect()
+        room_key = make_realtime_room_key(self.user)
+
+        await communicator.send_json_to({"type": "pong"})
+        await communicator.send_json_to({"type": "pong"})
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4029})
+        self.assertNotIn(room_key, get_channel_layer().groups)
+        await communicator.disconnect()
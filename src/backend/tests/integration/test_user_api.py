@@ -1,13 +1,31 @@
+import json
+
 from django.contrib.auth import get_user_model
-from tests.utils import CkcAPITestCase, CkcAPIClient
+from channels.db import database_sync_to_async
+from channels.testing import ApplicationCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test import override_settings
+from tests.utils import CkcAPITestCase, CkcAPIClient, CkcAPITransactionTestCase
 from django.urls import reverse
+from unittest.mock import patch
 
 from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from users.authentication import TokenCache, get_hit_ratio, get_token_cache
+from users.consumers import UserExportConsumer
+from users.export import UserExport
+
+from utils import metrics
 
 # Create the user creation url and assign it to constant
 CREATE_USER_URL = reverse('users:create')
 TOKEN_URL = reverse('users:token')
 ME_URL = reverse('users:me')
+LIST_URL = reverse('users:list')
+SEARCH_URL = reverse('users:search')
 
 def create_user(**kwargs):
     """Helper function to create users"""
@@ -153,4 +171,356 @@ class PrivateUserApiTests(CkcAPITestCase):
         self.assertEqual(self.user.email, payload['email'])
         self.assertTrue(self.user.check_password, payload['password'])
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        
\ No newline at end of file
+
+    def test_profile_etags(self):
+        """Test GETs with a current ETag get a 304, and saving the user changes it"""
+        res = self.client.get(ME_URL)
+        etag = res['ETag']
+        self.assertEqual(etag, f'"{self.user.pk}-{self.user.version}"')
+
+        res = self.client.get(ME_URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(res.content)
+
+        self.user.first_name = 'changed'
+        self.user.save()
+        res = self.client.get(ME_URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+
+    def test_update_with_if_match(self):
+        """Test updates with a stale If-Match are refused"""
+        etag = self.client.get(ME_URL)['ETag']
+        res = self.client.patch(ME_URL, {'first_name': 'first'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+
+        res = self.client.patch(ME_URL, {'first_name': 'second'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'first')
+
+
+LOGIN_URL = reverse('rest_login')
+
+
+class PasswordHashingTests(CkcAPITestCase):
+    """Test endpoints that hash passwords do it in the hashing pool"""
+
+    def setUp(self):
+        metrics.reset_counts()
+        self.user = create_user(email='test@test.com', password='testing')
+        self.client = CkcAPIClient()
+
+    def test_login(self):
+        """Test logging in sets up a session, and wrong passwords don't"""
+        res = self.client.post(LOGIN_URL, {'email': 'test@test.com', 'password': 'wrong'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data, {'non_field_errors': ['Incorrect login information.']})
+
+        res = self.client.post(LOGIN_URL, {'email': 'test@test.com', 'password': 'testing', 'remember_me': True})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.user.pk))
+        self.assertEqual(self.client.session.get_expiry_age(), 60 * 60 * 24 * 7 * 2)
+
+    def test_inactive_users_cant_log_in(self):
+        self.user.is_active = False
+        self.user.save()
+        res = self.client.post(LOGIN_URL, {'email': 'test@test.com', 'password': 'testing'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_logged_in_sessions_need_csrf_token(self):
+        """Test CSRF is checked like DRF does, only for logged in sessions"""
+        client = CkcAPIClient(enforce_csrf_checks=True)
+        res = client.post(LOGIN_URL, {'email': 'test@test.com', 'password': 'testing'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        res = client.post(LOGIN_URL, {'email': 'test@test.com', 'password': 'testing'})
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(USERS={'HASHING_MAX_PENDING': 0})
+    def test_full_pool_answers_503(self):
+        for url in [LOGIN_URL, TOKEN_URL]:
+            res = self.client.post(url, {'email': 'test@test.com', 'password': 'testing'})
+            self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(res['Retry-After'], '1')
+        self.assertEqual(metrics.get_count('users.hashing.rejected'), 2)
+
+    @override_settings(USERS={'HASHING_EXECUTOR': 'thread'})
+    def test_thread_executor(self):
+        res = self.client.post(TOKEN_URL, {'email': 'test@test.com', 'password': 'testing'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_outdated_hashes_are_updated(self):
+        with override_settings(PASSWORD_HASHERS=[
+            'django.contrib.auth.hashers.SHA1PasswordHasher',
+            'django.contrib.auth.hashers.MD5PasswordHasher',
+        ]):
+            res = self.client.post(TOKEN_URL, {'email': 'test@test.com', 'password': 'testing'})
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('sha1$'))
+            self.assertTrue(self.user.check_password('testing'))
+
+    def test_work_factors_come_from_settings(self):
+        """Test hashers rehash passwords when their work factor setting changes, in the process pool"""
+        hashers = ['users.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher']
+        with override_settings(PASSWORD_HASHERS=hashers, USERS={'PBKDF2_ITERATIONS': 1000}):
+            res = self.client.post(TOKEN_URL, {'email': 'test@test.com', 'password': 'testing'})
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1000$'))
+
+        with override_settings(PASSWORD_HASHERS=hashers, USERS={'PBKDF2_ITERATIONS': 2000}):
+            res = self.client.post(TOKEN_URL, {'email': 'test@test.com', 'password': 'testing'})
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('pbkdf2_sha256$2000$'))
+
+    def test_method_not_allowed(self):
+        res = self.client.get(TOKEN_URL)
+        self.assertEqual(res.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@override_settings(USERS={'TOKEN_CACHE_TTL': 30})
+class CachedTokenAuthenticationTests(CkcAPITestCase):
+    """Test token lookups for api/users/me/ are cached and forgotten when they should be"""
+
+    def setUp(self):
+        metrics.reset_counts()
+        get_token_cache().clear()
+        self.user = create_user(email='test@test.com', password='testing')
+        self.token = Token.objects.create(user=self.user)
+        self.client = CkcAPIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_repeat_requests_skip_the_database(self):
+        res = self.client.get(ME_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            res = self.client.get(ME_URL)
+        self.assertEqual(res.data['email'], 'test@test.com')
+        self.assertEqual(metrics.get_count('users.token_cache.miss'), 1)
+        self.assertEqual(metrics.get_count('users.token_cache.hit'), 1)
+        self.assertEqual(get_hit_ratio(), 0.5)
+
+    def test_deleted_tokens_are_forgotten(self):
+        self.client.get(ME_URL)
+        self.token.delete()
+        res = self.client.get(ME_URL)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_users_are_forgotten(self):
+        self.client.get(ME_URL)
+        self.user.is_active = False
+        self.user.save()
+        res = self.client.get(ME_URL)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_tokens_forgotten_during_a_lookup_stay_forgotten(self):
+        lookup = TokenAuthentication.authenticate_credentials
+
+        def lookup_then_delete(auth, key):
+            found = lookup(auth, key)
+            # Deleted after we read it, before it's cached
+            self.token.delete()
+            return found
+
+        with patch.object(TokenAuthentication, 'authenticate_credentials', lookup_then_delete):
+            self.assertEqual(self.client.get(ME_URL).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(ME_URL).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(USERS={})
+    def test_cache_is_off_by_default(self):
+        self.client.get(ME_URL)
+        self.token.delete()
+        res = self.client.get(ME_URL)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIsNone(get_hit_ratio())
+
+    @override_settings(USERS={'TOKEN_CACHE_TTL': 30, 'TOKEN_CACHE': 'default'})
+    def test_shared_cache(self):
+        self.client.get(ME_URL)
+        get_token_cache().clear()
+        with self.assertNumQueries(0):
+            res = self.client.get(ME_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(metrics.get_count('users.token_cache.shared_hit'), 1)
+        self.token.delete()
+        get_token_cache().clear()
+        self.assertEqual(self.client.get(ME_URL).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_lru_is_bounded_and_expires(self):
+        now = [0]
+        cache = TokenCache(ttl=10, size=1, clock=lambda: now[0])
+        cache.set('a', self.token)
+        cache.set('b', self.token)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b').user, self.user)
+        now[0] = 11
+        self.assertIsNone(cache.get('b'))
+
+
+class UserListApiTests(CkcAPITestCase):
+    """Test the staff only user listing"""
+
+    def setUp(self):
+        self.staff = create_user(email='staff@test.com', password='testing', is_staff=True)
+        self.users = [create_user(email=f'User{i}@test.com', password='testing') for i in range(5)]
+        self.client = CkcAPIClient()
+        self.client.force_authenticate(user=self.staff)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(user=self.users[0])
+        res = self.client.get(LIST_URL)
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_pages_through_users_newest_first(self):
+        seen = []
+        url = f'{LIST_URL}?page_size=2'
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', res.data)
+            seen += [user['id'] for user in res.data['results']]
+            url = res.data['next']
+        self.assertEqual(seen, sorted([self.staff.pk] + [user.pk for user in self.users], reverse=True))
+
+    def test_filters(self):
+        self.users[0].is_active = False
+        self.users[0].save()
+
+        res = self.client.get(LIST_URL, {'is_active': 'false'})
+        self.assertEqual([user['id'] for user in res.data['results']], [self.users[0].pk])
+
+        res = self.client.get(LIST_URL, {'is_staff': 'true'})
+        self.assertEqual([user['id'] for user in res.data['results']], [self.staff.pk])
+
+        res = self.client.get(LIST_URL, {'email': 'user1', 'is_active': 'true'})
+        self.assertEqual([user['email'] for user in res.data['results']], ['User1@test.com'])
+
+    def test_bad_filter(self):
+        res = self.client.get(LIST_URL, {'is_staff': 'maybe'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('is_staff', res.data)
+
+
+class UserSearchApiTests(CkcAPITestCase):
+    """Test the staff only user search"""
+
+    def setUp(self):
+        self.staff = create_user(email='staff@test.com', password='testing', is_staff=True)
+        self.smith = create_user(email='jsmith@test.com', password='testing', first_name='John', last_name='Smith')
+        self.smithers = create_user(email='w@test.com', password='testing', first_name='Waylon', last_name='Smithers')
+        self.client = CkcAPIClient()
+        self.client.force_authenticate(user=self.staff)
+
+    def test_ranked_by_similarity(self):
+        res = self.client.get(SEARCH_URL, {'q': 'smith'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['id'] for user in res.data], [self.smith.pk, self.smithers.pk])
+
+        res = self.client.get(SEARCH_URL, {'q': 'smith', 'limit': 1})
+        self.assertEqual([user['id'] for user in res.data], [self.smith.pk])
+
+    def test_every_word_must_match(self):
+        res = self.client.get(SEARCH_URL, {'q': 'waylon smith'})
+        self.assertEqual([user['id'] for user in res.data], [self.smithers.pk])
+
+    def test_like_wildcards_are_escaped(self):
+        res = self.client.get(SEARCH_URL, {'q': '%'})
+        self.assertEqual(res.data, [])
+
+    def test_bad_params(self):
+        self.assertEqual(self.client.get(SEARCH_URL).status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.get(SEARCH_URL, {'q': 'smith', 'limit': 'lots'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(user=self.smith)
+        self.assertEqual(self.client.get(SEARCH_URL, {'q': 'smith'}).status_code, status.HTTP_403_FORBIDDEN)
+
+
+def make_export(user, query_string=b"", headers=()):
+    return ApplicationCommunicator(UserExportConsumer.as_asgi(), {
+        "type": "http",
+        "method": "GET",
+        "path": "/api/users/export/",
+        "headers": list(headers),
+        "query_string": query_string,
+        "user": user,
+    })
+
+
+async def receive_export(communicator):
+    """Returns the response start and the whole body."""
+    await communicator.send_input({"type": "http.request", "body": b""})
+    start = await communicator.receive_output()
+    body = b""
+    message = {"more_body": True}
+    while message.get("more_body"):
+        message = await communicator.receive_output()
+        body += message["body"]
+    await communicator.send_input({"type": "http.disconnect"})
+    await communicator.wait()
+    return start, body
+
+
+@override_settings(USERS={'EXPORT_CHUNK_SIZE': 2})
+class UserExportTests(CkcAPITransactionTestCase):
+    """Test staff can stream users from api/users/export/"""
+
+    def setUp(self):
+        self.staff = create_user(email='staff@test.com', password='testing', is_staff=True)
+        self.users = [create_user(email=f'user{i}@test.com', password='testing') for i in range(4)]
+
+    async def test_csv_export(self):
+        start, body = await receive_export(make_export(self.staff))
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b"Content-Type", b"text/csv; charset=utf-8"), start['headers'])
+        lines = body.decode().splitlines()
+        self.assertEqual(lines[0], 'id,email,first_name,last_name,date_joined,is_active,is_staff')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]], [user.email for user in [self.staff] + self.users])
+
+    async def test_ndjson_export_with_fields_and_filters(self):
+        start, body = await receive_export(make_export(self.staff, b"format=ndjson&fields=id,email&is_staff=false&email=USER"))
+        self.assertIn((b"Content-Type", b"application/x-ndjson"), start['headers'])
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(rows, [{"id": user.pk, "email": user.email} for user in self.users])
+
+    async def test_failed_exports_are_cut_short(self):
+        def chunks(export):
+            yield "id\r\n"
+            raise RuntimeError("Nope")
+
+        with patch.object(UserExport, 'chunks', chunks), self.assertLogs('users.consumers', 'ERROR'):
+            start, body = await receive_export(make_export(self.staff))
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(body, b"id\r\n")
+
+    def test_reads_in_a_transaction(self):
+        # Outside one, Postgres would copy the rest of a server-side cursor aside (WITH HOLD)
+        chunks = UserExport().chunks()
+        self.assertEqual(next(chunks), 'id,email,first_name,last_name,date_joined,is_active,is_staff\r\n')
+        next(chunks)
+        self.assertTrue(connection.in_atomic_block)
+        chunks.close()
+        self.assertFalse(connection.in_atomic_block)
+
+    async def test_bad_params(self):
+        start, body = await receive_export(make_export(self.staff, b"fields=password"))
+        self.assertEqual(start['status'], 400)
+        self.assertIn('fields', json.loads(body))
+
+    async def test_token_auth(self):
+        token = await database_sync_to_async(Token.objects.create)(user=self.staff)
+        start, body = await receive_export(make_export(AnonymousUser(), headers=[(b"authorization", f"Token {token.key}".encode())]))
+        self.assertEqual(start['status'], 200)
+
+        start, body = await receive_export(make_export(AnonymousUser(), headers=[(b"authorization", b"Token nope")]))
+        self.assertEqual(start['status'], 401)
+
+    async def test_staff_only(self):
+        start, body = await receive_export(make_export(self.users[0]))
+        self.assertEqual(start['status'], 403)
+        start, body = await receive_export(make_export(AnonymousUser()))
+        self.assertEqual(start['status'], 401)
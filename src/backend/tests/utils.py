@@ -1,7 +1,14 @@
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.test import APITestCase, APITransactionTestCase, APIClient
 
 
 class CkcAPITestCase(APITestCase):
     pass
+
+
+class CkcAPITransactionTestCase(APITransactionTestCase):
+    """For tests where the DB is used from other threads, i.e. channels' database_sync_to_async"""
+    pass
+
+
 class CkcAPIClient(APIClient):
     pass
\ No newline at end of file
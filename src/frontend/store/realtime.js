@@ -3,6 +3,9 @@ import ws_client from "@/utils/ws_client"
 export const state = () => ({
     connection: null,
     initiated: false,
+    // Set when the server couldn't replay what we missed, pages watching this
+    // should refetch their data
+    needs_resync: false,
 })
 
 export const actions = {
@@ -25,8 +28,36 @@ export const actions = {
 
         ws_client.onmessage = e => {
             const data = JSON.parse(e.data)
-            if(data.type === "update") {
-                commit(data.commit, data.data, { root: true })
+            if(data.type === "ping") {
+                // Lets the server know we're still here
+                ws_client.send(JSON.stringify({ type: "pong" }))
+                return
+            }
+            // Batches are just a list of updates sent in one go
+            const updates = data.type === "batch" ? data.updates : [data]
+            updates.forEach(update => {
+                if(update.type === "update" || update.type === "patch") {
+                    if(update.seq && update.seq <= ws_client.lastSeq) {
+                        // Already had this one, i.e. live and again in a replay
+                        return
+                    }
+                    // Patches are applied to what we had, and are skipped
+                    // until a snapshot arrives if we missed one
+                    const payload = ws_client.resolveUpdate(update)
+                    if(payload !== undefined) {
+                        commit(update.commit, payload, { root: true })
+                    }
+                    if(update.seq) {
+                        // Sent back when reconnecting, so we only get what we missed
+                        ws_client.lastSeq = update.seq
+                    }
+                }
+            })
+            if(data.type === "resync") {
+                commit('resync_required')
+            }
+            if(data.type === "rpc") {
+                ws_client.resolveCalls(data)
             }
         }
 
@@ -44,5 +75,11 @@ export const actions = {
 export const mutations = {
     we_began_listening(state) {
         state.initiated = true
+    },
+    resync_required(state) {
+        state.needs_resync = true
+    },
+    resync_done(state) {
+        state.needs_resync = false
     }
 }
@@ -0,0 +1,28 @@
+import cloneDeep from "lodash/cloneDeep"
+
+// Applies an RFC 6902 patch from the backend (realtime.deltas) to a copy of
+// document. Only "add", "remove" and "replace" are ever sent.
+export default function applyPatch(document, patch) {
+    const root = { "": cloneDeep(document) }
+    patch.forEach(operation => {
+        const keys = operation.path.split("/").map(key => key.replace(/~1/g, "/").replace(/~0/g, "~"))
+        let parent = root
+        keys.slice(0, -1).forEach(key => {
+            parent = parent[key]
+        })
+        const key = keys[keys.length - 1]
+
+        if(operation.op === "remove") {
+            if(Array.isArray(parent)) {
+                parent.splice(key, 1)
+            } else {
+                delete parent[key]
+            }
+        } else if(operation.op === "add" && Array.isArray(parent)) {
+            parent.splice(key, 0, operation.value)
+        } else {
+            parent[key] = operation.value
+        }
+    })
+    return root[""]
+}
@@ -1,3 +1,5 @@
+import applyPatch from "@/utils/json_patch"
+
 export default {
     // Default reconnect interval
     reconnectInterval: 5000,
@@ -8,6 +10,22 @@ export default {
     // Log messages
     debug: false,
 
+    // Last update sequence number we saw, used to resume after reconnecting
+    lastSeq: null,
+
+    // RPC calls waiting for an answer, by id
+    pendingCalls: {},
+    nextCallId: 1,
+
+    // Topics we follow, subscribed to again after reconnecting
+    topics: new Set(),
+
+    // Last document and version per commit, for updates the backend sends
+    // as patches, plus commits we asked for a snapshot of
+    documents: {},
+    versions: {},
+    snapshotting: new Set(),
+
     // Open the URL
     open: function(url) {
         // Define that
@@ -25,6 +43,11 @@ export default {
                 console.log('[WS]: Reconnected.');
             }
 
+            // Follow our topics again on this new socket
+            that.topics.forEach(topic => {
+                that.send(JSON.stringify({ type: "subscribe", topic }));
+            });
+
             // Run the open function
             that.onopen(ev);
         }
@@ -34,6 +57,9 @@ export default {
         }
         // Setup the event handler for onclose
         this.instance.onclose = function(e) {
+            // Answers to calls on this socket are never coming
+            that.rejectCalls({ message: "Connection closed", code: 503 });
+
             switch (e){
 
                 // Normal closure
@@ -84,6 +110,74 @@ export default {
         this.instance.send(content);
     },
 
+    // Call a backend realtime.rpc handler, resolves with its result
+    call: function(method, params = {}) {
+        const id = this.nextCallId++;
+        return new Promise((resolve, reject) => {
+            this.pendingCalls[id] = { resolve, reject };
+            this.send(JSON.stringify({ type: "rpc", id, method, params }));
+        });
+    },
+
+    // Follow a backend realtime.topics topic
+    subscribe: function(topic) {
+        this.topics.add(topic);
+        this.send(JSON.stringify({ type: "subscribe", topic }));
+    },
+
+    // Stop following a topic
+    unsubscribe: function(topic) {
+        this.topics.delete(topic);
+        this.send(JSON.stringify({ type: "unsubscribe", topic }));
+    },
+
+    // Returns the full document from an "update" or "patch" message, or
+    // undefined when a patch isn't against the version we have. Then we ask for a
+    // snapshot, which comes back as a regular update.
+    resolveUpdate: function(update) {
+        if (update.type === "patch") {
+            if (this.versions[update.commit] !== update.base) {
+                if (!this.snapshotting.has(update.commit)) {
+                    this.snapshotting.add(update.commit);
+                    this.send(JSON.stringify({ type: "snapshot", commit: update.commit }));
+                }
+                return undefined;
+            }
+            this.documents[update.commit] = applyPatch(this.documents[update.commit], update.patch);
+        } else if (update.version) {
+            this.snapshotting.delete(update.commit);
+            this.documents[update.commit] = update.data;
+        } else {
+            return update.data;
+        }
+        this.versions[update.commit] = update.version;
+        return this.documents[update.commit];
+    },
+
+    // Settle pending calls from an "rpc" message
+    resolveCalls: function(data) {
+        const responses = data.results || [data];
+        responses.forEach(response => {
+            const call = this.pendingCalls[response.id];
+            if (!call) {
+                return;
+            }
+            delete this.pendingCalls[response.id];
+            if (response.error) {
+                call.reject(response.error);
+            } else {
+                call.resolve(response.result);
+            }
+        });
+    },
+
+    // Fail every call still waiting for an answer
+    rejectCalls: function(error) {
+        const calls = this.pendingCalls;
+        this.pendingCalls = {};
+        Object.values(calls).forEach(call => call.reject(error));
+    },
+
     // Define the reconnection function
     reconnect: function(e) {
 
@@ -106,8 +200,12 @@ export default {
             // Define has reconnected
             that.reconnected = true;
 
-            // Try and open the URL
-            that.open(that.url);
+            // Try and open the URL, asking for anything we missed
+            const url = new URL(that.url);
+            if (that.lastSeq) {
+                url.searchParams.set('resume', that.lastSeq);
+            }
+            that.open(url.toString());
 
         }, this.reconnectInterval);
     },